@@ -0,0 +1,382 @@
+"""Benchmarks for tuning the service's settings.
+
+Usage: python benchmark.py rpc [requests]
+       python benchmark.py storage [posts]
+       python benchmark.py blobs [database]
+       python benchmark.py slots [posts]
+
+rpc: Throughput and latency of scheduling and listing posts through a local
+service, for each Compression setting and for payloads that compress well
+(text) and ones that don't (images). grpc doesn't expose how many bytes went
+over the wire, so they're estimated by compressing the serialized message.
+
+storage: Operations per second of each Storage backend on a queue of text
+posts spread over a week, committing after every write like the Database does.
+
+blobs: Size and CPU time of storing posts raw, with zlib, with zstd, and with
+zstd and a dictionary trained on other posts of the same kind. Uses the posts
+in the given service database, or generated ones made of README words.
+
+slots: Time to find a free slot for an auto scheduled post, among queued posts
+spread over a week in a few subreddits, and packed back to back in one, which
+makes every search step over all of them.
+"""
+
+from concurrent import futures
+from configparser import ConfigParser
+import math
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import grpc
+from tabulate import tabulate
+
+import reddit_pb2 as rpc
+import reddit_pb2_grpc as reddit_grpc
+from server import (
+    BLOB_DICTIONARY_SIZE,
+    BLOB_ZSTD_LEVEL,
+    COMPRESSION_ALGORITHMS,
+    BlobCodec,
+    Database,
+    DbCommand,
+    MemoryStorage,
+    POST_SPACING,
+    Servicer,
+    SlotIndex,
+    SqliteStorage,
+    Storage,
+    database_thread,
+    load_dictionaries,
+    make_post_from_row,
+    rpc_server_settings,
+    zstandard,
+)
+
+PORT = 50099
+TEXT_SIZE = 16 * 1024  # bytes, a long self post
+IMAGE_SIZE = 2 * 1024 * 1024  # bytes, a typical photo
+WORDS = ["scheduled", "reddit", "post", "about", "the", "and", "of", "to", "a"]
+HEADERS = [
+    "call",
+    "compression",
+    "size KB",
+    "wire KB",
+    "p50 ms",
+    "p95 ms",
+    "calls/s",
+    "MB/s",
+]
+
+
+def text_post() -> rpc.Post:
+    body = []
+    while len(body) * 6 < TEXT_SIZE:
+        body.append(random.choice(WORDS))
+    return rpc.Post(
+        title="Benchmark",
+        subreddit="test",
+        scheduled_time=int(time.time()) + 3600,
+        data=rpc.Data(text=rpc.TextPost(body=" ".join(body))),
+    )
+
+
+def image_post() -> rpc.Post:
+    # Image formats are already compressed, so random bytes are representative
+    return rpc.Post(
+        title="Benchmark",
+        subreddit="test",
+        scheduled_time=int(time.time()) + 3600,
+        data=rpc.Data(
+            image=rpc.ImagePost(image_data=os.urandom(IMAGE_SIZE), extension="png")
+        ),
+    )
+
+
+def timed(call: Callable[[], object], times: int) -> List[float]:
+    latencies = []
+    for _ in range(times):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summarize(call: str, algorithm: str, message, latencies: List[float]) -> list:
+    size = message.ByteSize()
+    wire = size
+    if algorithm != "none":
+        wire = len(zlib.compress(message.SerializeToString()))
+    total = sum(latencies)
+    latencies = sorted(latencies)
+    return [
+        call,
+        algorithm,
+        f"{size / 1024:.0f}",
+        f"{wire / 1024:.0f}",
+        f"{statistics.median(latencies) * 1000:.2f}",
+        f"{latencies[int(len(latencies) * 0.95)] * 1000:.2f}",
+        f"{len(latencies) / total:.0f}",
+        f"{size * len(latencies) / total / 1024 / 1024:.1f}",
+    ]
+
+
+def bench_payload(name: str, post: rpc.Post, algorithm: str, requests: int) -> list:
+    """Schedules post requests times, then lists all of them."""
+    compression = COMPRESSION_ALGORITHMS[algorithm]
+    parser = ConfigParser()
+    # Room for listing every scheduled image
+    parser.read_string(f"[General]\nMaxMessageSize = {IMAGE_SIZE * requests >> 19}")
+    settings = rpc_server_settings(parser["General"])
+
+    with tempfile.TemporaryDirectory() as d:
+        db = Database(SqliteStorage(os.path.join(d, "database.sqlite")))
+        threading.Thread(target=database_thread, args=(db,), daemon=True).start()
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), **settings)
+        reddit_grpc.add_RedditSchedulerServicer_to_server(
+            Servicer()
+            .link_database(db)
+            .link_poster(SimpleNamespace(wake=lambda: None))
+            .set_compression(compression, 0),
+            server,
+        )
+        server.add_insecure_port(f"[::]:{PORT}")
+        server.start()
+        try:
+            with grpc.insecure_channel(
+                f"[::]:{PORT}", options=settings["options"]
+            ) as channel:
+                stub = reddit_grpc.RedditSchedulerStub(channel)
+                schedule = timed(
+                    lambda: stub.SchedulePost(post, compression=compression), requests
+                )
+                listing = stub.ListPosts(rpc.ListPostsRequest())
+                list_all = timed(
+                    lambda: stub.ListPosts(rpc.ListPostsRequest()),
+                    max(requests // 10, 3),
+                )
+        finally:
+            server.stop(None)
+            db.queue_command(DbCommand(command="quit", obj=None))
+    return [
+        summarize(f"SchedulePost {name}", algorithm, post, schedule),
+        summarize(f"ListPosts {name}", algorithm, listing, list_all),
+    ]
+
+
+def bench_rpc(requests: str = "50"):
+    rows = []
+    for name, post in [("text", text_post()), ("image", image_post())]:
+        for algorithm in COMPRESSION_ALGORITHMS:
+            rows += bench_payload(name, post, algorithm, int(requests))
+    print(tabulate(rows, headers=HEADERS))
+
+
+def sqlite_storage(path: str) -> SqliteStorage:
+    storage = SqliteStorage(path)
+    storage.open()
+    return storage
+
+
+def bench_backend(storage: Storage, posts: int) -> Dict[str, float]:
+    """Seconds each kind of operation took for all posts, or for a few
+    hundred reads."""
+    start = int(time.time())
+    span = 7 * 24 * 3600
+    post = text_post()
+    times = {}
+
+    def run(name: str, call: Callable[[int], object], count: int):
+        begin = time.perf_counter()
+        for i in range(count):
+            call(i)
+        times[name] = (time.perf_counter() - begin, count)
+
+    def add(_):
+        post.scheduled_time = start + random.randrange(span)
+        ids.extend(storage.add([post]))
+        storage.commit()
+
+    def edit(i):
+        entry = storage.get(ids[i])
+        entry.post.scheduled_time += 60
+        storage.edit(ids[i], entry.post)
+        storage.commit()
+
+    def mark_posted(i):
+        storage.mark_posted(ids[i])
+        storage.commit()
+
+    ids: List[int] = []
+    reads = min(posts, 200)
+    run("add", add, posts)
+    # Posts due within the first hour, like a Poster step catching up
+    run("eligible", lambda _: storage.eligible(start + 3600), reads)
+    run("next_due", lambda i: storage.next_due(start + span * i // reads), reads)
+    run("list", lambda _: storage.list(), max(reads // 50, 3))
+    run("edit", edit, posts)
+    run("mark_posted", mark_posted, posts)
+    return times
+
+
+def bench_storage(posts: str = "2000"):
+    rows = []
+    with tempfile.TemporaryDirectory() as d:
+        backends = [
+            ("sqlite file", lambda: sqlite_storage(os.path.join(d, "bench.sqlite"))),
+            ("sqlite :memory:", lambda: sqlite_storage(":memory:")),
+            ("memory", MemoryStorage),
+        ]
+        for name, make in backends:
+            for op, (elapsed, count) in bench_backend(make(), int(posts)).items():
+                rows.append(
+                    [
+                        name,
+                        op,
+                        count,
+                        f"{elapsed * 1000 / count:.3f}",
+                        f"{count / elapsed:.0f}",
+                    ]
+                )
+    print(tabulate(rows, headers=["backend", "operation", "calls", "ms", "calls/s"]))
+
+
+def generated_blobs() -> Dict[str, List[bytes]]:
+    with open(os.path.join(os.path.dirname(__file__), "README.md")) as f:
+        words = f.read().split()
+
+    def text(count: int) -> str:
+        return " ".join(random.choice(words) for _ in range(count))
+
+    def post(data: rpc.Data) -> bytes:
+        return rpc.Post(
+            title=text(random.randint(4, 15)),
+            subreddit="test",
+            scheduled_time=int(time.time()),
+            data=data,
+        ).SerializeToString()
+
+    return {
+        "short text": [
+            post(rpc.Data(text=rpc.TextPost(body=text(random.randint(10, 80)))))
+            for _ in range(1000)
+        ],
+        "long text": [
+            post(rpc.Data(text=rpc.TextPost(body=text(TEXT_SIZE // 6))))
+            for _ in range(100)
+        ],
+        "poll": [
+            post(
+                rpc.Data(
+                    poll=rpc.PollPost(
+                        selftext=text(30), duration=3, options=[text(3)] * 4
+                    )
+                )
+            )
+            for _ in range(1000)
+        ],
+        "image": [image_post().SerializeToString() for _ in range(5)],
+    }
+
+
+def database_blobs(path: str) -> Dict[str, List[bytes]]:
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    load_dictionaries(conn)
+    blobs = [
+        make_post_from_row(row).SerializeToString()
+        for row in conn.execute("SELECT * FROM Posts")
+    ]
+    conn.close()
+    return {"database": blobs}
+
+
+def bench_codec(codec: BlobCodec, blobs: List[bytes]) -> List[str]:
+    begin = time.perf_counter()
+    packed = [codec.encode(blob) for blob in blobs]
+    encode = time.perf_counter() - begin
+    begin = time.perf_counter()
+    for blob in packed:
+        codec.decode(blob)
+    decode = time.perf_counter() - begin
+    size = sum(len(blob) for blob in blobs)
+    stored = sum(len(blob) for blob in packed)
+    return [
+        f"{stored / 1024:.0f}",
+        f"{size / stored:.2f}",
+        f"{encode * 1e6 / len(blobs):.1f}",
+        f"{decode * 1e6 / len(blobs):.1f}",
+    ]
+
+
+def bench_blobs(database: str = ""):
+    kinds = database_blobs(database) if database else generated_blobs()
+    rows = []
+    for kind, blobs in kinds.items():
+        # Half to train the dictionary on, the other half to measure
+        training, blobs = blobs[::2], blobs[1::2] or blobs
+        codecs = [("raw", BlobCodec("none")), ("zlib", BlobCodec("zlib"))]
+        if zstandard is not None:
+            codecs.append(("zstd", BlobCodec("zstd")))
+            try:
+                dictionary = zstandard.train_dictionary(
+                    BLOB_DICTIONARY_SIZE, training, level=BLOB_ZSTD_LEVEL
+                )
+                trained = BlobCodec("zstd")
+                trained.add_dictionary(dictionary.as_bytes())
+                codecs.append(("zstd + dictionary", trained))
+            except zstandard.ZstdError:
+                pass  # Too few posts to learn from
+        for name, codec in codecs:
+            rows.append([kind, name, len(blobs)] + bench_codec(codec, blobs))
+    headers = ["posts", "encoding", "count", "KB", "ratio", "encode us", "decode us"]
+    print(tabulate(rows, headers=headers))
+
+
+def bench_slots(posts: str = "5000"):
+    start = int(time.time())
+    span = 7 * 24 * 3600
+    spread = SlotIndex()
+    for id in range(int(posts)):
+        spread.add(id, f"sub{id % 5}", start + random.randrange(span))
+    packed = SlotIndex()
+    for id in range(int(posts)):
+        packed.add(id, "sub0", start + id * POST_SPACING)
+    cases = [
+        ("spread", spread, [("sub0", 0)]),
+        ("spread, 2 targets", spread, [("sub0", 0), ("sub1", 60), ("sub2", 120)]),
+        ("packed", packed, [("sub0", 0)]),
+    ]
+    rows = []
+    for name, index, slots in cases:
+        times = 100
+        begin = time.perf_counter()
+        for _ in range(times):
+            at = start + random.randrange(span)
+            index.earliest(slots, at, math.inf, POST_SPACING)
+        elapsed = time.perf_counter() - begin
+        rows.append([name, posts, f"{elapsed * 1000 / times:.3f}"])
+    print(tabulate(rows, headers=["queue", "posts", "ms"]))
+
+
+FUNC_MAP = {
+    "rpc": bench_rpc,
+    "storage": bench_storage,
+    "blobs": bench_blobs,
+    "slots": bench_slots,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in FUNC_MAP:
+        print(__doc__)
+        sys.exit(1)
+    FUNC_MAP[sys.argv[1]](*sys.argv[2:])
@@ -1,19 +1,27 @@
 import configparser
+import fcntl
+import hashlib
+import itertools
 from io import TextIOWrapper
+import json
 import os
+import pstats
 import shutil
+import uuid
 from datetime import datetime
 
 import click
 import grpc
-import yaml
 import questionary
 from dateutil import parser
 from tabulate import tabulate
 from pathlib import Path
-from typing import Dict, List, Literal, Optional, TypeAlias
+from typing import BinaryIO, Dict, Iterator, List, Literal, Optional, Tuple, TypeAlias
 from colored import fg, attr
+from google.protobuf import json_format
+from google.protobuf.message import DecodeError
 
+import post_file
 import reddit_pb2 as rpc
 import reddit_pb2_grpc as reddit_grpc
 
@@ -25,6 +33,19 @@ CONFIG_SEARCH_PATHS = [
     "./config.ini",
 ]
 
+CACHE_DIR = Path(os.path.expandvars("$HOME/.cache/reddit-scheduler"))
+SPOOL_DIR = Path(os.path.expandvars("$HOME/.local/share/reddit-scheduler"))
+SPOOL_FLUSH_TIMEOUT = 5  # seconds
+PROFILE_SLACK = 10  # seconds a profile call waits past the profile's timeout
+# Same defaults as the service, see server.py
+MAX_MESSAGE_SIZE = 32  # MB
+COMPRESSION_THRESHOLD = 64  # KB
+COMPRESSION_ALGORITHMS = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
 ERR_MISSING_SERVICE = (
     "Failed to connect to service. Are you sure it's running and on the expected port?\n\n"
     "You can turn it on with\n"
@@ -60,11 +81,59 @@ ERR_SAMPLE_CONFIG = (
 )
 
 PostType: TypeAlias = Literal["text", "poll", "image", "url"]
+ExportFormat: TypeAlias = Literal["proto", "ndjson"]
 
 
 class Config:
-    def __init__(self, port):
+    def __init__(
+        self,
+        port,
+        max_message_size: float = MAX_MESSAGE_SIZE,
+        keepalive: float = 0,
+        compression: grpc.Compression = grpc.Compression.NoCompression,
+        compression_threshold: float = COMPRESSION_THRESHOLD,
+    ):
         self.port = port
+        self.max_message_size = int(max_message_size * 1024 * 1024)
+        self.keepalive = int(keepalive * 1000)
+        self.compression = compression
+        self.compression_threshold = int(compression_threshold * 1024)
+
+    @classmethod
+    def from_general(cls, port, general: configparser.SectionProxy) -> "Config":
+        """Reads the rpc settings shared with the service from its General section."""
+        name = general.get("Compression", fallback="none").lower()
+        if name not in COMPRESSION_ALGORITHMS:
+            raise ValueError(f"Unknown compression {name}")
+        return cls(
+            port,
+            max_message_size=general.getfloat(
+                "MaxMessageSize", fallback=MAX_MESSAGE_SIZE
+            ),
+            keepalive=general.getfloat("KeepaliveTime", fallback=0),
+            compression=COMPRESSION_ALGORITHMS[name],
+            compression_threshold=general.getfloat(
+                "CompressionThreshold", fallback=COMPRESSION_THRESHOLD
+            ),
+        )
+
+    def channel(self) -> grpc.Channel:
+        options = [
+            ("grpc.max_send_message_length", self.max_message_size),
+            ("grpc.max_receive_message_length", self.max_message_size),
+        ]
+        if self.keepalive > 0:
+            options += [
+                ("grpc.keepalive_time_ms", self.keepalive),
+                ("grpc.keepalive_permit_without_calls", 1),
+            ]
+        return grpc.insecure_channel(f"[::]:{self.port}", options=options)
+
+    def call_compression(self, request) -> Optional[grpc.Compression]:
+        """Compression for a call sending request, if it's large enough to pay off."""
+        if request.ByteSize() >= self.compression_threshold:
+            return self.compression
+        return None
 
 
 def validate_time(time_input: str) -> str | Literal[True]:
@@ -213,143 +282,113 @@ def make_post_from_cli(stub: reddit_grpc.RedditSchedulerStub) -> rpc.Post | None
     return post
 
 
-def verify_yaml_keys(file, keys: List[str]) -> bool:
-    for key in keys:
-        if key not in file:
-            print("YAML missing key:", key)
-            print(ERR_SAMPLE_CONFIG)
-            return False
-    return True
-
-
-def make_post_from_text_yaml(file) -> rpc.TextPost | None:
-    if not verify_yaml_keys(file, ["body"]):
+def read_post_file(file_stream: TextIOWrapper) -> Optional[dict]:
+    """The parsed YAML of a post file, or None if it's not a post file."""
+    try:
+        return post_file.read_post_file(file_stream)
+    except ValueError as e:
+        print_post_file_error(e)
         return None
-    return rpc.TextPost(body=file["body"])
 
 
-def make_post_from_poll_yaml(file) -> rpc.PollPost | None:
-    if not verify_yaml_keys(file, ["options"]):
-        return None
-    post = rpc.PollPost(
-        options=file["options"],
-    )
-    if "selftext" in file:
-        post.selftext = file["selftext"]
-    if "duration" in file:
-        try:
-            post.duration = int(file["duration"])
-        except ValueError:
-            print("Invalid duration in YAML file: ", file["duration"])
-    return post
+def print_post_file_error(e: ValueError):
+    print(ERR_INVALID_POST_FILE, e)
+    print(ERR_SAMPLE_CONFIG)
 
 
-def make_post_from_image_yaml(file, root: Path) -> rpc.ImagePost | None:
-    if not verify_yaml_keys(file, ["image_path"]):
-        return None
-    path = make_absolute(root, Path(file["image_path"]))
-    data = read_file_data(path)
-    if data is None:
-        return None
-    ext = path.suffix.lstrip(".")
-    nsfw = False
-    if "nsfw" in file:
-        nsfw = file["nsfw"]
-    return rpc.ImagePost(image_data=data, extension=ext, nsfw=nsfw)
-
+def resolve_flairs(
+    stub: reddit_grpc.RedditSchedulerStub, pairs: List[Tuple[str, str]]
+) -> Optional[Dict[Tuple[str, str], rpc.Flair]]:
+    """Looks up every (subreddit, flair text) pair in a single call.
 
-def make_post_from_url_yaml(file) -> rpc.UrlPost | None:
-    if not verify_yaml_keys(file, ["url"]):
+    Returns the flairs by pair, or None after printing why some weren't found.
+    """
+    pairs = list(dict.fromkeys(pairs))
+    if len(pairs) == 0:
+        return {}
+    reply: rpc.ResolveFlairsReply = stub.ResolveFlairs(
+        rpc.ResolveFlairsRequest(
+            subreddits=[subreddit for subreddit, _ in pairs],
+            flair_texts=[text for _, text in pairs],
+        )
+    )
+    if reply.error_msg:
+        print("Failed to find flairs. Server returned error:", reply.error_msg)
+        return None
+    errors = [err for err in reply.error_msgs if err]
+    for err in errors:
+        print(err)
+    if errors:
         return None
-    return rpc.UrlPost(url=file["url"])
+    return dict(zip(pairs, reply.flairs))
 
 
-def make_post_from_file(
-    stub: reddit_grpc.RedditSchedulerStub, file_stream: TextIOWrapper
+def make_post_from_yaml(
+    parsed: dict, root: Path, flairs: Dict[Tuple[str, str], rpc.Flair]
 ) -> rpc.Post | None:
+    """Makes the post of a parsed post file, with its flairs looked up in flairs."""
     try:
-        parsed = yaml.load(file_stream, Loader=yaml.SafeLoader)
-    except yaml.YAMLError as e:
-        print(ERR_INVALID_POST_FILE, e)
-        return None
-    if not verify_yaml_keys(parsed, ["title", "subreddit", "type", "scheduled_time"]):
-        return
-    try:
-        time = parser.parse(parsed["scheduled_time"], dayfirst=True)
-    except ValueError:
-        print("Invalid scheduled time in YAML file:", parsed["scheduled_time"])
-        return None
-    except TypeError:
-        print(
-            "Schedule time should be of type string, got:",
-            type(parsed["scheduled_time"]),
-        )
+        post = post_file.make_post(parsed, root, lambda *pair: flairs[pair])
+    except ValueError as e:
+        print_post_file_error(e)
         return None
 
+    time = datetime.fromtimestamp(post.scheduled_time)
     now = datetime.now()
-    if time < now:
+    # Auto scheduled posts start looking for a free time from now at the earliest
+    if time < now and not post.HasField("auto_schedule"):
         print("The scheduled time from the YAML file is in the past:")
         print("YAML:", time.strftime(TIME_FMT))
         print("Current: ", now.strftime(TIME_FMT))
         print("It will be posted immediately. Do you still want to continue? (y/n)")
         if input(PROMPT) != "y":
             return None
+    return post
 
-    subreddit = parsed["subreddit"]
 
-    flair: Optional[rpc.Flair] = None
-    if "flair" in parsed:
-        resp: rpc.ListFlairsResponse = stub.ListFlairs(
-            rpc.ListFlairsRequest(subreddit=subreddit)
-        )
-        text = parsed["flair"]
-        flair: Optional[rpc.Flair] = None
-        for f in resp.flairs:
-            if f.text == text:
-                flair = f
-                break
-        if flair is None:
-            print(f"r/{subreddit} doesn't have a flair called {flair}")
-            return None
-
-    post_type = parsed["type"]
-    data = rpc.Data()
-    p = None
-    if post_type == "poll":
-        p = make_post_from_poll_yaml(parsed)
+def make_posts_from_files(
+    stub: reddit_grpc.RedditSchedulerStub, file_streams: List[TextIOWrapper]
+) -> Optional[List[rpc.Post]]:
+    """Makes the posts of post files, looking up the flairs of all of them in a
+    single call. Returns None if any of the files is invalid."""
+    parsed = []
+    for file_stream in file_streams:
+        p = read_post_file(file_stream)
         if p is None:
             return None
-        data.poll.CopyFrom(p)
-    elif post_type == "text":
-        p = make_post_from_text_yaml(parsed)
-        if p is None:
-            return None
-        data.text.CopyFrom(p)
-    elif post_type == "image":
-        p = make_post_from_image_yaml(parsed, Path(file_stream.name).parent)
-        if p is None:
-            return None
-        data.image.CopyFrom(p)
-    elif post_type == "url":
-        p = make_post_from_url_yaml(parsed)
-        if p is None:
-            return None
-        data.url.CopyFrom(p)
-    else:
-        print("Unknown post type: ", post_type)
-        print(ERR_SAMPLE_CONFIG)
-        return None
-    if p is None:
+        parsed.append((p, Path(file_stream.name).parent))
+    flairs = resolve_flairs(
+        stub, [f for p, _ in parsed for f in post_file.post_file_flairs(p)]
+    )
+    if flairs is None:
         return None
+    posts = []
+    for p, root in parsed:
+        post = make_post_from_yaml(p, root, flairs)
+        if post is None:
+            return None
+        posts.append(post)
+    return posts
 
-    return rpc.Post(
-        title=parsed["title"],
-        subreddit=parsed["subreddit"],
-        scheduled_time=int(time.timestamp()),
-        data=data,
-        flair_id=flair.id if flair else "",
-        flair_text=flair.text if flair else "",
+
+def make_post_from_file(
+    stub: reddit_grpc.RedditSchedulerStub, file_stream: TextIOWrapper
+) -> rpc.Post | None:
+    posts = make_posts_from_files(stub, [file_stream])
+    return posts[0] if posts else None
+
+
+def find_flair(
+    stub: reddit_grpc.RedditSchedulerStub, subreddit: str, text: str
+) -> Optional[rpc.Flair]:
+    resp: rpc.ListFlairsResponse = stub.ListFlairs(
+        rpc.ListFlairsRequest(subreddit=subreddit)
     )
+    for f in resp.flairs:
+        if f.text == text:
+            return f
+    print(f"r/{subreddit} doesn't have a flair called {text}")
+    return None
 
 
 def status_to_string(status) -> str:
@@ -359,10 +398,69 @@ def status_to_string(status) -> str:
         return "Error"
     elif status == rpc.PostStatus.POSTED:
         return "Posted"
+    elif status == rpc.PostStatus.DELETED:
+        return "Deleted"
+    elif status == rpc.PostStatus.SUBMITTED:
+        return "Submitted"
     else:
         return "Unknown"
 
 
+def post_cache_path(port) -> Path:
+    return CACHE_DIR / f"posts-{port}.cache"
+
+
+def load_post_cache(path: Path) -> rpc.SyncPostsReply:
+    """Reads the local copy of the queue, or an empty one if there is none."""
+    cache = rpc.SyncPostsReply()
+    try:
+        with open(path, "rb") as f:
+            cache.ParseFromString(f.read())
+    except (OSError, DecodeError):
+        return rpc.SyncPostsReply()
+    return cache
+
+
+def save_post_cache(path: Path, cache: rpc.SyncPostsReply):
+    os.makedirs(path.parent, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        f.write(cache.SerializeToString())
+    os.replace(tmp, path)
+
+
+def apply_sync(cache: rpc.SyncPostsReply, reply: rpc.SyncPostsReply) -> bool:
+    """Merges a SyncPosts reply into the cache. Returns whether anything changed."""
+    if len(reply.posts) == 0 and len(reply.deleted_ids) == 0:
+        if reply.seq == cache.seq:
+            return False
+    posts = {entry.id: entry for entry in cache.posts}
+    for entry in reply.posts:
+        posts[entry.id] = entry
+    for id in reply.deleted_ids:
+        posts.pop(id, None)
+    cache.CopyFrom(rpc.SyncPostsReply(posts=posts.values(), seq=reply.seq))
+    return True
+
+
+def sync_posts(
+    stub: reddit_grpc.RedditSchedulerStub, path: Path
+) -> rpc.SyncPostsReply | None:
+    """Brings the local copy of the queue up to date and returns it."""
+    cache = load_post_cache(path)
+    reply = stub.SyncPosts(rpc.SyncPostsRequest(since_seq=cache.seq))
+    if not reply.error_msg and reply.seq < cache.seq:
+        # Service is running on a different database, start over
+        cache = rpc.SyncPostsReply()
+        reply = stub.SyncPosts(rpc.SyncPostsRequest(since_seq=0))
+    if reply.error_msg:
+        print("Failed to sync posts. Server returned error:", reply.error_msg)
+        return None
+    if apply_sync(cache, reply):
+        save_post_cache(path, cache)
+    return cache
+
+
 def print_post_list(posts: List[rpc.PostDbEntry], filter: str):
     rows = []
     headers = ["Id", "Scheduled Time", "Subreddit", "Title", "Status"]
@@ -390,6 +488,26 @@ def print_post_list(posts: List[rpc.PostDbEntry], filter: str):
         print(f"A post errored, use `reddit list -p {error_id}` to see why")
 
 
+def post_link(entry: rpc.PostDbEntry) -> str:
+    """URL of the post on reddit, or "" if it isn't known."""
+    if entry.permalink != "":
+        return f"https://www.reddit.com{entry.permalink}"
+    if entry.submission_id != "":
+        # Short link, the permalink is filled in once stats are fetched
+        return f"https://redd.it/{entry.submission_id.split('_')[-1]}"
+    return ""
+
+
+def format_post_event(entry: rpc.PostDbEntry) -> str:
+    now = datetime.now().strftime(TIME_FMT)
+    post = entry.post
+    status = status_to_string(entry.status)
+    line = f'[{now}] {entry.id}: r/{post.subreddit} "{post.title}" -> {status}'
+    if entry.status == rpc.PostStatus.ERROR:
+        line += f"\n{fg('red')}{entry.error}{attr('reset')}"
+    return line
+
+
 def print_post_info(all_posts: List[rpc.PostDbEntry], post_id: int):
     entry = None
     for p in all_posts:
@@ -433,44 +551,406 @@ def print_post_info(all_posts: List[rpc.PostDbEntry], post_id: int):
     rows.extend(details)
     if post.flair_text != "":
         rows.append(["Flair", post.flair_text])
+    link = post_link(entry)
+    if link != "":
+        rows.append(["Link", link])
+    if entry.HasField("stats"):
+        stats = entry.stats
+        fetched = datetime.fromtimestamp(stats.fetched_time).strftime(TIME_FMT)
+        rows += [
+            ["Score", stats.score],
+            ["Comments", stats.num_comments],
+            ["Upvote ratio", f"{stats.upvote_ratio:.0%}"],
+            ["Stats from", fetched],
+        ]
 
     print(tabulate(rows))
     if entry.status == rpc.PostStatus.ERROR:
         print(f"{fg('red')}Posting failed with error:\n{entry.error}{attr('reset')}")
 
 
+def encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def read_varint(stream: BinaryIO) -> int | None:
+    """Reads a varint from the stream, or returns None at the end of it."""
+    n = 0
+    shift = 0
+    while True:
+        b = stream.read(1)
+        if len(b) == 0:
+            if shift == 0:
+                return None
+            raise EOFError("truncated length prefix")
+        n |= (b[0] & 0x7F) << shift
+        if b[0] & 0x80 == 0:
+            return n
+        shift += 7
+
+
+def write_entry(stream: BinaryIO, entry: rpc.PostDbEntry, format: ExportFormat):
+    """Writes an entry as length-delimited protobuf or as a line of JSON."""
+    if format == "proto":
+        data = entry.SerializeToString()
+        stream.write(encode_varint(len(data)))
+        stream.write(data)
+    else:
+        line = json.dumps(json_format.MessageToDict(entry)) + "\n"
+        stream.write(line.encode())
+
+
+def read_entries(stream: BinaryIO, format: ExportFormat) -> Iterator[rpc.PostDbEntry]:
+    """Reads back entries written by write_entry one at a time."""
+    if format == "proto":
+        while (size := read_varint(stream)) is not None:
+            data = stream.read(size)
+            if len(data) != size:
+                raise EOFError("truncated post")
+            entry = rpc.PostDbEntry()
+            entry.ParseFromString(data)
+            yield entry
+    else:
+        for line in stream:
+            if line.strip():
+                yield json_format.Parse(line, rpc.PostDbEntry())
+
+
+def spool_path(port) -> Path:
+    return SPOOL_DIR / f"spool-{port}.bin"
+
+
+def read_spool(path: Path) -> List[rpc.Post]:
+    """Reads the posts waiting in the spool, oldest first."""
+    posts = []
+    try:
+        with open(path, "rb") as f:
+            while (size := read_varint(f)) is not None:
+                data = f.read(size)
+                if len(data) != size:
+                    # Interrupted while appending, the post wasn't spooled
+                    break
+                posts.append(rpc.Post.FromString(data))
+    except FileNotFoundError:
+        pass
+    except (EOFError, DecodeError):
+        print("Post spool is corrupt, some spooled posts were lost:", path)
+    return posts
+
+
+def post_digest(post: rpc.Post) -> bytes:
+    """Digest of what the post says, leaving out its idempotency key."""
+    if post.idempotency_key:
+        keyless = rpc.Post()
+        keyless.CopyFrom(post)
+        keyless.ClearField("idempotency_key")
+        post = keyless
+    return hashlib.sha256(post.SerializeToString(deterministic=True)).digest()
+
+
+def dedupe_posts(posts: List[rpc.Post]) -> List[rpc.Post]:
+    """Drops repeats of the same post, keeping the first one in place."""
+    seen = set()
+    unique = []
+    for post in posts:
+        digest = post_digest(post)
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(post)
+    return unique
+
+
+def lock_spool(path: Path) -> BinaryIO:
+    """Keeps other clients off the spool until the returned file is closed."""
+    os.makedirs(path.parent, exist_ok=True)
+    lock = open(path.with_suffix(".lock"), "wb")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def spool_post(path: Path, post: rpc.Post) -> bool:
+    """Saves the post to be scheduled later. Returns False if it already was.
+
+    The post is given an idempotency key, so the service schedules it only
+    once however many times the spool is sent.
+    """
+    with lock_spool(path):
+        digest = post_digest(post)
+        if any(post_digest(p) == digest for p in read_spool(path)):
+            return False
+        keyed = rpc.Post()
+        keyed.CopyFrom(post)
+        keyed.idempotency_key = keyed.idempotency_key or uuid.uuid4().hex
+        data = keyed.SerializeToString(deterministic=True)
+        with open(path, "ab") as f:
+            f.write(encode_varint(len(data)))
+            f.write(data)
+    return True
+
+
+def flush_spool(
+    stub: reddit_grpc.RedditSchedulerStub,
+    path: Path,
+    compression: Optional[grpc.Compression] = None,
+) -> int:
+    """Schedules the spooled posts in one call and empties the spool.
+
+    Rejected posts are reported and dropped. Returns the number of posts that
+    were scheduled. The spool is left alone if the call fails, even if the
+    service scheduled the posts before the reply was lost. Their idempotency
+    keys keep the next flush from scheduling them twice.
+    """
+    with lock_spool(path):
+        posts = dedupe_posts(read_spool(path))
+        if len(posts) == 0:
+            return 0
+        reply: rpc.SchedulePostsReply = stub.SchedulePosts(
+            rpc.SchedulePostsRequest(posts=posts),
+            timeout=SPOOL_FLUSH_TIMEOUT,
+            compression=compression,
+        )
+        if reply.error_msg:
+            print(
+                "Failed to send spooled posts. Server returned error:", reply.error_msg
+            )
+            return 0
+        os.remove(path)
+    for post, err in zip(posts, reply.error_msgs):
+        if err:
+            print(
+                f'Spooled post "{post.title}" to r/{post.subreddit} was rejected: {err}'
+            )
+    return sum(1 for err in reply.error_msgs if not err)
+
+
+def externalize_image(entry: rpc.PostDbEntry, image_dir: Path, root: Path):
+    """Moves the image of an image post into its own file in image_dir.
+
+    The entry keeps a reference to the file relative to root.
+    """
+    if not entry.post.data.HasField("image"):
+        return
+    image = entry.post.data.image
+    path = image_dir / f"{entry.id}.{image.extension}"
+    with open(path, "wb") as f:
+        f.write(image.image_data)
+    image.image_data = b""
+    image.image_ref = os.path.relpath(path.absolute(), root.absolute())
+
+
+def inline_image(entry: rpc.PostDbEntry, root: Path) -> bool:
+    """Reads a referenced image back into the entry. Returns False on failure."""
+    if not entry.post.data.HasField("image"):
+        return True
+    image = entry.post.data.image
+    if image.image_ref == "":
+        return True
+    data = read_file_data(make_absolute(root, Path(image.image_ref)))
+    if data is None:
+        return False
+    image.image_data = data
+    image.image_ref = ""
+    return True
+
+
+def print_rpc_error(e: grpc.RpcError):
+    """Explains a failed RPC, which usually means the service isn't running."""
+    if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+        print("Service is busy. Server returned error:", e.details())
+    else:
+        print(ERR_MISSING_SERVICE)
+
+
+def schedule_posts(
+    config, stub: reddit_grpc.RedditSchedulerStub, posts: List[rpc.Post]
+):
+    """Schedules posts from several files in one call, or spools them if the
+    service isn't reachable."""
+    request = rpc.SchedulePostsRequest(posts=posts)
+    try:
+        reply: rpc.SchedulePostsReply = stub.SchedulePosts(
+            request, compression=config.call_compression(request)
+        )
+    except grpc.RpcError as e:
+        if e.code() != grpc.StatusCode.UNAVAILABLE:
+            raise
+        saved = sum(spool_post(spool_path(config.port), p) for p in posts)
+        print(
+            f"Service isn't reachable, saved {saved} posts to schedule once it is. "
+            "Run `reddit sync` to send them."
+        )
+        return
+    if reply.error_msg:
+        print("Failed to schedule posts. Server returned error:", reply.error_msg)
+        return
+    for p, err, warning in itertools.zip_longest(
+        posts, reply.error_msgs, reply.warnings, fillvalue=""
+    ):
+        if err:
+            print(f'Post "{p.title}" to r/{p.subreddit} was rejected: {err}')
+        elif warning:
+            print(f'Post "{p.title}" to r/{p.subreddit}: {warning}')
+    print(f"Scheduled {sum(1 for err in reply.error_msgs if not err)} posts.")
+
+
 @click.command()
-@click.option("-f", "--file", type=click.File())
+@click.option("-f", "--file", "files", type=click.File(), multiple=True)
 @click.pass_obj
-def post(config, file):
+def post(config, files):
     """Schedule a reddit post.
 
     Default behavior is an interactive CLI. If FILENAME is provided, then post
     information will be sourced from there. Use `reddit file` to generate
-    boilerplate post yaml files which can be filled in.
+    boilerplate post yaml files which can be filled in. Give -f several times
+    to schedule several files at once.
     """
     try:
-        with grpc.insecure_channel(f"[::]:{config.port}") as channel:
+        with config.channel() as channel:
             stub = reddit_grpc.RedditSchedulerStub(channel)
+            if len(files) > 1:
+                posts = make_posts_from_files(stub, list(files))
+                if posts is not None:
+                    schedule_posts(config, stub, posts)
+                return
             rpc_post = (
                 make_post_from_cli(stub)
-                if file is None
-                else make_post_from_file(stub, file)
+                if len(files) == 0
+                else make_post_from_file(stub, files[0])
             )
             if rpc_post is None:
                 return
-            reply = stub.SchedulePost(rpc_post)
+            try:
+                reply = stub.SchedulePost(
+                    rpc_post, compression=config.call_compression(rpc_post)
+                )
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.UNAVAILABLE:
+                    raise
+                if spool_post(spool_path(config.port), rpc_post):
+                    print(
+                        "Service isn't reachable, saved the post to schedule once "
+                        "it is. Run `reddit sync` to send it."
+                    )
+                else:
+                    print("Service isn't reachable, the post is already saved.")
+                return
             if reply.error_msg:
                 print(
                     "Failed to schedule post. Server returned error:", reply.error_msg
                 )
+                return
+            if reply.warning:
+                print("Warning:", reply.warning)
+            if rpc_post.HasField("auto_schedule") and reply.scheduled_time:
+                time = datetime.fromtimestamp(reply.scheduled_time)
+                print(f"Scheduled for {time.strftime(TIME_FMT)}.")
             else:
                 print("Scheduled.")
     except grpc.RpcError as e:
-        print(ERR_MISSING_SERVICE)
+        print_rpc_error(e)
         print(e)
 
 
+@click.command()
+@click.argument("post_ids", type=int, nargs=-1, required=True)
+@click.option("-t", "--time", help="New scheduled time, e.g. '3/20 18:01'")
+@click.option(
+    "-o",
+    "--offset",
+    type=int,
+    help="Minutes to move the posts by, negative moves them earlier",
+)
+@click.pass_obj
+def reschedule(config, post_ids, time, offset):
+    """Change when posts are posted.
+    Moves the posts with the given POST_IDS to a new time, or all of them by the
+    same offset. Either all posts are moved or none are.
+    """
+    if (time is None) == (offset is None):
+        print("Give either --time or --offset.")
+        return
+    request = rpc.EditPostRequest(
+        operation=rpc.EditPostRequest.RESCHEDULE, id=post_ids[0], ids=post_ids[1:]
+    )
+    if time is not None:
+        try:
+            request.scheduled_time = int(parser.parse(time, dayfirst=False).timestamp())
+        except ValueError:
+            print("Invalid time:", time)
+            return
+    else:
+        request.offset = offset * 60
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            reply = stub.EditPost(request)
+            if reply.error_msg:
+                print("Failed to reschedule. Server returned error:", reply.error_msg)
+                return
+            print("Rescheduled.")
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+
+
+@click.command()
+@click.argument("post_id", type=int)
+@click.option("--title")
+@click.option("--body", help="Body of a text post, or selftext of a poll")
+@click.option("--flair", help="Flair text, use `reddit flairs` to get values")
+@click.pass_obj
+def edit(config, post_id, title, body, flair):
+    """Change the title, body or flair of a post.
+    The post keeps its id and scheduled time.
+    """
+    request = rpc.EditPostRequest(operation=rpc.EditPostRequest.UPDATE, id=post_id)
+    if title is not None:
+        request.post.title = title
+        request.update_mask.paths.append("title")
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            if body is not None or flair is not None:
+                cache = sync_posts(stub, post_cache_path(config.port))
+                if cache is None:
+                    return
+                entry = next((e for e in cache.posts if e.id == post_id), None)
+                if entry is None:
+                    print(f"No post with id {post_id}.")
+                    return
+                if body is not None:
+                    if entry.post.data.HasField("text"):
+                        request.post.data.text.body = body
+                        request.update_mask.paths.append("data.text.body")
+                    elif entry.post.data.HasField("poll"):
+                        request.post.data.poll.selftext = body
+                        request.update_mask.paths.append("data.poll.selftext")
+                    else:
+                        print("Only text posts and polls have a body.")
+                        return
+                if flair is not None:
+                    f = find_flair(stub, entry.post.subreddit, flair)
+                    if f is None:
+                        return
+                    request.post.flair_id = f.id
+                    request.post.flair_text = f.text
+                    request.update_mask.paths.extend(["flair_id", "flair_text"])
+            if len(request.update_mask.paths) == 0:
+                print("Nothing to change, give --title, --body or --flair.")
+                return
+            reply = stub.EditPost(request)
+            if reply.error_msg:
+                print("Failed to edit post. Server returned error:", reply.error_msg)
+                return
+            print("Edited.")
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+
+
 @click.command()
 @click.option(
     "-t", "--type", required=True, type=click.Choice(["text", "poll", "image", "url"])
@@ -523,18 +1003,17 @@ def list_posts(config, filter, post_id):
     ID. Otherwise, lists all posts filtered with the -f option.
     """
     try:
-        with grpc.insecure_channel(f"[::]:{config.port}") as channel:
+        with config.channel() as channel:
             stub = reddit_grpc.RedditSchedulerStub(channel)
-            reply = stub.ListPosts(rpc.ListPostsRequest())
-            if reply.error_msg:
-                print("Failed to list posts. Server returned error:", reply.error_msg)
+            cache = sync_posts(stub, post_cache_path(config.port))
+            if cache is None:
                 return
             if post_id is None:
-                print_post_list(reply.posts, filter)
+                print_post_list(list(cache.posts), filter)
             else:
-                print_post_info(reply.posts, post_id)
-    except grpc.RpcError:
-        print(ERR_MISSING_SERVICE)
+                print_post_info(list(cache.posts), post_id)
+    except grpc.RpcError as e:
+        print_rpc_error(e)
 
 
 @click.command()
@@ -547,7 +1026,7 @@ def delete(config, post_id):
     """
     click.confirm("Are you sure?", abort=True)
     try:
-        with grpc.insecure_channel(f"[::]:{config.port}") as channel:
+        with config.channel() as channel:
             stub = reddit_grpc.RedditSchedulerStub(channel)
             reply = stub.EditPost(
                 rpc.EditPostRequest(operation=rpc.EditPostRequest.DELETE, id=post_id)
@@ -556,8 +1035,224 @@ def delete(config, post_id):
                 print("Failed to delete post. Server returned error:", reply.error_msg)
                 return
             print("Deleted.")
-    except grpc.RpcError:
-        print(ERR_MISSING_SERVICE)
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+
+
+@click.command()
+@click.pass_obj
+def watch(config):
+    """Follow posts as they are scheduled, posted, errored or deleted.
+    Runs until interrupted with Ctrl-C.
+    """
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            for entry in stub.WatchPosts(rpc.WatchPostsRequest()):
+                print(format_post_event(entry), flush=True)
+    except KeyboardInterrupt:
+        pass
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+
+
+@click.command(name="export")
+@click.option("-o", "--output", type=click.File("wb", lazy=False), default="-")
+@click.option("-f", "--format", type=click.Choice(["proto", "ndjson"]), default="proto")
+@click.option(
+    "--image-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Write images to this directory instead of inlining them.",
+)
+@click.pass_obj
+def export_posts(config, output, format, image_dir):
+    """Export all posts for backups or migrations.
+    Posts are streamed one at a time to OUTPUT (stdout by default) either as
+    length-delimited protobuf or as newline delimited JSON. Restore them with
+    `reddit import`.
+    """
+    root = Path(output.name).parent if os.path.exists(output.name) else Path.cwd()
+    if image_dir is not None:
+        os.makedirs(image_dir, exist_ok=True)
+    count = 0
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            for entry in stub.ExportPosts(rpc.ExportPostsRequest()):
+                if image_dir is not None:
+                    externalize_image(entry, image_dir, root)
+                write_entry(output, entry, format)
+                count += 1
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+        return
+    click.echo(f"Exported {count} posts.", err=True)
+
+
+@click.command(name="import")
+@click.argument("input", type=click.File("rb"))
+@click.option("-f", "--format", type=click.Choice(["proto", "ndjson"]), default="proto")
+@click.pass_obj
+def import_posts(config, input, format):
+    """Import posts from a file created by `reddit export`.
+    Posts keep their status but are given new ids.
+    """
+    root = Path(input.name).parent
+    failed = []
+    read_error = None
+
+    # Runs on a gRPC thread, so errors are handed back instead of raised
+    def entries():
+        nonlocal read_error
+        try:
+            for entry in read_entries(input, format):
+                if inline_image(entry, root):
+                    yield entry
+                else:
+                    failed.append(entry.id)
+        except (DecodeError, json_format.ParseError, EOFError) as e:
+            read_error = e
+
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            # Imports are large by nature, so they're compressed regardless of size
+            reply = stub.ImportPosts(entries(), compression=config.compression)
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+        return
+    if read_error is not None:
+        print("Failed to read the rest of the export file:", read_error)
+    print(f"Imported {reply.imported} posts.")
+    if reply.skipped:
+        print(f"Skipped {reply.skipped} invalid posts.")
+    if failed:
+        print("Skipped posts with missing images:", ", ".join(map(str, failed)))
+    if reply.error_msg:
+        print("Import stopped early. Server returned error:", reply.error_msg)
+
+
+@click.command()
+@click.pass_obj
+def health(config):
+    """Check whether the service is stuck posting."""
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            reply: rpc.GetHealthReply = stub.GetHealth(rpc.GetHealthRequest())
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+        return
+    if reply.poster_stalled:
+        print(f"{fg('red')}Posting is stalled.{attr('reset')}")
+    else:
+        print("Healthy.")
+    if len(reply.hung_post_ids) != 0:
+        ids = ", ".join(map(str, reply.hung_post_ids))
+        print("Submissions still running after timing out:", ids)
+
+
+@click.command()
+@click.pass_obj
+def stats(config):
+    """Show how posted posts are doing on reddit."""
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            reply: rpc.GetStatsReply = stub.GetStats(rpc.GetStatsRequest())
+            if reply.error_msg:
+                print("Server returned error:", reply.error_msg)
+                return
+            cache = sync_posts(stub, post_cache_path(config.port))
+            if cache is None:
+                return
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+        return
+    posts = {entry.id: entry.post for entry in cache.posts}
+    rows = []
+    for id, s in sorted(reply.stats.items(), key=lambda item: -item[1].score):
+        post = posts.get(id)
+        if post is None:
+            continue
+        rows.append(
+            [
+                id,
+                post.subreddit,
+                post.title,
+                s.score,
+                s.num_comments,
+                f"{s.upvote_ratio:.0%}",
+            ]
+        )
+    headers = ["Id", "Subreddit", "Title", "Score", "Comments", "Upvoted"]
+    print(tabulate(rows, headers=headers))
+
+
+@click.group()
+def debug():
+    """Look into what the service is doing."""
+
+
+@debug.command()
+@click.option("--poster", is_flag=True, help="Profile poster steps instead of RPCs.")
+@click.option("-n", "--count", type=int, default=10, help="RPCs or steps to profile.")
+@click.option("--timeout", type=int, default=60, help="Seconds to wait for them.")
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False),
+    default="reddit-scheduler.pstats",
+    help="Where to write the cProfile stats.",
+)
+@click.option("--top", type=int, default=20, help="Rows to print per table.")
+@click.pass_obj
+def profile(config, poster: bool, count: int, timeout: int, output: str, top: int):
+    """Profile the service while it handles the next RPCs or poster steps.
+
+    Writes the cProfile stats to OUTPUT, which pstats and tools like snakeviz
+    can open, and prints the slowest functions, the largest allocation sites
+    and the SQL statements that took the longest.
+    """
+    target = rpc.ProfileRequest.POSTER_STEP if poster else rpc.ProfileRequest.RPC
+    what = "poster steps" if poster else "RPCs"
+    print(f"Profiling the next {count} {what} for up to {timeout} seconds...")
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            reply: rpc.ProfileReply = stub.Profile(
+                rpc.ProfileRequest(
+                    target=target, count=count, timeout=timeout, top_allocations=top
+                ),
+                timeout=timeout + PROFILE_SLACK,
+            )
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+        return
+    if reply.error_msg:
+        print("Server returned error:", reply.error_msg)
+        return
+    print(f"Profiled {reply.samples} {what}.")
+    if reply.samples == 0:
+        return
+
+    with open(output, "wb") as f:
+        f.write(reply.pstats)
+    print("Wrote cProfile stats to", output)
+    pstats.Stats(output).sort_stats("cumulative").print_stats(top)
+
+    rows = [[a.location, f"{a.size / 1024:.1f}", a.count] for a in reply.allocations]
+    print(tabulate(rows, headers=["Allocated at", "KB", "Blocks"]), end="\n\n")
+    rows = [
+        [
+            s.sql if len(s.sql) <= 80 else s.sql[:77] + "...",
+            s.count,
+            f"{s.total_time * 1000:.2f}",
+            f"{s.total_time / s.count * 1000:.3f}",
+        ]
+        for s in reply.statements[:top]
+    ]
+    print(tabulate(rows, headers=["Statement", "Count", "Total ms", "Avg ms"]))
 
 
 def get_default_config_path():
@@ -577,7 +1272,7 @@ def flairs(config, subreddit: str):
     """
     try:
         subreddit = subreddit.lstrip("r/")
-        with grpc.insecure_channel(f"[::]:{config.port}") as channel:
+        with config.channel() as channel:
             stub = reddit_grpc.RedditSchedulerStub(channel)
             reply: rpc.ListFlairsResponse = stub.ListFlairs(
                 rpc.ListFlairsRequest(subreddit=subreddit)
@@ -588,8 +1283,44 @@ def flairs(config, subreddit: str):
                     print(flair.text)
             else:
                 print(f"Subreddit r/{subreddit} doesn't have any flairs")
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+
+
+@click.command()
+@click.pass_obj
+def sync(config):
+    """Schedule posts saved while the service wasn't reachable.
+
+    Only new posts from `reddit post` are saved. Other commands, like edit and
+    reschedule, need the service to be running.
+    """
+    try:
+        with config.channel() as channel:
+            stub = reddit_grpc.RedditSchedulerStub(channel)
+            if not spool_path(config.port).exists():
+                print("No saved posts.")
+                return
+            count = flush_spool(stub, spool_path(config.port), config.compression)
+            print(f"Scheduled {count} saved posts.")
+    except grpc.RpcError as e:
+        print_rpc_error(e)
+
+
+def try_flush_spool(config: Config):
+    """Schedules spooled posts if there are any and the service is reachable."""
+    path = spool_path(config.port)
+    if not path.exists():
+        return
+    try:
+        with config.channel() as channel:
+            count = flush_spool(
+                reddit_grpc.RedditSchedulerStub(channel), path, config.compression
+            )
+            if count > 0:
+                print(f"Scheduled {count} posts saved while the service was down.")
     except grpc.RpcError:
-        print(ERR_MISSING_SERVICE)
+        pass
 
 
 @click.group()
@@ -598,20 +1329,28 @@ def flairs(config, subreddit: str):
 @click.pass_context
 def main(ctx, config, port):
     """CLI for reddit scheduler service."""
-    if port is None:
-        if config is None:
-            print(ERR_MISSING_CONFIG)
-            ctx.abort()
-        parser = configparser.ConfigParser()
+    if port is None and config is None:
+        print(ERR_MISSING_CONFIG)
+        ctx.abort()
+    parser = configparser.ConfigParser()
+    if config is not None:
         parser.read(config)
+    # Without a General section, every setting falls back to its default
+    general = parser["General" if parser.has_section("General") else "DEFAULT"]
+    if port is None:
         try:
-            port = parser["General"]["Port"]
+            port = general["Port"]
         except KeyError:
             print("Could not find Port setting in", config)
             print("Please add it or use the --port flag")
             ctx.abort()
-    ctx.obj = Config(port=port)
-    pass
+    try:
+        ctx.obj = Config.from_general(port, general)
+    except ValueError as e:
+        print(f"Invalid setting in {config}: {e}")
+        ctx.abort()
+    if ctx.invoked_subcommand != "sync":
+        try_flush_spool(ctx.obj)
 
 
 if __name__ == "__main__":
@@ -619,5 +1358,14 @@ if __name__ == "__main__":
     main.add_command(file)
     main.add_command(list_posts)
     main.add_command(delete)
+    main.add_command(reschedule)
+    main.add_command(edit)
     main.add_command(flairs)
+    main.add_command(watch)
+    main.add_command(health)
+    main.add_command(sync)
+    main.add_command(stats)
+    main.add_command(export_posts)
+    main.add_command(import_posts)
+    main.add_command(debug)
     main()
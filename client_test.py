@@ -1,17 +1,40 @@
+import tempfile
+from datetime import datetime
 import unittest
-import yaml
+from unittest import mock
 import grpc
 
 from client import *
 from grpc.framework.foundation import logging_pool
 from click.testing import CliRunner
+from io import BytesIO
 import reddit_pb2 as proto
 import reddit_pb2_grpc
 
 PORT = 5071
 
 
+IMAGE_ENTRY = proto.PostDbEntry(
+    id=7,
+    post=proto.Post(
+        title="Image",
+        subreddit="test",
+        scheduled_time=1000,
+        data=proto.Data(
+            image=proto.ImagePost(image_data=b"not really a png", extension="png")
+        ),
+    ),
+    status=proto.PostStatus.PENDING,
+)
+
+
 class MockGoodServicer(reddit_pb2_grpc.RedditSchedulerServicer):
+    def __init__(self):
+        self.imported = []
+        self.edits = []
+        self.scheduled = []
+        self.resolves = 0
+
     def ListPosts(self, request, _):
         del request
         return proto.ListPostsReply()
@@ -25,14 +48,49 @@ class MockGoodServicer(reddit_pb2_grpc.RedditSchedulerServicer):
             ]
         return proto.ListFlairsResponse(flairs=flairs)
 
+    def ResolveFlairs(self, request: proto.ResolveFlairsRequest, _):
+        self.resolves += 1
+        ids = {"flair1": "1", "flair2": "2"}
+        flairs, errors = [], []
+        for sub, text in zip(request.subreddits, request.flair_texts):
+            found = sub in ("test", "test2") and text in ids
+            flairs.append(
+                proto.Flair(text=text, id=ids[text]) if found else proto.Flair()
+            )
+            errors.append(
+                "" if found else f"r/{sub} doesn't have a flair called {text}"
+            )
+        return proto.ResolveFlairsReply(flairs=flairs, error_msgs=errors)
+
     def SchedulePost(self, request, _):
         del request
         return proto.SchedulePostReply(error_msg="fail")
 
+    def SchedulePosts(self, request, _):
+        self.scheduled.extend(request.posts)
+        errors = ["" if p.subreddit == "test" else "rejected" for p in request.posts]
+        return proto.SchedulePostsReply(error_msgs=errors)
+
     def EditPost(self, request, _):
-        del request
+        self.edits.append(request)
         return proto.EditPostReply()
 
+    def WatchPosts(self, request, _):
+        del request
+        yield proto.PostDbEntry(
+            id=1,
+            post=proto.Post(title="Hello", subreddit="test"),
+            status=proto.PostStatus.POSTED,
+        )
+
+    def ExportPosts(self, request, _):
+        del request
+        yield IMAGE_ENTRY
+
+    def ImportPosts(self, request_iterator, _):
+        self.imported = list(request_iterator)
+        return proto.ImportPostsReply(imported=len(self.imported))
+
 
 class ClientTest(unittest.TestCase):
     def setUp(self) -> None:
@@ -40,8 +98,9 @@ class ClientTest(unittest.TestCase):
         self.server = grpc.server(self.pool)
         addr = f"[::]:{PORT}"
         self.server.add_insecure_port(addr)
+        self.servicer = MockGoodServicer()
         reddit_pb2_grpc.add_RedditSchedulerServicer_to_server(
-            MockGoodServicer(), self.server
+            self.servicer, self.server
         )
         self.server.start()
 
@@ -49,36 +108,53 @@ class ClientTest(unittest.TestCase):
         self.server.stop(None)
         self.pool.shutdown(wait=True)
 
-    def test_make_post_from_poll_yaml(self):
-        # TODO add error cases once we switch to logging instead of print
-        f = open("examples/poll-post.yaml", "r")
-        file = yaml.safe_load(f)
-        f.close()
-        ret = make_post_from_poll_yaml(file)
-        self.assertIsNotNone(ret)
-        if ret is not None:
-            self.assertEqual(ret.selftext, "")
-            self.assertEqual(ret.duration, 7)
-            self.assertEqual(ret.options, ["Yes", "No"])
-
-    def test_make_post_from_image_yaml(self):
-        f = open("testdata/image-post.yaml", "r")
-        file = yaml.safe_load(f)
-        f.close()
-        ret = make_post_from_image_yaml(file, Path("testdata"))
-        self.assertIsNotNone(ret)
-        if ret is not None:
-            self.assertEqual(ret.extension, "png")
-            self.assertEqual(ret.nsfw, True)
-
-    def test_make_post_from_url_yaml(self):
-        f = open("testdata/url-post.yaml", "r")
-        file = yaml.safe_load(f)
-        f.close()
-        ret = make_post_from_url_yaml(file)
-        self.assertIsNotNone(ret)
-        if ret is not None:
-            self.assertEqual(ret.url, "google.com")
+    def test_config_from_general(self):
+        parser = configparser.ConfigParser()
+        parser.read_string("[General]\nCompression = deflate\nMaxMessageSize = 2\n")
+        config = Config.from_general(PORT, parser["General"])
+        self.assertEqual(config.max_message_size, 2 * 1024 * 1024)
+        self.assertIsNone(config.call_compression(proto.Post(title="small")))
+        big = proto.Post(data=proto.Data(text=proto.TextPost(body="a" * 100000)))
+        self.assertEqual(config.call_compression(big), grpc.Compression.Deflate)
+
+        parser["General"]["Compression"] = "brotli"
+        self.assertRaises(ValueError, Config.from_general, PORT, parser["General"])
+
+    def test_make_post_from_file_crosspost(self):
+        with grpc.insecure_channel(f"[::]:{PORT}") as channel:
+            stub = reddit_pb2_grpc.RedditSchedulerStub(channel)
+            with open("testdata/crosspost-post.yaml", "r") as f:
+                post = make_post_from_file(stub, f)
+        self.assertIsNotNone(post)
+        if post is not None:
+            self.assertEqual(post.flair_id, "1")
+            self.assertEqual(
+                [(t.subreddit, t.flair_id, t.delay) for t in post.targets],
+                [("test2", "2", 1800), ("other", "", 0)],
+            )
+            self.assertEqual(
+                [(f.action, f.delay, f.text) for f in post.follow_ups],
+                [
+                    (proto.FollowUp.Action.COMMENT, 0, "Source in the comments"),
+                    (proto.FollowUp.Action.DELETE, 86400, ""),
+                ],
+            )
+            self.assertEqual(post.auto_schedule.spacing, 1800)
+            self.assertEqual(post.auto_schedule.until - post.scheduled_time, 86400)
+
+    def test_post_files(self):
+        runner = CliRunner()
+        main.add_command(post)
+
+        files = ["testdata/crosspost-post.yaml", "testdata/crosspost-post.yaml"]
+        result = runner.invoke(
+            main, ["--port", str(PORT), "post", "-f", files[0], "-f", files[1]]
+        )
+        self.assertEqual(result.exit_code, 0)
+        # Both files' flairs come back from one call
+        self.assertEqual(self.servicer.resolves, 1)
+        self.assertEqual([p.flair_id for p in self.servicer.scheduled], ["1", "1"])
+        self.assertIn("Scheduled 2 posts.", result.stdout)
 
     def test_post_flair(self):
         runner = CliRunner()
@@ -93,6 +169,140 @@ class ClientTest(unittest.TestCase):
             print(result.stdout)
         assert result.exit_code == 0
 
+    def test_reschedule_offset(self):
+        runner = CliRunner()
+        main.add_command(reschedule)
+
+        result = runner.invoke(
+            main, ["--port", str(PORT), "reschedule", "3", "4", "5", "-o", "-90"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Rescheduled.", result.stdout)
+        self.assertEqual(len(self.servicer.edits), 1)
+        request = self.servicer.edits[0]
+        self.assertEqual(request.operation, proto.EditPostRequest.RESCHEDULE)
+        self.assertEqual([request.id] + list(request.ids), [3, 4, 5])
+        self.assertEqual(request.offset, -90 * 60)
+
+    def test_reschedule_time_is_month_first(self):
+        runner = CliRunner()
+        main.add_command(reschedule)
+
+        result = runner.invoke(
+            main, ["--port", str(PORT), "reschedule", "3", "-t", "3/4/2100 18:01"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        scheduled = datetime.fromtimestamp(self.servicer.edits[0].scheduled_time)
+        self.assertEqual((scheduled.month, scheduled.day), (3, 4))
+
+    def test_spool(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / "spool.bin"
+            first = proto.Post(title="first", subreddit="test")
+            second = proto.Post(title="second", subreddit="other")
+            self.assertTrue(spool_post(path, first))
+            self.assertTrue(spool_post(path, second))
+            self.assertFalse(spool_post(path, first))
+            # A post cut short by a crash is ignored
+            with open(path, "ab") as f:
+                f.write(encode_varint(100) + b"partial")
+            spooled = read_spool(path)
+            self.assertEqual([p.title for p in spooled], ["first", "second"])
+            # Each post gets its own key, so resending it is harmless
+            keys = [p.idempotency_key for p in spooled]
+            self.assertNotIn("", keys)
+            self.assertNotEqual(keys[0], keys[1])
+
+            with grpc.insecure_channel(f"[::]:{PORT}") as channel:
+                stub = reddit_pb2_grpc.RedditSchedulerStub(channel)
+                self.assertEqual(flush_spool(stub, path), 1)
+            self.assertEqual(list(self.servicer.scheduled), spooled)
+            self.assertFalse(path.exists())
+
+    def test_post_spooled_when_offline(self):
+        runner = CliRunner()
+        main.add_command(post)
+        with tempfile.TemporaryDirectory() as d:
+            file = Path(d) / "post.yaml"
+            file.write_text(
+                "type: url\ntitle: Offline\nsubreddit: test\nurl: google.com\n"
+                "scheduled_time: '3/20 18:01 2100'\n"
+            )
+            with mock.patch("client.SPOOL_DIR", Path(d)):
+                result = runner.invoke(
+                    main, ["--port", str(PORT + 1), "post", "-f", str(file)]
+                )
+                self.assertEqual(result.exit_code, 0)
+                self.assertIn("saved the post", result.stdout)
+                posts = read_spool(spool_path(PORT + 1))
+            self.assertEqual([p.title for p in posts], ["Offline"])
+
+    def test_watch(self):
+        runner = CliRunner()
+        main.add_command(watch)
+
+        result = runner.invoke(main, ["--port", str(PORT), "watch"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('1: r/test "Hello" -> Posted', result.stdout)
+
+    def test_apply_sync(self):
+        cache = proto.SyncPostsReply(
+            posts=[
+                proto.PostDbEntry(id=1, status=proto.PostStatus.PENDING),
+                proto.PostDbEntry(id=2, status=proto.PostStatus.PENDING),
+            ],
+            seq=2,
+        )
+        self.assertFalse(apply_sync(cache, proto.SyncPostsReply(seq=2)))
+
+        delta = proto.SyncPostsReply(
+            posts=[
+                proto.PostDbEntry(id=1, status=proto.PostStatus.POSTED),
+                proto.PostDbEntry(id=3, status=proto.PostStatus.PENDING),
+            ],
+            deleted_ids=[2],
+            seq=5,
+        )
+        self.assertTrue(apply_sync(cache, delta))
+        self.assertEqual(cache.seq, 5)
+        statuses = {e.id: e.status for e in cache.posts}
+        self.assertEqual(
+            statuses, {1: proto.PostStatus.POSTED, 3: proto.PostStatus.PENDING}
+        )
+
+    def test_read_write_entries(self):
+        for format in ["proto", "ndjson"]:
+            stream = BytesIO()
+            write_entry(stream, IMAGE_ENTRY, format)
+            write_entry(stream, proto.PostDbEntry(id=300), format)
+            stream.seek(0)
+            entries = list(read_entries(stream, format))
+            self.assertEqual(entries, [IMAGE_ENTRY, proto.PostDbEntry(id=300)])
+
+    def test_export_import_image_dir(self):
+        runner = CliRunner()
+        main.add_command(export_posts)
+        main.add_command(import_posts)
+
+        with tempfile.TemporaryDirectory() as dir:
+            out = os.path.join(dir, "posts.ndjson")
+            images = os.path.join(dir, "images")
+            result = runner.invoke(
+                main,
+                ["--port", str(PORT), "export", "-o", out, "-f", "ndjson"]
+                + ["--image-dir", images],
+            )
+            self.assertEqual(result.exit_code, 0)
+            with open(out) as f:
+                self.assertIn('"imageRef": "images/7.png"', f.read())
+
+            result = runner.invoke(
+                main, ["--port", str(PORT), "import", out, "-f", "ndjson"]
+            )
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Imported 1 posts.", result.stdout)
+            self.assertEqual(self.servicer.imported, [IMAGE_ENTRY])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -2,22 +2,36 @@ from configparser import ConfigParser
 import sqlite3
 import os
 import sys
-import reddit_pb2 as rpc
 import praw
+from server import (
+    create_tables,
+    load_dictionaries,
+    make_post_from_row,
+    train_dictionary,
+    zstandard,
+)
+
+DB_PATH = os.path.expandvars("$HOME/.config/reddit-scheduler/database.sqlite")
 
 
 def dump():
-    path = os.path.expandvars("$HOME/.config/reddit-scheduler/database.sqlite")
-    conn = sqlite3.connect(path)
+    conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
-    for row in conn.execute("SELECT * FROM Queue"):
-        post = rpc.Post(
-            title=row["title"],
-            subreddit=row["subreddit"],
-            scheduled_time=row["scheduled_time"],
-        )
-        post.data.ParseFromString(row["data"])
-        print(post)
+    create_tables(conn)
+    load_dictionaries(conn)
+    for row in conn.execute("SELECT * FROM Posts"):
+        print(row["id"], make_post_from_row(row))
+
+
+def train():
+    if zstandard is None:
+        sys.exit("zstandard isn't installed, run `pip install zstandard` first")
+    conn = sqlite3.connect(DB_PATH)
+    create_tables(conn)
+    load_dictionaries(conn)
+    print("Trained dictionary", train_dictionary(conn))
+    print("Restart the service to compress new posts with it")
+
 
 def reddit_instance():
     parser = ConfigParser()
@@ -33,7 +47,7 @@ def reddit_instance():
     )
 
 
-FUNC_MAP = {"dump": dump}
+FUNC_MAP = {"dump": dump, "train": train}
 
 if __name__ == "__main__":
     FUNC_MAP[sys.argv[1]]()
@@ -0,0 +1,155 @@
+"""Reads the YAML post files that `reddit post -f` and the drop directory take.
+
+The client and the service both import this, so a file is read the same way
+whichever one it goes through. Problems with a file raise ValueError saying
+what is wrong with it.
+"""
+
+from pathlib import Path
+from typing import Callable, List, TextIO, Tuple
+
+import yaml
+from dateutil import parser as date_parser
+
+import reddit_pb2 as rpc
+
+REQUIRED_KEYS = ["title", "subreddit", "type", "scheduled_time"]
+
+# Looks up the flair with some text in a subreddit, raising ValueError if it
+# has none
+FindFlair = Callable[[str, str], rpc.Flair]
+
+
+def require(obj, keys: List[str]):
+    if not isinstance(obj, dict):
+        raise ValueError(f"expected a mapping, got: {obj}")
+    missing = [k for k in keys if k not in obj]
+    if missing:
+        raise ValueError(f"missing keys: {', '.join(missing)}")
+
+
+def parse_time(value, what: str) -> int:
+    """Parses a time the way post files write them, day first if ambiguous."""
+    try:
+        return int(date_parser.parse(str(value), dayfirst=True).timestamp())
+    except (ValueError, OverflowError):
+        raise ValueError(f"invalid {what}: {value}")
+
+
+def parse_minutes(value, what: str) -> int:
+    """Seconds in a number of minutes."""
+    try:
+        return int(value) * 60
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {what}: {value}")
+
+
+def read_post_file(stream: TextIO) -> dict:
+    """The parsed YAML of a post file, with the keys every post file has."""
+    try:
+        parsed = yaml.load(stream, Loader=yaml.SafeLoader)
+    except yaml.YAMLError as e:
+        raise ValueError(f"invalid YAML: {e}")
+    require(parsed, REQUIRED_KEYS)
+    for target in parsed.get("crosspost") or []:
+        require(target, ["subreddit"])
+    return parsed
+
+
+def post_file_flairs(parsed: dict) -> List[Tuple[str, str]]:
+    """The (subreddit, flair text) pairs a parsed post file refers to."""
+    flairs = []
+    if "flair" in parsed:
+        flairs.append((str(parsed["subreddit"]), str(parsed["flair"])))
+    for target in parsed.get("crosspost") or []:
+        if "flair" in target:
+            flairs.append((str(target["subreddit"]), str(target["flair"])))
+    return flairs
+
+
+def read_data(parsed: dict, root: Path) -> rpc.Data:
+    """The data of the post's type. Image paths are relative to root."""
+    post_type = parsed["type"]
+    data = rpc.Data()
+    if post_type == "text":
+        require(parsed, ["body"])
+        data.text.body = parsed["body"] or ""
+    elif post_type == "poll":
+        require(parsed, ["options"])
+        data.poll.options.extend(str(o) for o in parsed["options"])
+        data.poll.selftext = parsed.get("selftext") or ""
+        if "duration" in parsed:
+            try:
+                data.poll.duration = int(parsed["duration"])
+            except (TypeError, ValueError):
+                raise ValueError(f"invalid poll duration: {parsed['duration']}")
+    elif post_type == "image":
+        require(parsed, ["image_path"])
+        image_path = root / Path(parsed["image_path"])
+        try:
+            with open(image_path, "rb") as f:
+                data.image.image_data = f.read()
+        except OSError as e:
+            raise ValueError(f"couldn't read image {image_path}: {e.strerror}")
+        if len(data.image.image_data) == 0:
+            raise ValueError(f"image {image_path} is empty")
+        data.image.extension = image_path.suffix.lstrip(".")
+        data.image.nsfw = bool(parsed.get("nsfw", False))
+    elif post_type == "url":
+        require(parsed, ["url"])
+        data.url.url = str(parsed["url"])
+    else:
+        raise ValueError(f"unknown post type: {post_type}")
+    return data
+
+
+def read_follow_up(follow_up) -> rpc.FollowUp:
+    require(follow_up, ["action"])
+    action = str(follow_up["action"]).upper()
+    if action not in rpc.FollowUp.Action.keys() or action == "UNKNOWN":
+        raise ValueError(f"unknown follow-up action: {follow_up['action']}")
+    f = rpc.FollowUp(action=rpc.FollowUp.Action.Value(action))
+    if action == "COMMENT":
+        require(follow_up, ["text"])
+    f.text = str(follow_up.get("text") or "")
+    if "delay" in follow_up:
+        f.delay = parse_minutes(follow_up["delay"], "follow-up delay")
+    return f
+
+
+def make_post(parsed: dict, root: Path, find_flair: FindFlair) -> rpc.Post:
+    """Makes the post of a file read by read_post_file.
+
+    Image paths are relative to root, usually the directory of the file.
+    """
+    post = rpc.Post(
+        title=str(parsed["title"]),
+        subreddit=str(parsed["subreddit"]),
+        scheduled_time=parse_time(parsed["scheduled_time"], "scheduled time"),
+        data=read_data(parsed, root),
+    )
+    if "flair" in parsed:
+        flair = find_flair(post.subreddit, str(parsed["flair"]))
+        post.flair_id = flair.id
+        post.flair_text = flair.text
+    for target in parsed.get("crosspost") or []:
+        t = post.targets.add(subreddit=str(target["subreddit"]))
+        if "flair" in target:
+            flair = find_flair(t.subreddit, str(target["flair"]))
+            t.flair_id = flair.id
+            t.flair_text = flair.text
+        if "delay" in target:
+            t.delay = parse_minutes(target["delay"], "crosspost delay")
+    for follow_up in parsed.get("follow_up") or []:
+        post.follow_ups.append(read_follow_up(follow_up))
+    if "auto_schedule" in parsed:
+        auto = parsed["auto_schedule"] or {}
+        require(auto, [])
+        post.auto_schedule.SetInParent()
+        if "until" in auto:
+            post.auto_schedule.until = parse_time(auto["until"], "auto schedule end")
+        if "spacing" in auto:
+            post.auto_schedule.spacing = parse_minutes(
+                auto["spacing"], "auto schedule spacing"
+            )
+    return post
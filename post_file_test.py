@@ -0,0 +1,101 @@
+import io
+import unittest
+from pathlib import Path
+
+import reddit_pb2 as rpc
+
+from post_file import *
+
+FLAIRS = {
+    ("test", "flair1"): rpc.Flair(text="flair1", id="1"),
+    ("test2", "flair2"): rpc.Flair(text="flair2", id="2"),
+    ("test", "example flair"): rpc.Flair(text="example flair", id="3"),
+}
+
+
+def find_flair(subreddit: str, text: str) -> rpc.Flair:
+    if (subreddit, text) not in FLAIRS:
+        raise ValueError(f"r/{subreddit} doesn't have a flair called {text}")
+    return FLAIRS[(subreddit, text)]
+
+
+def read(path: str) -> rpc.Post:
+    with open(path, "r") as f:
+        parsed = read_post_file(f)
+    return make_post(parsed, Path(path).parent, find_flair)
+
+
+def read_string(content: str) -> rpc.Post:
+    return make_post(read_post_file(io.StringIO(content)), Path("."), find_flair)
+
+
+class PostFileTest(unittest.TestCase):
+    def test_poll(self):
+        post = read("examples/poll-post.yaml")
+        self.assertEqual(post.data.poll.selftext, "")
+        self.assertEqual(post.data.poll.duration, 7)
+        self.assertEqual(post.data.poll.options, ["Yes", "No"])
+
+    def test_image(self):
+        post = read_string(
+            "type: image\ntitle: Pic\nsubreddit: test\nnsfw: true\n"
+            "image_path: testdata/sample-image.png\nscheduled_time: '3/20 18:01'\n"
+        )
+        self.assertGreater(len(post.data.image.image_data), 0)
+        self.assertEqual(post.data.image.extension, "png")
+        self.assertTrue(post.data.image.nsfw)
+
+    def test_url(self):
+        post = read("testdata/url-post.yaml")
+        self.assertEqual(post.data.url.url, "google.com")
+
+    def test_crosspost(self):
+        post = read("testdata/crosspost-post.yaml")
+        self.assertEqual(post.flair_id, "1")
+        self.assertEqual(
+            [(t.subreddit, t.flair_id, t.delay) for t in post.targets],
+            [("test2", "2", 1800), ("other", "", 0)],
+        )
+        self.assertEqual(
+            [(f.action, f.delay, f.text) for f in post.follow_ups],
+            [
+                (rpc.FollowUp.Action.COMMENT, 0, "Source in the comments"),
+                (rpc.FollowUp.Action.DELETE, 86400, ""),
+            ],
+        )
+        self.assertEqual(post.auto_schedule.spacing, 1800)
+        self.assertEqual(post.auto_schedule.until - post.scheduled_time, 86400)
+        with open("testdata/crosspost-post.yaml", "r") as f:
+            flairs = post_file_flairs(read_post_file(f))
+        self.assertEqual(flairs, [("test", "flair1"), ("test2", "flair2")])
+
+    def test_errors(self):
+        base = "title: Hi\nsubreddit: test\nscheduled_time: '3/20 18:01 2100'\n"
+        cases = [
+            ("type: text\ntitle: Hi\n", "missing keys: subreddit"),
+            ("type: text\n: [", "invalid YAML"),
+            (base + "type: text\n", "missing keys: body"),
+            (base + "type: gif\n", "unknown post type: gif"),
+            (base + "type: url\nurl: a\nflair: nope\n", "called nope"),
+            (base + "type: image\nimage_path: nope.png\n", "couldn't read image"),
+            (base.replace("3/20", "3/40") + "type: url\nurl: a\n", "scheduled time"),
+            (base + "type: url\nurl: a\ncrosspost:\n  - flair: x\n", "subreddit"),
+            (
+                base + "type: url\nurl: a\nfollow_up:\n  - action: comment\n",
+                "missing keys: text",
+            ),
+            (
+                base + "type: url\nurl: a\nfollow_up:\n  - action: dance\n",
+                "unknown follow-up action",
+            ),
+            (base + "type: url\nurl: a\nauto_schedule: 5\n", "expected a mapping"),
+        ]
+        for content, error in cases:
+            with self.subTest(error=error):
+                with self.assertRaises(ValueError) as cm:
+                    read_string(content)
+                self.assertIn(error, str(cm.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,17 @@
-""" Defines the reddit-scheduler service.
+"""Defines the reddit-scheduler service.
 
-Consists of 3 classes running on separate threads:
+Consists of 8 classes running on separate threads:
 - Servicer: responds to client RPC calls
 - Poster: periodically scans the database for posts ready to be posted
 - Database: wrapper around the database
+- RequirementsFetcher: fetches subreddit posting rules for the Database
+- SubmissionReconciler: confirms image posts submitted without waiting on Reddit
+- StatsCollector: refreshes the score and comment count of posted posts
+- DropDirectoryIngester: schedules post files dropped into DropDirectory
+- TokenRefresher: renews the Reddit OAuth token shared by all of the above
+
+The Profile RPC profiles the Servicer's database operations or the Poster's
+steps on demand, see Profiler.
 
 The Servicer and the Poster both enqueue commands in the Database.
 
@@ -13,32 +21,128 @@ LOG_STDOUT:     Enables logging to stdout
 CONFIG_PATH:    Set path of config file. Otherwise searches as defined in the global
                 var CONFIG_SEARCH_PATHS
 DB_PATH:        Sets the path to the database to use. Creates new database if none is found there
+TOKEN_PATH:     Sets where the Reddit OAuth token is kept between restarts. Defaults to
+                token.json in $STATE_DIRECTORY or ~/.local/state/reddit-scheduler
+
+When started through reddit-scheduler.socket, the service serves RPCs on the
+socket handed over by systemd and, if IdleTimeout is set in the config, exits
+while idle. A transient systemd timer brings it back for the next post.
 """
+
+from abc import ABC, abstractmethod
 from concurrent import futures
 from configparser import ConfigParser
 import logging
+import math
 from praw.exceptions import RedditAPIException
 import os
 from queue import Queue
 import queue
 import uuid
+import socket
 import sqlite3
+import subprocess
 import sys
 from pathlib import Path
+import hashlib
+import bisect
+import itertools
 import threading
 import time
-import time
-from typing import Any, Callable, Optional, List, cast
+import cProfile
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
+import json
+import marshal
+import pstats
+import re
+import reprlib
+import tracemalloc
+import select
+import shutil
+import signal
+import struct
+import zlib
+from typing import Any, Callable, Dict, Optional, List, Set, Sized, Tuple, cast
+from urllib.parse import urlparse
 
 import grpc
 import praw
+from google.protobuf.message import Message
 from systemd import journal, daemon
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import post_file
 import reddit_pb2 as rpc
 import reddit_pb2_grpc as reddit_grpc
 
 LOG_LEVEL = logging.DEBUG if os.environ.get("DEBUG") else logging.INFO
 LOCK_TIMEOUT = 10  # seconds
+DB_QUEUE_SIZE = 100
+MIN_RETRY_AFTER = 0.1  # seconds
+EXPORT_PAGE_SIZE = 100  # posts read from the database at a time when exporting
+IMPORT_BATCH_SIZE = 500  # posts inserted per transaction when importing
+SUBMIT_TIMEOUT = 120  # seconds a submission may take before it's abandoned
+MAX_SUBMISSIONS = 4  # submissions that can run at once, including abandoned ones
+MAX_FOLLOW_UPS = 4  # follow-up jobs that can run at once
+# Poster is stalled if it makes no progress within a step for this long
+STALL_TIMEOUT = SUBMIT_TIMEOUT + 2 * LOCK_TIMEOUT
+STAGE_LEAD_TIME = 300  # seconds before scheduled_time that posts are staged
+MAX_STAGING = 2  # media uploads that can run at once while staging
+AUTH_MARGIN = 60  # seconds an OAuth token must outlive a post's scheduled_time
+TOKEN_REFRESH_MARGIN = 10 * 60  # seconds before expiry the OAuth token is renewed
+TOKEN_RETRY = 60  # seconds before retrying a failed OAuth token renewal
+STATS_INTERVAL = 60  # seconds between checks for stale post stats
+STATS_MIN_INTERVAL = 5 * 60  # seconds, how often the newest posts are refreshed
+STATS_MAX_INTERVAL = 24 * 60 * 60  # seconds, how often the oldest posts are refreshed
+STATS_MAX_AGE = 30 * 24 * 60 * 60  # seconds after which stats stop being refreshed
+STATS_BATCH_SIZE = 100  # fullnames per info request, the most Reddit accepts
+STATS_MAX_BATCHES = 10  # info requests per check
+STATS_QUERY_SIZE = 500  # post ids per stats query, below SQLite's 999 variables
+RECONCILE_INTERVAL = 30  # seconds between checks for submitted image posts
+RECONCILE_TIMEOUT = 15 * 60  # seconds before a submission is considered lost
+RECONCILE_LISTING_SIZE = 100  # recent submissions fetched to match against
+CLOCK_SLACK = 60  # seconds of clock difference tolerated with Reddit
+POST_SPACING = 10 * 60  # seconds between posts to a subreddit, like Reddit's limit
+IDLE_CHECK_INTERVAL = 10  # seconds
+FLAIR_TTL = 60 * 60  # seconds flairs of a subreddit are cached for
+FLAIR_WORKERS = 8  # subreddits whose flairs are fetched at once
+INGEST_WORKERS = 4  # threads parsing dropped post files
+INGEST_SETTLE = 0.5  # seconds to wait for more files before inserting a batch
+INGEST_RETRY = 30  # seconds before retrying files the database couldn't take
+PROXY_BUFFER_SIZE = 64 * 1024  # bytes
+SERVICE_UNIT = "reddit-scheduler.service"
+WAKEUP_UNIT = "reddit-scheduler-wakeup"
+IDEMPOTENCY_KEY_TTL = 30 * 24 * 60 * 60  # seconds a post's idempotency key is kept
+REQUIREMENTS_TTL = 24 * 60 * 60  # seconds before subreddit rules are refetched
+REQUIREMENTS_RETRY = 10 * 60  # seconds before a failed fetch is retried
+WATCH_BUFFER = 100  # events a watcher can fall behind before being dropped
+WATCH_POLL_INTERVAL = 1  # seconds between checks for a cancelled watch
+RPC_WORKERS = 10  # threads handling RPCs, watches hold one for their whole duration
+MAX_MESSAGE_SIZE = 32  # MB, large enough for any image Reddit accepts
+KEEPALIVE_TIMEOUT = 20  # seconds to wait for a keepalive ping to be acknowledged
+COMPRESSION_THRESHOLD = 64  # KB, smaller replies are not worth compressing
+PROFILE_COUNT = 10  # RPCs or Poster steps profiled when the client doesn't say
+PROFILE_TIMEOUT = 60  # seconds a profile waits for its RPCs or steps by default
+PROFILE_TOP_ALLOCATIONS = 10
+REPR_LIMIT = 200  # characters of a command's payload shown in logs
+BLOB_COMPRESSION_MIN = 64  # bytes, smaller posts are stored as they are
+BLOB_PROBE_SIZE = 16 * 1024  # bytes tried first to skip compressing images
+BLOB_ZSTD_LEVEL = 3
+BLOB_ZLIB_LEVEL = 6
+BLOB_DICTIONARY_SIZE = 16 * 1024  # bytes
+BLOB_DICTIONARY_SAMPLES = 10000  # newest posts a dictionary is trained on
+BLOB_ALGORITHMS = ["none", "zlib", "zstd"]
+COMPRESSION_ALGORITHMS = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
 
 # Logging setup
 log = logging.getLogger()
@@ -53,6 +157,139 @@ def set_debug_level(level):
     log.setLevel(level)
 
 
+class BoundedRepr(reprlib.Repr):
+    """reprlib.Repr that also keeps protobuf messages and bytes short.
+
+    Bytes, like the data of images, are shown by their length and repeated
+    fields by their count, so the cost doesn't grow with the payload. The
+    result is cut to REPR_LIMIT characters.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.maxstring = self.maxother = REPR_LIMIT
+        self.maxlevel = 3
+        self.maxlist = self.maxtuple = self.maxdict = 3
+
+    def repr(self, obj: Any) -> str:
+        text = super().repr(obj)
+        if len(text) > REPR_LIMIT:
+            text = text[: REPR_LIMIT - 3] + "..."
+        return text
+
+    def repr_bytes(self, obj: bytes, level: int) -> str:
+        return f"<{len(obj)} bytes>"
+
+    def repr_instance(self, obj: Any, level: int) -> str:
+        if isinstance(obj, Message):
+            return self.repr_message(obj, level)
+        if isinstance(obj, Sized):
+            # Containers reprlib doesn't know, like repeated protobuf fields
+            return f"<{type(obj).__name__} of {len(obj)}>"
+        return super().repr_instance(obj, level)
+
+    def repr_message(self, msg: Message, level: int) -> str:
+        name = type(msg).__name__
+        if level <= 0:
+            return f"{name}(...)"
+        fields = []
+        for field, value in msg.ListFields():
+            if isinstance(value, Sized) and not isinstance(value, (str, bytes)):
+                # Repeated or map field
+                text = f"<{len(value)} items>"
+            elif isinstance(value, Message):
+                text = self.repr_message(value, level - 1)
+            else:
+                text = self.repr1(value, level - 1)
+            fields.append(f"{field.name}={text}")
+        return f"{name}({', '.join(fields)})"
+
+
+bounded = BoundedRepr()
+
+
+class Bounded:
+    """Log argument that is formatted with `bounded`, and only if it's logged."""
+
+    __slots__ = ["obj"]
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return bounded.repr(self.obj)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def post_trace_id(post_id: int) -> str:
+    """Trace id shared by everything the Poster does for a post."""
+    return f"post-{post_id}"
+
+
+class Tracer:
+    """Writes timed spans of work to a JSONL file, one span per line.
+
+    Spans of the same RPC or post share a trace id, so its work can be followed
+    across the Servicer, Database and Poster threads. Does nothing until a file
+    is set, which callers check with `enabled` before doing any tracing work.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def set_path(self, path: str):
+        """Starts appending spans to path, or stops tracing if it's empty."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if not path:
+                return
+            try:
+                self.file = open(path, "a", buffering=1)
+            except OSError as e:
+                log.error("Not tracing, failed to open trace file: %s", e)
+
+    def record(
+        self, trace_id: Optional[str], name: str, start: float, end: float, **attrs
+    ):
+        """Records a span that ran from start to end, in time.time() seconds."""
+        span = {
+            "trace": trace_id,
+            "span": name,
+            "start": round(start, 6),
+            "duration": round(end - start, 6),
+            "thread": threading.current_thread().name,
+            **attrs,
+        }
+        line = json.dumps(span, default=str) + "\n"
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line)
+
+    @contextmanager
+    def span(self, trace_id: Optional[str], name: str, **attrs):
+        if self.file is None:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(trace_id, name, start, time.time(), **attrs)
+
+
+tracer = Tracer()
+
+
 CONFIG_SEARCH_PATHS = [
     os.environ.get("CONFIG_PATH"),
     os.path.expandvars("$HOME/.config/reddit-scheduler/config.ini"),
@@ -65,6 +302,28 @@ ERR_INTERNAL = (
     "internal error. See service logs via `systemctl --user status reddit-scheduler`"
 )
 ERR_UNKNOWN_ID = "No post with id %d exists."
+ERR_ALREADY_POSTED = "Post with id %d was already posted."
+ERR_UNEDITABLE_FIELD = "Field %s can't be updated, only: %s"
+ERR_WRONG_POST_TYPE = "Post with id %d has no field %s."
+ERR_OVERLOADED = "Service is overloaded, retry in %d ms."
+ERR_ABANDONED = "Caller stopped waiting before the command was handled."
+ERR_SUBMIT_TIMEOUT = "Submission took longer than %d seconds, will retry."
+ERR_SUBMISSION_LOST = (
+    "Reddit didn't show the submission within %d seconds, will retry. "
+    "The image may have failed processing."
+)
+ERR_PROFILE_RUNNING = "Another profile is already running."
+ERR_UNKNOWN_COMPRESSION = "Unknown compression %s, expected one of: %s"
+ERR_WATCH_DROPPED = "Watch fell too far behind and was dropped, please reconnect."
+
+# Fields of a post that an UPDATE edit may change
+EDITABLE_FIELDS = [
+    "title",
+    "flair_id",
+    "flair_text",
+    "data.text.body",
+    "data.poll.selftext",
+]
 
 # TODO how do you deal with schema updates? ==> separate table with version
 # Existing table cols will not be updated due to IF NOT EXISTS
@@ -78,19 +337,202 @@ CREATE TABLE IF NOT EXISTS Queue (
 );
 """
 
+# Values of Queue.posted
+NOT_POSTED = 0
+POSTED = 1
+SUBMITTED = 2  # Submitted without waiting for Reddit to confirm it's up
+
+# Idempotency keys of scheduled posts, along with the id of the post they made
+QUERY_CREATE_IDEMPOTENCY_KEYS = """
+CREATE TABLE IF NOT EXISTS IdempotencyKeys (
+    key TEXT PRIMARY KEY,
+    post_id INTEGER NOT NULL,
+    created_time INTEGER NOT NULL
+);
+"""
+
+QUERY_SELECT_IDEMPOTENCY_KEY = """
+SELECT post_id FROM IdempotencyKeys
+WHERE key == ?;
+"""
+
+QUERY_INSERT_IDEMPOTENCY_KEY = """
+INSERT INTO IdempotencyKeys (key, post_id, created_time)
+VALUES (?, ?, ?);
+"""
+
+QUERY_DELETE_OLD_IDEMPOTENCY_KEYS = """
+DELETE FROM IdempotencyKeys
+WHERE created_time < ?;
+"""
+
+# Statuses of exported posts that can be imported, and those that were sent to
+# Reddit already
+IMPORTABLE_STATUSES = [
+    rpc.PostStatus.PENDING,
+    rpc.PostStatus.POSTED,
+    rpc.PostStatus.ERROR,
+    rpc.PostStatus.SUBMITTED,
+]
+SENT_STATUSES = [rpc.PostStatus.POSTED, rpc.PostStatus.SUBMITTED]
+
+# Posts made to Reddit. submission_id is the fullname of the submission, which
+# is NULL until a SUBMITTED post is confirmed, and NULL for dry runs.
+QUERY_CREATE_SUBMISSIONS = """
+CREATE TABLE IF NOT EXISTS Submissions (
+    post_id INTEGER PRIMARY KEY,
+    submitted_time INTEGER NOT NULL,
+    submission_id TEXT,
+    permalink TEXT
+);
+"""
+
+# Data of posts scheduled to several subreddits at once. It is stored here
+# only once, and left out of the Queue.post of every target.
+QUERY_CREATE_PAYLOADS = """
+CREATE TABLE IF NOT EXISTS Payloads (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+QUERY_CREATE_SHARES = """
+CREATE TABLE IF NOT EXISTS Shares (
+    post_id INTEGER PRIMARY KEY,
+    payload_id INTEGER NOT NULL
+);
+"""
+
+# zstd dictionaries posts were compressed with, the newest one is used for new
+# posts. dict_id is the id zstd writes into the frames compressed with it.
+QUERY_CREATE_DICTIONARIES = """
+CREATE TABLE IF NOT EXISTS Dictionaries (
+    id INTEGER PRIMARY KEY,
+    dict_id INTEGER UNIQUE NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+# Latest performance of posts on Reddit, refreshed by the StatsCollector
+QUERY_CREATE_STATS = """
+CREATE TABLE IF NOT EXISTS Stats (
+    post_id INTEGER PRIMARY KEY,
+    score INTEGER NOT NULL,
+    num_comments INTEGER NOT NULL,
+    upvote_ratio REAL NOT NULL,
+    fetched_time INTEGER NOT NULL,
+    next_fetch_time INTEGER NOT NULL
+);
+"""
+
+# What reads should use. Recreated on startup so it can gain columns.
+QUERY_DROP_POSTS_VIEW = """
+DROP VIEW IF EXISTS Posts;
+"""
+
+QUERY_CREATE_POSTS_VIEW = """
+CREATE VIEW Posts AS
+SELECT
+    Queue.*,
+    Submissions.submitted_time,
+    Submissions.submission_id,
+    Submissions.permalink,
+    Stats.score,
+    Stats.num_comments,
+    Stats.upvote_ratio,
+    Stats.fetched_time,
+    Stats.next_fetch_time,
+    Payloads.data AS payload
+FROM Queue
+LEFT JOIN Submissions ON Submissions.post_id == Queue.id
+LEFT JOIN Stats ON Stats.post_id == Queue.id
+LEFT JOIN Shares ON Shares.post_id == Queue.id
+LEFT JOIN Payloads ON Payloads.id == Shares.payload_id;
+"""
+
+QUERY_CREATE_REQUIREMENTS = """
+CREATE TABLE IF NOT EXISTS Requirements (
+    subreddit TEXT PRIMARY KEY,
+    requirements BLOB NOT NULL,
+    fetched_time INTEGER NOT NULL
+);
+"""
+
+# Holds the sequence number of the latest change to every post, including
+# deleted ones. REPLACE-ing a row gives it a new, higher seq.
+QUERY_CREATE_CHANGELOG = """
+CREATE TABLE IF NOT EXISTS ChangeLog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER UNIQUE NOT NULL
+);
+"""
+
+# Databases created before the change log existed need their posts in it
+QUERY_BACKFILL_CHANGELOG = """
+INSERT INTO ChangeLog (post_id)
+SELECT id FROM Queue
+WHERE id NOT IN (SELECT post_id FROM ChangeLog);
+"""
+
 QUERY_INSERT_POST = """
 INSERT INTO Queue (post, scheduled_time, posted)
 VALUES (?, ?, ?);
 """
 
+QUERY_IMPORT_POST = """
+INSERT INTO Queue (post, scheduled_time, posted, error)
+VALUES (?, ?, ?, ?);
+"""
+
 QUERY_ELIGIBLE = """
-SELECT * FROM Queue
-WHERE scheduled_time < strftime('%s','now')
-AND posted == 0;
+SELECT * FROM Posts
+WHERE scheduled_time <= ?
+AND posted == 0
+ORDER BY id;
 """
 
 QUERY_ALL = """
-SELECT * FROM Queue;
+SELECT * FROM Posts
+ORDER BY id;
+"""
+
+QUERY_UNPOSTED = """
+SELECT * FROM Posts
+WHERE posted == 0
+ORDER BY id;
+"""
+
+QUERY_PAGE = """
+SELECT * FROM Posts
+WHERE id > ?
+ORDER BY id
+LIMIT ?;
+"""
+
+QUERY_NEXT_DUE = """
+SELECT MIN(scheduled_time) FROM Queue
+WHERE posted == 0
+AND error IS NULL
+AND scheduled_time > ?;
+"""
+
+QUERY_UPCOMING = """
+SELECT * FROM Posts
+WHERE posted == 0
+AND error IS NULL
+AND scheduled_time <= ?
+ORDER BY scheduled_time;
+"""
+
+QUERY_SELECT = """
+SELECT * FROM Posts
+WHERE id == ?;
+"""
+
+QUERY_REPLACE_POST = """
+UPDATE Queue
+SET post = ?, scheduled_time = ?, error = NULL
+WHERE id == ?;
 """
 
 QUERY_DELETE = """
@@ -98,14 +540,46 @@ DELETE FROM Queue
 WHERE id == ?;
 """
 
-QUERY_EXISTS = """
-SELECT COUNT(*) FROM Queue
-WHERE id == ?;
+QUERY_DELETE_SUBMISSION = """
+DELETE FROM Submissions
+WHERE post_id == ?;
+"""
+
+QUERY_INSERT_PAYLOAD = """
+INSERT INTO Payloads (data)
+VALUES (?);
+"""
+
+QUERY_INSERT_SHARE = """
+INSERT INTO Shares (post_id, payload_id)
+VALUES (?, ?);
+"""
+
+QUERY_DELETE_SHARE = """
+DELETE FROM Shares
+WHERE post_id == ?;
+"""
+
+# Run before deleting the post's share
+QUERY_DELETE_UNSHARED_PAYLOAD = """
+DELETE FROM Payloads
+WHERE id == (SELECT payload_id FROM Shares WHERE post_id == ?1)
+AND NOT EXISTS (
+    SELECT 1 FROM Shares
+    WHERE payload_id == Payloads.id
+    AND post_id != ?1
+);
+"""
+
+QUERY_SELECT_PAYLOAD = """
+SELECT Payloads.data FROM Shares
+JOIN Payloads ON Payloads.id == Shares.payload_id
+WHERE Shares.post_id == ?;
 """
 
 QUERY_MARK_POSTED = """
 UPDATE Queue
-SET posted = 1
+SET posted = 1, error = NULL
 WHERE id == ?;
 """
 
@@ -115,6 +589,201 @@ SET error = ?
 WHERE id == ?;
 """
 
+QUERY_MARK_SUBMITTED = """
+UPDATE Queue
+SET posted = 2, error = NULL
+WHERE id == ?;
+"""
+
+QUERY_INSERT_SUBMISSION = """
+INSERT OR REPLACE INTO Submissions (post_id, submitted_time, submission_id)
+VALUES (?, ?, ?);
+"""
+
+QUERY_SUBMITTED = """
+SELECT * FROM Posts
+WHERE posted == 2
+ORDER BY submitted_time;
+"""
+
+# Keeps the submitted_time of SUBMITTED posts
+QUERY_CONFIRM_SUBMISSION = """
+INSERT INTO Submissions (post_id, submitted_time, submission_id, permalink)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (post_id) DO UPDATE
+SET submission_id = excluded.submission_id,
+    permalink = COALESCE(excluded.permalink, permalink);
+"""
+
+QUERY_SET_PERMALINK = """
+UPDATE Submissions
+SET permalink = ?
+WHERE post_id == ?;
+"""
+
+QUERY_STALE_STATS = """
+SELECT id, submission_id, submitted_time FROM Posts
+WHERE posted == 1
+AND submission_id IS NOT NULL
+AND submitted_time > ?
+AND COALESCE(next_fetch_time, 0) <= ?
+ORDER BY COALESCE(next_fetch_time, 0)
+LIMIT ?;
+"""
+
+QUERY_STORE_STATS = """
+INSERT OR REPLACE INTO Stats
+(post_id, score, num_comments, upvote_ratio, fetched_time, next_fetch_time)
+VALUES (?, ?, ?, ?, ?, ?);
+"""
+
+# Stats rows of posts that were never fetched have a fetched_time of 0
+QUERY_POSTPONE_STATS = """
+INSERT INTO Stats
+(post_id, score, num_comments, upvote_ratio, fetched_time, next_fetch_time)
+VALUES (?, 0, 0, 0, 0, ?)
+ON CONFLICT (post_id) DO UPDATE
+SET next_fetch_time = excluded.next_fetch_time;
+"""
+
+QUERY_ALL_STATS = """
+SELECT * FROM Stats
+WHERE fetched_time > 0;
+"""
+
+# Formatted with a placeholder per post id
+QUERY_STATS_OF = """
+SELECT * FROM Stats
+WHERE post_id IN ({})
+AND fetched_time > 0;
+"""
+
+# Follow-ups of posts that are up on Reddit, created when the post is confirmed.
+# position is the index of the follow-up in the post's follow_ups.
+QUERY_CREATE_JOBS = """
+CREATE TABLE IF NOT EXISTS Jobs (
+    id INTEGER PRIMARY KEY,
+    post_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    follow_up BLOB NOT NULL,
+    due_time INTEGER NOT NULL,
+    done_time INTEGER,
+    error TEXT,
+    UNIQUE (post_id, position)
+);
+"""
+
+QUERY_CREATE_JOBS_INDEX = """
+CREATE INDEX IF NOT EXISTS JobsDue ON Jobs (due_time)
+WHERE done_time IS NULL;
+"""
+
+# Ignored when the post was already confirmed before
+QUERY_INSERT_JOB = """
+INSERT OR IGNORE INTO Jobs (post_id, position, follow_up, due_time)
+VALUES (?, ?, ?, ?);
+"""
+
+QUERY_DUE_JOBS = """
+SELECT Jobs.id, Jobs.post_id, Jobs.follow_up, Submissions.submission_id
+FROM Jobs
+JOIN Submissions ON Submissions.post_id == Jobs.post_id
+WHERE Jobs.done_time IS NULL
+AND Jobs.due_time <= ?
+ORDER BY Jobs.due_time;
+"""
+
+QUERY_NEXT_JOB = """
+SELECT MIN(due_time) FROM Jobs
+WHERE done_time IS NULL
+AND due_time > ?;
+"""
+
+QUERY_FINISH_JOB = """
+UPDATE Jobs
+SET done_time = ?, error = ?
+WHERE id == ?;
+"""
+
+QUERY_DELETE_JOBS = """
+DELETE FROM Jobs
+WHERE post_id == ?;
+"""
+
+QUERY_DELETE_STATS = """
+DELETE FROM Stats
+WHERE post_id == ?;
+"""
+
+# Submission never showed up, so go back to retrying the post
+QUERY_FAIL_SUBMISSION = """
+UPDATE Queue
+SET posted = 0, error = ?
+WHERE id == ?;
+"""
+
+QUERY_ALL_REQUIREMENTS = """
+SELECT * FROM Requirements;
+"""
+
+QUERY_STORE_REQUIREMENTS = """
+INSERT OR REPLACE INTO Requirements (subreddit, requirements, fetched_time)
+VALUES (?, ?, ?);
+"""
+
+QUERY_ALL_DICTIONARIES = """
+SELECT data FROM Dictionaries
+ORDER BY id;
+"""
+
+QUERY_INSERT_DICTIONARY = """
+INSERT INTO Dictionaries (dict_id, data)
+VALUES (?, ?);
+"""
+
+# Images don't compress and would only teach the dictionary noise
+QUERY_DICTIONARY_SAMPLES = """
+SELECT post FROM Queue
+WHERE length(post) <= ?
+ORDER BY id DESC
+LIMIT ?;
+"""
+
+QUERY_RECORD_CHANGE = """
+INSERT OR REPLACE INTO ChangeLog (post_id)
+VALUES (?);
+"""
+
+QUERY_LATEST_SEQ = """
+SELECT COALESCE(MAX(seq), 0) FROM ChangeLog;
+"""
+
+# Deleted posts have no matching Posts row so their columns come back NULL
+QUERY_CHANGES_SINCE = """
+SELECT ChangeLog.post_id AS changed_id, Posts.* FROM ChangeLog
+LEFT JOIN Posts ON Posts.id == ChangeLog.post_id
+WHERE ChangeLog.seq > ?
+ORDER BY ChangeLog.seq;
+"""
+
+
+def create_tables(conn: sqlite3.Connection):
+    conn.execute(QUERY_CREATE_TABLE)
+    conn.execute(QUERY_CREATE_CHANGELOG)
+    conn.execute(QUERY_CREATE_REQUIREMENTS)
+    conn.execute(QUERY_CREATE_SUBMISSIONS)
+    conn.execute(QUERY_CREATE_STATS)
+    conn.execute(QUERY_CREATE_PAYLOADS)
+    conn.execute(QUERY_CREATE_SHARES)
+    conn.execute(QUERY_CREATE_DICTIONARIES)
+    conn.execute(QUERY_CREATE_JOBS)
+    conn.execute(QUERY_CREATE_JOBS_INDEX)
+    conn.execute(QUERY_CREATE_IDEMPOTENCY_KEYS)
+    conn.execute(QUERY_DROP_POSTS_VIEW)
+    conn.execute(QUERY_CREATE_POSTS_VIEW)
+    conn.execute(QUERY_BACKFILL_CHANGELOG)
+    conn.commit()
+
 
 # TODO validate data field as well (or delegate to praw)
 def validate_post(post: rpc.Post):
@@ -122,23 +791,349 @@ def validate_post(post: rpc.Post):
     return post.title != "" and post.subreddit != "" and post.scheduled_time != 0
 
 
+def post_type(post: rpc.Post) -> str:
+    """Name of the Data field that is set, e.g. "image"."""
+    return post.data.WhichOneof("type") or ""
+
+
+def check_requirements(post: rpc.Post, reqs: rpc.SubredditRequirements) -> str:
+    """Returns why the subreddit would reject the post, or "" if it wouldn't."""
+    sub = f"r/{post.subreddit}"
+    title = post.title.lower()
+    if reqs.title_min_length and len(post.title) < reqs.title_min_length:
+        return f"{sub} requires titles of at least {reqs.title_min_length} characters"
+    if reqs.title_max_length and len(post.title) > reqs.title_max_length:
+        return f"{sub} requires titles of at most {reqs.title_max_length} characters"
+    if reqs.title_required_strings and not any(
+        s.lower() in title for s in reqs.title_required_strings
+    ):
+        options = ", ".join(reqs.title_required_strings)
+        return f"{sub} requires the title to contain one of: {options}"
+    for s in reqs.title_blacklisted_strings:
+        if s.lower() in title:
+            return f"{sub} doesn't allow titles containing: {s}"
+    if reqs.flair_required and post.flair_id == "":
+        return f"{sub} requires posts to have a flair"
+    if post_type(post) in reqs.disallowed_types:
+        return f"{sub} doesn't allow {post_type(post)} posts"
+    if post.data.HasField("text"):
+        body = post.data.text.body
+        if reqs.body_required and body == "":
+            return f"{sub} requires posts to have a body"
+        if reqs.body_not_allowed and body != "":
+            return f"{sub} doesn't allow posts to have a body"
+        if reqs.body_max_length and len(body) > reqs.body_max_length:
+            return f"{sub} requires bodies of at most {reqs.body_max_length} characters"
+    if post.data.HasField("url"):
+        url = post.data.url.url
+        if "://" not in url:
+            url = "//" + url
+        host = (urlparse(url).hostname or "").lower()
+        for domain in reqs.domain_blacklist:
+            domain = domain.lower()
+            if host == domain or host.endswith("." + domain):
+                return f"{sub} doesn't allow links to {domain}"
+    return ""
+
+
+class BlobCodec:
+    """Compresses the posts and payloads stored in the database.
+
+    Compressed blobs start with a byte saying how they were compressed. Raw
+    protobuf starts with a field tag, whose low 3 bits (the wire type) are never
+    6 or 7, so blobs that were stored as they are, including every blob written
+    before compression existed, can't be mistaken for compressed ones.
+
+    zstd frames name the dictionary they were compressed with, so every
+    dictionary that was ever added is kept for decompressing. Only used from
+    the database thread.
+    """
+
+    ZLIB = 0x07
+    ZSTD = 0x0F
+
+    def __init__(self, algorithm: Optional[str] = None):
+        self.compressor: Any = None
+        # zstd decompressors by dictionary id, 0 being no dictionary
+        self.decompressors: Dict[int, Any] = {}
+        if zstandard is not None:
+            self.compressor = zstandard.ZstdCompressor(level=BLOB_ZSTD_LEVEL)
+            self.decompressors[0] = zstandard.ZstdDecompressor()
+        self.set_algorithm(algorithm or ("zstd" if zstandard is not None else "zlib"))
+
+    def set_algorithm(self, algorithm: str):
+        if algorithm not in BLOB_ALGORITHMS:
+            raise ValueError(
+                ERR_UNKNOWN_COMPRESSION % (algorithm, ", ".join(BLOB_ALGORITHMS))
+            )
+        if algorithm == "zstd" and zstandard is None:
+            log.warning("zstandard is not installed, compressing posts with zlib")
+            algorithm = "zlib"
+        self.algorithm = algorithm
+
+    def add_dictionary(self, data: bytes):
+        """Decompresses with the dictionary from now on, and compresses with it
+        since it's the newest one."""
+        if zstandard is None:
+            log.warning("zstandard is not installed, ignoring dictionary")
+            return
+        dictionary = zstandard.ZstdCompressionDict(data)
+        self.decompressors[dictionary.dict_id()] = zstandard.ZstdDecompressor(
+            dict_data=dictionary
+        )
+        self.compressor = zstandard.ZstdCompressor(
+            level=BLOB_ZSTD_LEVEL, dict_data=dictionary
+        )
+
+    def compress(self, blob: bytes) -> bytes:
+        if self.algorithm == "zstd":
+            return bytes([self.ZSTD]) + self.compressor.compress(blob)
+        return bytes([self.ZLIB]) + zlib.compress(blob, BLOB_ZLIB_LEVEL)
+
+    def encode(self, blob: bytes) -> bytes:
+        """The blob compressed, or as it is if that doesn't make it smaller."""
+        if self.algorithm == "none" or len(blob) < BLOB_COMPRESSION_MIN:
+            return blob
+        if len(blob) > 4 * BLOB_PROBE_SIZE:
+            probe = self.compress(blob[:BLOB_PROBE_SIZE])
+            if len(probe) > 0.9 * BLOB_PROBE_SIZE:
+                return blob
+        packed = self.compress(blob)
+        return packed if len(packed) < len(blob) else blob
+
+    def decode(self, blob: bytes) -> bytes:
+        if len(blob) == 0:
+            return blob
+        if blob[0] == self.ZLIB:
+            return zlib.decompress(memoryview(blob)[1:])
+        if blob[0] == self.ZSTD:
+            if zstandard is None:
+                raise ValueError("Post is compressed with zstd, install zstandard")
+            frame = memoryview(blob)[1:]
+            dict_id = zstandard.get_frame_parameters(frame).dict_id
+            if dict_id not in self.decompressors:
+                raise ValueError(
+                    f"Post is compressed with unknown dictionary {dict_id}"
+                )
+            return self.decompressors[dict_id].decompress(frame)
+        return blob
+
+
+codec = BlobCodec()
+
+
+def load_dictionaries(conn: sqlite3.Connection):
+    for row in conn.execute(QUERY_ALL_DICTIONARIES):
+        codec.add_dictionary(row[0])
+
+
+def train_dictionary(conn: sqlite3.Connection) -> int:
+    """Trains a zstd dictionary on the newest short posts and stores it, so that
+    the service compresses new posts with it after its next start.
+
+    Returns the id of the dictionary. Raises zstandard.ZstdError if there are
+    too few posts to learn from.
+    """
+    samples = [
+        codec.decode(row[0])
+        for row in conn.execute(
+            QUERY_DICTIONARY_SAMPLES, (BLOB_PROBE_SIZE, BLOB_DICTIONARY_SAMPLES)
+        )
+    ]
+    dictionary = zstandard.train_dictionary(
+        BLOB_DICTIONARY_SIZE, samples, level=BLOB_ZSTD_LEVEL
+    )
+    conn.execute(QUERY_INSERT_DICTIONARY, (dictionary.dict_id(), dictionary.as_bytes()))
+    conn.commit()
+    return dictionary.dict_id()
+
+
 def make_post_from_row(row: sqlite3.Row) -> rpc.Post:
     post = rpc.Post()
-    post.ParseFromString(row["post"])
+    post.ParseFromString(codec.decode(row["post"]))
+    if row["payload"] is not None:
+        post.data.ParseFromString(codec.decode(row["payload"]))
     return post
 
 
+def split_targets(p: rpc.Post) -> List[rpc.Post]:
+    """The post to its own subreddit followed by one post per target."""
+    posts = [rpc.Post()]
+    posts[0].CopyFrom(p)
+    del posts[0].targets[:]
+    for target in p.targets:
+        posts.append(
+            rpc.Post(
+                title=p.title,
+                scheduled_time=p.scheduled_time + target.delay,
+                subreddit=target.subreddit,
+                data=p.data,
+                flair_id=target.flair_id,
+                flair_text=target.flair_text,
+                follow_ups=p.follow_ups,
+            )
+        )
+    return posts
+
+
+def check_follow_ups(post: rpc.Post) -> str:
+    """Returns what is wrong with the follow-ups of the post, or ""."""
+    for follow_up in post.follow_ups:
+        if follow_up.action == rpc.FollowUp.Action.UNKNOWN:
+            return "follow-up is missing an action"
+        if follow_up.action == rpc.FollowUp.Action.COMMENT and follow_up.text == "":
+            return "comment follow-up is missing its text"
+    return ""
+
+
+def make_entry_from_row(row: sqlite3.Row) -> rpc.PostDbEntry:
+    status = rpc.PostStatus.UNKNOWN
+    error = ""
+    if row["error"] is not None:
+        status = rpc.PostStatus.ERROR
+        error = row["error"]
+    elif row["posted"] == SUBMITTED:
+        status = rpc.PostStatus.SUBMITTED
+    elif row["posted"]:
+        status = rpc.PostStatus.POSTED
+    else:
+        status = rpc.PostStatus.PENDING
+    return rpc.PostDbEntry(
+        id=row["id"],
+        post=make_post_from_row(row),
+        status=status,
+        error=error,
+        submission_id=row["submission_id"] or "",
+        permalink=row["permalink"] or "",
+        stats=make_stats_from_row(row) if row["fetched_time"] else None,
+    )
+
+
+def make_stats_from_row(row: sqlite3.Row) -> rpc.PostStats:
+    return rpc.PostStats(
+        score=row["score"],
+        num_comments=row["num_comments"],
+        upvote_ratio=row["upvote_ratio"],
+        fetched_time=row["fetched_time"],
+    )
+
+
+def stats_refresh_interval(age: float) -> float:
+    """Seconds until the stats of a post that is `age` seconds old are stale.
+
+    Posts change the most right after going up, so young posts are refreshed
+    often and older ones less and less.
+    """
+    return min(max(age / 4, STATS_MIN_INTERVAL), STATS_MAX_INTERVAL)
+
+
+# DbCommand priorities, lower values are handled first
+PRIORITY_HIGH = 0  # Poster reads and commits
+PRIORITY_NORMAL = 1  # Client writes
+PRIORITY_LOW = 2  # Client reads
+
+# Fraction of the database queue each priority may fill before being rejected.
+# Keeps room for Poster commits when clients flood the service.
+ADMISSION_LIMITS = {
+    PRIORITY_HIGH: 1.0,
+    PRIORITY_NORMAL: 0.9,
+    PRIORITY_LOW: 0.5,
+}
+
+
+class Clock:
+    """Where the Database and the Poster get the time from.
+
+    Only the schedule runs on the clock. Timeouts of RPCs, submissions and the
+    watchdog keep measuring real time.
+    """
+
+    def time(self) -> float:
+        return time.time()
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        """Waits up to timeout seconds for event. Returns whether it was set."""
+        return event.wait(timeout)
+
+
+class SimulatedClock(Clock):
+    """Clock that jumps ahead instead of waiting, to run a schedule in seconds.
+
+    `wait` returns right away, moving the time forward by the whole timeout
+    unless the event is already set.
+    """
+
+    def __init__(self, start: float):
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self) -> float:
+        with self.lock:
+            return self.now
+
+    def advance(self, seconds: float):
+        with self.lock:
+            self.now += max(0, seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        if event.is_set():
+            return True
+        self.advance(timeout)
+        return False
+
+
+class DbOverloaded(Exception):
+    """Raised when the Database refuses to queue a command."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(ERR_OVERLOADED % (retry_after * 1000))
+        self.retry_after = retry_after
+
+
 class DbCommand:
     """Primary way to instruct Database to do something.
 
     Command consist of a string descriptor and object payload and can be queued
     in the Database. The Database will reply via the `oneshot` channel
+
+    Commands with a `deadline` (in time.monotonic() seconds) or that were
+    cancelled are dropped by the Database instead of being handled, since
+    nobody is waiting for the answer anymore.
+
+    While tracing, the Database records its spans for the command under
+    `trace_id`, which is made up if the sender doesn't have one.
     """
 
-    def __init__(self, command: str, obj: Any):
+    def __init__(
+        self,
+        command: str,
+        obj: Any,
+        priority: int = PRIORITY_NORMAL,
+        deadline: Optional[float] = None,
+        trace_id: Optional[str] = None,
+    ):
         self.command = command
         self.obj = obj
+        self.priority = priority
+        self.deadline = deadline
+        self.cancelled = False
         self.oneshot = Queue(maxsize=1)  # type: Queue[DbReply]
+        self.trace_id = trace_id
+        # time.time() it was queued at, only set while tracing
+        self.queued_time = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_abandoned(self) -> bool:
+        if self.cancelled:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def time_left(self) -> float:
+        if self.deadline is None:
+            return LOCK_TIMEOUT
+        return max(0, self.deadline - time.monotonic())
 
     # Database helpers
     def reply_ok(self, obj: Any):
@@ -152,10 +1147,34 @@ class DbCommand:
 
     # Client helpers
     def wait_for_answer(self):
-        return self.oneshot.get(timeout=LOCK_TIMEOUT)
+        return self.oneshot.get(timeout=self.time_left())
 
     def __str__(self):
-        return f"DbCommand ({self.command}, {self.obj})"
+        return f"DbCommand ({self.command}, {bounded.repr(self.obj)})"
+
+
+class RpcCommands:
+    """Cancels the Database command an RPC is waiting on once the RPC ends.
+
+    Registers a single callback with the RPC's context, so RPCs that run a
+    command per page or batch don't pile up a callback for each of them.
+    """
+
+    def __init__(self, context: grpc.ServicerContext):
+        self.current: Optional[DbCommand] = None
+        # add_callback refuses callbacks of RPCs that already ended
+        self.ended = not context.add_callback(self.cancel)
+
+    def track(self, command: DbCommand):
+        self.current = command
+        if self.ended:
+            command.cancel()
+
+    def cancel(self):
+        self.ended = True
+        command = self.current
+        if command is not None:
+            command.cancel()
 
 
 class DbReply:
@@ -180,381 +1199,3434 @@ class ObjMarkError:
         self.err = err
 
 
-class Database:
-    """Wraps a SQL connection and provides an async channel for SQL operations."""
+class ObjRequirements:
+    """Obj included in a requirements DbCommand."""
 
-    def __init__(self, path: str):
-        self.path = path
-        self.queue = Queue(100)
-        # We initialize the connection in start() so that all SQL components are
-        # running in the same thread
-        self.conn: Optional[sqlite3.Connection] = None
+    def __init__(self, subreddit: str, reqs: rpc.SubredditRequirements) -> None:
+        self.subreddit = subreddit
+        self.reqs = reqs
 
-    def adopt_connection_for_testing(self, conn: sqlite3.Connection):
-        self.conn = conn
 
-    def queue_command(self, command: DbCommand):
-        """Queue a command to be handled by the db later.
+class ObjSubmission:
+    """Obj included in a confirm_submitted DbCommand."""
 
-        This may block if the queue buffer is full and errors after LOCK_TIMEOUT.
-        """
-        log.debug("Database queued command: %s", command)
-        try:
-            self.queue.put(command, timeout=LOCK_TIMEOUT)
-        except queue.Full:
-            raise Exception("Service timeout: service may be overloaded")
+    def __init__(self, id: int, submission_id: str, permalink: Optional[str]) -> None:
+        self.id = id
+        self.submission_id = submission_id
+        self.permalink = permalink
+
+
+class ObjJob:
+    """A due follow-up, as returned by a due_jobs DbCommand."""
+
+    def __init__(
+        self, id: int, post_id: int, submission_id: str, follow_up: rpc.FollowUp
+    ) -> None:
+        self.id = id
+        self.post_id = post_id
+        self.submission_id = submission_id
+        self.follow_up = follow_up
+
+
+class ObjJobResult:
+    """Obj included in a finish_job DbCommand. err is "" if the job succeeded."""
+
+    def __init__(self, id: int, err: str) -> None:
+        self.id = id
+        self.err = err
+
+
+class ObjStats:
+    """Stats of one post included in a store_stats DbCommand. stats is None for
+    posts Reddit didn't return, which only pushes back their next fetch."""
+
+    def __init__(
+        self,
+        id: int,
+        stats: Optional[rpc.PostStats],
+        permalink: str,
+        next_fetch_time: int,
+    ) -> None:
+        self.id = id
+        self.stats = stats
+        self.permalink = permalink
+        self.next_fetch_time = next_fetch_time
+
+
+class Watcher:
+    """Subscription to post status changes handed out by the Database.
+
+    The Database pushes PostDbEntry objects into `events` as it applies them. If
+    the buffer fills up the watcher is dropped rather than blocking the Database.
+    """
+
+    def __init__(self):
+        self.events = Queue(WATCH_BUFFER)  # type: Queue[rpc.PostDbEntry]
+        self.dropped = False
+
+
+# String, blob and number literals, so statements differing only in their
+# parameters are timed together
+SQL_LITERAL = re.compile(r"[xX]'[0-9a-fA-F]*'|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class StatementTimer:
+    """Times the SQLite statements the Database runs while profiling.
+
+    SQLite only reports when a statement starts, so each one is timed until the
+    next one starts or the Database finishes the command that ran it.
+    """
+
+    def __init__(self):
+        # Count and total seconds by normalized statement
+        self.timings: Dict[str, List[float]] = {}
+        self.current: Optional[str] = None
+        self.started = 0.0
+
+    def trace(self, sql: str):
+        self.finish()
+        self.current = " ".join(SQL_LITERAL.sub("?", sql).split())
+        self.started = time.perf_counter()
+
+    def finish(self):
+        if self.current is None:
+            return
+        timing = self.timings.setdefault(self.current, [0, 0.0])
+        timing[0] += 1
+        timing[1] += time.perf_counter() - self.started
+        self.current = None
+
+    def results(self) -> List[rpc.StatementTiming]:
+        timings = sorted(self.timings.items(), key=lambda item: -item[1][1])
+        return [
+            rpc.StatementTiming(sql=sql, count=int(count), total_time=total)
+            for sql, (count, total) in timings
+        ]
+
+
+class Profiler:
+    """Profiles the next few calls of a method with cProfile and tracemalloc.
+
+    The method is only wrapped while the profile runs, by shadowing it on the
+    instance, so it costs nothing the rest of the time. Calls that overlap one
+    being profiled run unprofiled, since cProfile profiles a thread at a time.
+    """
+
+    # Held while a profile runs, only one can run at a time
+    running = threading.Lock()
+
+    def __init__(self, obj: Any, method: str, count: int):
+        self.obj = obj
+        self.method = method
+        self.count = count
+        self.samples = 0
+        self.stats: Optional[pstats.Stats] = None
+        self.stopped = False
+        self.stats_lock = threading.Lock()
+        # Held while a call is being profiled
+        self.sampling = threading.Lock()
+        # Set once count calls were profiled
+        self.done = threading.Event()
+        self.started_tracemalloc = False
 
     def start(self):
-        self.initialize()
-        self.handle_commands()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        original = getattr(self.obj, self.method)
 
-    def initialize(self):
+        def sample(*args, **kwargs):
+            if self.done.is_set() or not self.sampling.acquire(blocking=False):
+                return original(*args, **kwargs)
+            try:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Another profiler is active, e.g. one left from a profile
+                    # that timed out
+                    return original(*args, **kwargs)
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    self.record(profile)
+            finally:
+                self.sampling.release()
+
+        setattr(self.obj, self.method, sample)
+
+    def record(self, profile: cProfile.Profile):
+        with self.stats_lock:
+            if self.stopped:
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.samples += 1
+            if self.samples >= self.count:
+                self.done.set()
+
+    def stop(self, top_allocations: int) -> rpc.ProfileReply:
+        """Unwraps the method and returns what was profiled so far."""
+        delattr(self.obj, self.method)
+        snapshot = tracemalloc.take_snapshot()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        with self.stats_lock:
+            self.stopped = True
+        reply = rpc.ProfileReply(samples=self.samples)
+        if self.stats is not None:
+            reply.pstats = marshal.dumps(self.stats.stats)  # type: ignore
+        # Leave out the profiling's own allocations
+        snapshot = snapshot.filter_traces(
+            [
+                tracemalloc.Filter(False, module.__file__)
+                for module in [tracemalloc, cProfile, pstats]
+            ]
+        )
+        for stat in snapshot.statistics("lineno")[:top_allocations]:
+            frame = stat.traceback[0]
+            reply.allocations.append(
+                rpc.Allocation(
+                    location=f"{frame.filename}:{frame.lineno}",
+                    size=stat.size,
+                    count=stat.count,
+                )
+            )
+        return reply
+
+
+class Storage(ABC):
+    """Where the Database keeps the posts in its queue and everything it knows
+    about them: their submissions, stats and follow-up jobs, the change log
+    SyncPosts reads, idempotency keys and cached subreddit requirements.
+
+    Implementations store what they are given. Validating posts, checking
+    subreddit rules and notifying watchers is up to the Database. Only used
+    from the database thread, and nothing is durable until commit().
+    """
+
+    @abstractmethod
+    def open(self):
+        """Gets ready for use, called from the database thread first thing."""
+
+    @abstractmethod
+    def close(self): ...
+
+    @abstractmethod
+    def commit(self):
+        """Makes the changes since the last commit durable."""
+
+    @abstractmethod
+    def rollback(self):
+        """Drops the changes since the last commit, where the backend can."""
+
+    @abstractmethod
+    def trace(self, callback: Optional[Callable[[str], None]]):
+        """Calls callback with every statement run from now on, or stops if
+        it's None. Backends that don't run statements never call it."""
+
+    @abstractmethod
+    def add(self, posts: List[rpc.Post]) -> List[int]:
+        """Stores the targets of one scheduled post, which all share its data.
+
+        Returns their ids in order. Ids only ever increase.
+        """
+
+    @abstractmethod
+    def import_entry(self, entry: rpc.PostDbEntry, submitted_time: int) -> int:
+        """Stores an exported post with its status, error and submission, if it
+        has one, as made at submitted_time. Returns its new id.
+
+        The status must be PENDING, POSTED or ERROR.
+        """
+
+    @abstractmethod
+    def get(self, id: int) -> Optional[rpc.PostDbEntry]: ...
+
+    @abstractmethod
+    def list(self) -> List[rpc.PostDbEntry]:
+        """Every post, by id."""
+
+    @abstractmethod
+    def page(self, after_id: int, limit: int) -> List[rpc.PostDbEntry]:
+        """The first `limit` posts with an id above after_id, by id."""
+
+    @abstractmethod
+    def eligible(self, now: int) -> List[rpc.PostDbEntry]:
+        """Posts that are due by now and weren't posted, failed ones included,
+        by id."""
+
+    @abstractmethod
+    def next_due(self, after: int) -> Optional[int]:
+        """Scheduled time of the next pending post due after `after`.
+
+        Failed posts don't count, they wait until they're edited.
+        """
+
+    @abstractmethod
+    def upcoming(self, until: int) -> List[rpc.PostDbEntry]:
+        """Pending posts due by `until`, by scheduled time. Failed ones don't
+        count."""
+
+    @abstractmethod
+    def unposted(self) -> List[rpc.PostDbEntry]:
+        """Posts that weren't posted, failed ones included, by id."""
+
+    @abstractmethod
+    def edit(self, id: int, post: rpc.Post):
+        """Replaces the post and clears its error so that it's retried."""
+
+    @abstractmethod
+    def delete(self, id: int):
+        """Deletes the post along with its submission, stats and jobs."""
+
+    @abstractmethod
+    def mark_posted(self, id: int): ...
+
+    @abstractmethod
+    def mark_error(self, id: int, err: str): ...
+
+    @abstractmethod
+    def mark_submitted(self, id: int, now: int):
+        """Marks the post as SUBMITTED at now, with no submission id yet."""
+
+    @abstractmethod
+    def submitted(self) -> List[Tuple[rpc.PostDbEntry, int]]:
+        """SUBMITTED posts along with when they were submitted, oldest first."""
+
+    @abstractmethod
+    def confirm_submitted(
+        self, id: int, now: int, submission_id: str, permalink: Optional[str]
+    ):
+        """Marks the post as posted as the given submission. SUBMITTED posts
+        keep their submitted time, others are submitted at now."""
+
+    @abstractmethod
+    def fail_submitted(self, id: int, err: str):
+        """Sends a SUBMITTED post back to be retried, failed with err."""
+
+    @abstractmethod
+    def add_job(self, post_id: int, position: int, follow_up: rpc.FollowUp, due: int):
+        """Adds a job for the follow-up at position in the post's follow_ups,
+        unless the post already had one for it."""
+
+    @abstractmethod
+    def due_jobs(self, now: int) -> List[ObjJob]:
+        """Unfinished jobs due by now, by due time."""
+
+    @abstractmethod
+    def next_job(self, after: int) -> Optional[int]:
+        """When the next unfinished job due after `after` is due."""
+
+    @abstractmethod
+    def finish_job(self, job_id: int, now: int, err: str): ...
+
+    @abstractmethod
+    def stale_stats(
+        self, now: int, oldest: int, limit: int
+    ) -> List[Tuple[int, str, int]]:
+        """Up to `limit` posted posts submitted after `oldest` whose stats are
+        due for a refresh by now, as (id, submission id, submitted time).
+        Longest overdue first."""
+
+    @abstractmethod
+    def store_stats(self, obj: ObjStats):
+        """Stores fetched stats and permalink, or only pushes back the next
+        fetch if obj has no stats."""
+
+    @abstractmethod
+    def stats(self, ids: List[int]) -> Dict[int, rpc.PostStats]:
+        """Fetched stats by post id of the given posts, or of all posts if ids
+        is empty."""
+
+    @abstractmethod
+    def changes_since(self, seq: int) -> rpc.SyncPostsReply:
+        """The latest change seq and the posts changed after seq, by seq. Posts
+        deleted since are only listed by id."""
+
+    @abstractmethod
+    def find_idempotency_key(self, key: str) -> Optional[int]:
+        """Id of the post the key was used for, if it was."""
+
+    @abstractmethod
+    def add_idempotency_key(self, key: str, post_id: int, now: int): ...
+
+    @abstractmethod
+    def expire_idempotency_keys(self, before: int):
+        """Forgets the keys added before `before`."""
+
+    @abstractmethod
+    def all_requirements(
+        self,
+    ) -> Dict[str, Tuple[rpc.SubredditRequirements, float]]:
+        """Cached subreddit requirements by subreddit, with when they were
+        fetched."""
+
+    @abstractmethod
+    def store_requirements(
+        self, subreddit: str, reqs: rpc.SubredditRequirements, now: int
+    ): ...
+
+
+class SqliteStorage(Storage):
+    """Keeps posts in a SQLite database, the one the service uses.
+
+    Targets share a single copy of their data in Payloads. Every change is
+    recorded in the ChangeLog for SyncPosts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Connected in open() so that the connection is only used from the
+        # database thread
+        self.conn: sqlite3.Connection
+
+    def adopt_connection_for_testing(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def open(self):
         try:
             self.conn = sqlite3.connect(self.path)
             self.conn.row_factory = sqlite3.Row
         except Exception as e:
             raise Exception(f"Failed to initialize db at {self.path}") from e
         try:
-            cur = self.conn.cursor()
-            cur.execute(QUERY_CREATE_TABLE)
+            create_tables(self.conn)
         except Exception as e:
             raise Exception("Failed to create database table") from e
+        load_dictionaries(self.conn)
 
-    def step(self) -> bool:
-        if self.conn == None:
-            assert False
-        entry: DbCommand = self.queue.get()
-        log.debug("Database handling command: %s", entry)
-        command = entry.command
-        if command == "quit":
-            log.debug("Stopping database")
-            self.conn.close()
-            return False
-        elif command == "post":
-            try:
-                msg = self.add_post(entry.obj)
-                entry.reply(msg, msg != "")
-            except:
-                log.exception("Failed to insert post into database:\n%s", entry.obj)
-                entry.reply_err(ERR_INTERNAL)
-        elif command == "eligible":
-            try:
-                posts = self.get_posts_from_query(QUERY_ELIGIBLE)
-                entry.reply(posts, posts == None)
-            except:
-                log.exception("Failed to get eligible posts")
-                entry.reply_err(ERR_INTERNAL)
-        elif command == "all":
-            try:
-                all = self.get_posts_from_query(QUERY_ALL)
-                entry.reply(all, all == None)
-            except:
-                log.exception("Failed to get all posts")
-                entry.reply_err(ERR_INTERNAL)
-        elif command == "edit":
-            try:
-                msg = self.edit_post(entry.obj)
-                entry.reply(msg, msg != "")
-            except:
-                log.exception("Failed to edit post")
-                entry.reply_err(ERR_INTERNAL)
-        elif command == "mark_posted":
-            try:
-                msg = self.mark_posted(entry.obj)
-                entry.reply(msg, msg != "")
-            except:
-                log.exception("Failed to mark post with id %d as posted", entry.obj)
-                entry.reply_err(ERR_INTERNAL)
-        elif command == "mark_error":
-            obj = cast(ObjMarkError, entry.obj)
-            try:
-                msg = self.mark_error(obj.id, obj.err)
-            except:
-                log.exception(
-                    "Failed to mark post with id %d as error %s",
-                    obj.id,
-                    obj.err,
-                )
-                entry.reply_err(ERR_INTERNAL)
-        return True
+    def close(self):
+        self.conn.close()
 
-    def handle_commands(self):
-        while self.step():
-            pass
+    def commit(self):
+        self.conn.commit()
 
-    def id_exists(self, id: int) -> bool:
-        if self.conn == None:
-            assert False
-        return self.conn.execute(QUERY_EXISTS, (id,)).fetchone()[0] != 0
+    def rollback(self):
+        self.conn.rollback()
 
-    def add_post(self, p: rpc.Post) -> str:
-        if self.conn == None:
-            assert False
+    def trace(self, callback: Optional[Callable[[str], None]]):
+        self.conn.set_trace_callback(callback)
 
-        if not validate_post(p):
-            return "invalid post, client should not have sent this"
+    def entries(self, query: str, params: Tuple = ()) -> List[rpc.PostDbEntry]:
+        return [make_entry_from_row(row) for row in self.conn.execute(query, params)]
+
+    def add(self, posts: List[rpc.Post]) -> List[int]:
+        payload_id = None
+        if len(posts) > 1:
+            cur = self.conn.execute(
+                QUERY_INSERT_PAYLOAD, (codec.encode(posts[0].data.SerializeToString()),)
+            )
+            payload_id = cur.lastrowid
+        ids = []
+        for post in posts:
+            if payload_id is not None:
+                shared = rpc.Post()
+                shared.CopyFrom(post)
+                shared.ClearField("data")
+                post = shared
+            cur = self.conn.execute(
+                QUERY_INSERT_POST,
+                (
+                    codec.encode(post.SerializeToString()),
+                    post.scheduled_time,
+                    NOT_POSTED,
+                ),
+            )
+            id = cast(int, cur.lastrowid)
+            if payload_id is not None:
+                self.conn.execute(QUERY_INSERT_SHARE, (id, payload_id))
+            self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+            ids.append(id)
+        return ids
+
+    def import_entry(self, entry: rpc.PostDbEntry, submitted_time: int) -> int:
+        cur = self.conn.execute(
+            QUERY_IMPORT_POST,
+            (
+                codec.encode(entry.post.SerializeToString()),
+                entry.post.scheduled_time,
+                POSTED if entry.status == rpc.PostStatus.POSTED else NOT_POSTED,
+                entry.error or None,
+            ),
+        )
+        id = cast(int, cur.lastrowid)
+        if entry.submission_id != "":
+            self.conn.execute(
+                QUERY_CONFIRM_SUBMISSION,
+                (id, submitted_time, entry.submission_id, entry.permalink or None),
+            )
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+        return id
+
+    def get(self, id: int) -> Optional[rpc.PostDbEntry]:
+        row = self.conn.execute(QUERY_SELECT, (id,)).fetchone()
+        return make_entry_from_row(row) if row is not None else None
+
+    def list(self) -> List[rpc.PostDbEntry]:
+        return self.entries(QUERY_ALL)
+
+    def page(self, after_id: int, limit: int) -> List[rpc.PostDbEntry]:
+        return self.entries(QUERY_PAGE, (after_id, limit))
+
+    def eligible(self, now: int) -> List[rpc.PostDbEntry]:
+        return self.entries(QUERY_ELIGIBLE, (now,))
+
+    def next_due(self, after: int) -> Optional[int]:
+        return self.conn.execute(QUERY_NEXT_DUE, (after,)).fetchone()[0]
+
+    def upcoming(self, until: int) -> List[rpc.PostDbEntry]:
+        return self.entries(QUERY_UPCOMING, (until,))
+
+    def unposted(self) -> List[rpc.PostDbEntry]:
+        return self.entries(QUERY_UNPOSTED)
+
+    def edit(self, id: int, post: rpc.Post):
+        row = self.conn.execute(QUERY_SELECT_PAYLOAD, (id,)).fetchone()
+        if row is not None:
+            if codec.decode(row["data"]) == post.data.SerializeToString():
+                # Keep sharing the data with the other targets
+                shared = rpc.Post()
+                shared.CopyFrom(post)
+                shared.ClearField("data")
+                post = shared
+            else:
+                self.conn.execute(QUERY_DELETE_UNSHARED_PAYLOAD, (id,))
+                self.conn.execute(QUERY_DELETE_SHARE, (id,))
+        self.conn.execute(
+            QUERY_REPLACE_POST,
+            (codec.encode(post.SerializeToString()), post.scheduled_time, id),
+        )
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+
+    def delete(self, id: int):
+        self.conn.execute(QUERY_DELETE, (id,))
+        self.conn.execute(QUERY_DELETE_SUBMISSION, (id,))
+        self.conn.execute(QUERY_DELETE_STATS, (id,))
+        self.conn.execute(QUERY_DELETE_JOBS, (id,))
+        self.conn.execute(QUERY_DELETE_UNSHARED_PAYLOAD, (id,))
+        self.conn.execute(QUERY_DELETE_SHARE, (id,))
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+
+    def mark_posted(self, id: int):
+        self.conn.execute(QUERY_MARK_POSTED, (id,))
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+
+    def mark_error(self, id: int, err: str):
+        self.conn.execute(QUERY_MARK_ERROR, (err, id))
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+
+    def mark_submitted(self, id: int, now: int):
+        self.conn.execute(QUERY_MARK_SUBMITTED, (id,))
+        self.conn.execute(QUERY_INSERT_SUBMISSION, (id, now, None))
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+
+    def submitted(self) -> List[Tuple[rpc.PostDbEntry, int]]:
+        return [
+            (make_entry_from_row(row), row["submitted_time"])
+            for row in self.conn.execute(QUERY_SUBMITTED)
+        ]
+
+    def confirm_submitted(
+        self, id: int, now: int, submission_id: str, permalink: Optional[str]
+    ):
+        self.conn.execute(QUERY_CONFIRM_SUBMISSION, (id, now, submission_id, permalink))
+        self.conn.execute(QUERY_MARK_POSTED, (id,))
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+
+    def fail_submitted(self, id: int, err: str):
+        self.conn.execute(QUERY_FAIL_SUBMISSION, (err, id))
+        self.conn.execute(QUERY_DELETE_SUBMISSION, (id,))
+        self.conn.execute(QUERY_RECORD_CHANGE, (id,))
+
+    def add_job(self, post_id: int, position: int, follow_up: rpc.FollowUp, due: int):
+        self.conn.execute(
+            QUERY_INSERT_JOB, (post_id, position, follow_up.SerializeToString(), due)
+        )
+
+    def due_jobs(self, now: int) -> List[ObjJob]:
+        return [
+            ObjJob(
+                row["id"],
+                row["post_id"],
+                row["submission_id"],
+                rpc.FollowUp.FromString(row["follow_up"]),
+            )
+            for row in self.conn.execute(QUERY_DUE_JOBS, (now,))
+        ]
+
+    def next_job(self, after: int) -> Optional[int]:
+        return self.conn.execute(QUERY_NEXT_JOB, (after,)).fetchone()[0]
+
+    def finish_job(self, job_id: int, now: int, err: str):
+        self.conn.execute(QUERY_FINISH_JOB, (now, err or None, job_id))
+
+    def stale_stats(
+        self, now: int, oldest: int, limit: int
+    ) -> List[Tuple[int, str, int]]:
+        rows = self.conn.execute(QUERY_STALE_STATS, (oldest, now, limit))
+        return [(row[0], row[1], row[2]) for row in rows]
+
+    def store_stats(self, obj: ObjStats):
+        s = obj.stats
+        if s is None:
+            self.conn.execute(QUERY_POSTPONE_STATS, (obj.id, obj.next_fetch_time))
+            return
         self.conn.execute(
-            QUERY_INSERT_POST,
+            QUERY_STORE_STATS,
             (
-                p.SerializeToString(),
-                p.scheduled_time,
-                0,
+                obj.id,
+                s.score,
+                s.num_comments,
+                s.upvote_ratio,
+                s.fetched_time,
+                obj.next_fetch_time,
             ),
         )
-        self.conn.commit()
-        return ""
+        self.conn.execute(QUERY_SET_PERMALINK, (obj.permalink, obj.id))
+        self.conn.execute(QUERY_RECORD_CHANGE, (obj.id,))
 
-    def edit_post(self, request: rpc.EditPostRequest):
-        if self.conn == None:
-            assert False
-        if not self.id_exists(request.id):
-            return ERR_UNKNOWN_ID % request.id
-        if request.operation == rpc.EditPostRequest.Operation.DELETE:
-            self.conn.execute(QUERY_DELETE, (request.id,))
-            self.conn.commit()
+    def stats(self, ids: List[int]) -> Dict[int, rpc.PostStats]:
+        if not ids:
+            rows = list(self.conn.execute(QUERY_ALL_STATS))
         else:
-            raise ValueError(f"unknown edit operation: {request.operation}")
+            ids = list(dict.fromkeys(ids))
+            rows = []
+            for i in range(0, len(ids), STATS_QUERY_SIZE):
+                chunk = ids[i : i + STATS_QUERY_SIZE]
+                query = QUERY_STATS_OF.format(", ".join("?" * len(chunk)))
+                rows += self.conn.execute(query, chunk)
+        return {row["post_id"]: make_stats_from_row(row) for row in rows}
+
+    def changes_since(self, seq: int) -> rpc.SyncPostsReply:
+        reply = rpc.SyncPostsReply(
+            seq=self.conn.execute(QUERY_LATEST_SEQ).fetchone()[0]
+        )
+        for row in self.conn.execute(QUERY_CHANGES_SINCE, (seq,)):
+            if row["id"] is None:
+                reply.deleted_ids.append(row["changed_id"])
+            else:
+                reply.posts.append(make_entry_from_row(row))
+        return reply
+
+    def find_idempotency_key(self, key: str) -> Optional[int]:
+        row = self.conn.execute(QUERY_SELECT_IDEMPOTENCY_KEY, (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_idempotency_key(self, key: str, post_id: int, now: int):
+        self.conn.execute(QUERY_INSERT_IDEMPOTENCY_KEY, (key, post_id, now))
+
+    def expire_idempotency_keys(self, before: int):
+        self.conn.execute(QUERY_DELETE_OLD_IDEMPOTENCY_KEYS, (before,))
+
+    def all_requirements(
+        self,
+    ) -> Dict[str, Tuple[rpc.SubredditRequirements, float]]:
+        return {
+            row["subreddit"]: (
+                rpc.SubredditRequirements.FromString(row["requirements"]),
+                row["fetched_time"],
+            )
+            for row in self.conn.execute(QUERY_ALL_REQUIREMENTS)
+        }
+
+    def store_requirements(
+        self, subreddit: str, reqs: rpc.SubredditRequirements, now: int
+    ):
+        self.conn.execute(
+            QUERY_STORE_REQUIREMENTS, (subreddit, reqs.SerializeToString(), now)
+        )
+
+
+class MemoryStorage(Storage):
+    """Keeps everything in memory, for simulations, benchmarks and tests that
+    don't need it to outlive the process.
+
+    Posts that weren't posted are kept sorted by (scheduled_time, id), pending
+    and failed ones apart, so finding due posts doesn't go through the whole
+    queue. Every target gets its own copy of the data. Changes apply right
+    away, so rollback() can't undo them.
+    """
+
+    def __init__(self):
+        self.entries: Dict[int, rpc.PostDbEntry] = {}
+        self.ids = itertools.count(1)
+        self.pending: List[Tuple[int, int]] = []
+        self.failed: List[Tuple[int, int]] = []
+        # Submitted time by id of posts sent to Reddit
+        self.submitted_times: Dict[int, int] = {}
+        # Next stats fetch by id of posts that had one scheduled
+        self.next_fetch_times: Dict[int, int] = {}
+        # Unfinished jobs by id, as (post_id, follow_up, due time)
+        self.jobs: Dict[int, Tuple[int, rpc.FollowUp, int]] = {}
+        self.job_ids = itertools.count(1)
+        # (post_id, position) of every job added, finished or not
+        self.job_positions: Set[Tuple[int, int]] = set()
+        # Latest change seq by post id. Changed posts move to the end, so this
+        # is ordered by seq.
+        self.changes: Dict[int, int] = {}
+        self.seq = 0
+        # (post_id, added time) by key, in the order they were added
+        self.idempotency_keys: Dict[str, Tuple[int, int]] = {}
+        self.requirements: Dict[str, Tuple[rpc.SubredditRequirements, float]] = {}
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def trace(self, callback: Optional[Callable[[str], None]]):
+        pass
+
+    def index_of(self, entry: rpc.PostDbEntry) -> Optional[List[Tuple[int, int]]]:
+        if entry.status == rpc.PostStatus.PENDING:
+            return self.pending
+        if entry.status == rpc.PostStatus.ERROR:
+            return self.failed
+        return None
+
+    def unindex(self, entry: rpc.PostDbEntry):
+        index = self.index_of(entry)
+        if index is not None:
+            key = (entry.post.scheduled_time, entry.id)
+            del index[bisect.bisect_left(index, key)]
+
+    def reindex(self, entry: rpc.PostDbEntry):
+        index = self.index_of(entry)
+        if index is not None:
+            bisect.insort(index, (entry.post.scheduled_time, entry.id))
+
+    def record_change(self, id: int):
+        self.seq += 1
+        self.changes.pop(id, None)
+        self.changes[id] = self.seq
+
+    def copy(self, entry: rpc.PostDbEntry) -> rpc.PostDbEntry:
+        # Callers are free to change what they get back
+        copy = rpc.PostDbEntry()
+        copy.CopyFrom(entry)
+        return copy
+
+    def insert(self, entry: rpc.PostDbEntry) -> int:
+        entry.id = next(self.ids)
+        self.entries[entry.id] = entry
+        self.reindex(entry)
+        self.record_change(entry.id)
+        return entry.id
+
+    def add(self, posts: List[rpc.Post]) -> List[int]:
+        return [
+            self.insert(rpc.PostDbEntry(post=post, status=rpc.PostStatus.PENDING))
+            for post in posts
+        ]
+
+    def import_entry(self, entry: rpc.PostDbEntry, submitted_time: int) -> int:
+        id = self.insert(
+            rpc.PostDbEntry(
+                post=entry.post,
+                status=entry.status,
+                error=entry.error,
+                submission_id=entry.submission_id,
+                permalink=entry.permalink,
+            )
+        )
+        if entry.submission_id != "":
+            self.submitted_times[id] = submitted_time
+        return id
+
+    def get(self, id: int) -> Optional[rpc.PostDbEntry]:
+        entry = self.entries.get(id)
+        return self.copy(entry) if entry is not None else None
+
+    def list(self) -> List[rpc.PostDbEntry]:
+        # Ids are increasing and dicts keep insertion order
+        return [self.copy(entry) for entry in self.entries.values()]
+
+    def page(self, after_id: int, limit: int) -> List[rpc.PostDbEntry]:
+        after = (e for e in self.entries.values() if e.id > after_id)
+        return [self.copy(entry) for entry in itertools.islice(after, limit)]
+
+    def eligible(self, now: int) -> List[rpc.PostDbEntry]:
+        ids = []
+        for index in [self.pending, self.failed]:
+            due = bisect.bisect_left(index, (now + 1,))
+            ids += [id for _, id in index[:due]]
+        return [self.copy(self.entries[id]) for id in sorted(ids)]
+
+    def next_due(self, after: int) -> Optional[int]:
+        i = bisect.bisect_left(self.pending, (after + 1,))
+        return self.pending[i][0] if i < len(self.pending) else None
+
+    def upcoming(self, until: int) -> List[rpc.PostDbEntry]:
+        due = bisect.bisect_left(self.pending, (until + 1,))
+        return [self.copy(self.entries[id]) for _, id in self.pending[:due]]
+
+    def unposted(self) -> List[rpc.PostDbEntry]:
+        ids = sorted(id for _, id in self.pending + self.failed)
+        return [self.copy(self.entries[id]) for id in ids]
+
+    def edit(self, id: int, post: rpc.Post):
+        entry = self.entries[id]
+        self.unindex(entry)
+        entry.post.CopyFrom(post)
+        if entry.status == rpc.PostStatus.ERROR:
+            entry.status = rpc.PostStatus.PENDING
+        entry.error = ""
+        self.reindex(entry)
+        self.record_change(id)
+
+    def delete(self, id: int):
+        entry = self.entries.pop(id, None)
+        if entry is not None:
+            self.unindex(entry)
+        self.submitted_times.pop(id, None)
+        self.next_fetch_times.pop(id, None)
+        for job_id, job in list(self.jobs.items()):
+            if job[0] == id:
+                del self.jobs[job_id]
+        self.job_positions = {p for p in self.job_positions if p[0] != id}
+        self.record_change(id)
+
+    def set_status(self, id: int, status: int, err: str = ""):
+        entry = self.entries[id]
+        self.unindex(entry)
+        entry.status = status
+        entry.error = err
+        self.reindex(entry)
+        self.record_change(id)
+
+    def mark_posted(self, id: int):
+        self.set_status(id, rpc.PostStatus.POSTED)
+
+    def mark_error(self, id: int, err: str):
+        self.set_status(id, rpc.PostStatus.ERROR, err)
+
+    def mark_submitted(self, id: int, now: int):
+        entry = self.entries[id]
+        entry.ClearField("submission_id")
+        entry.ClearField("permalink")
+        self.submitted_times[id] = now
+        self.set_status(id, rpc.PostStatus.SUBMITTED)
+
+    def submitted(self) -> List[Tuple[rpc.PostDbEntry, int]]:
+        submitted = [
+            (self.copy(entry), self.submitted_times[entry.id])
+            for entry in self.entries.values()
+            if entry.status == rpc.PostStatus.SUBMITTED
+        ]
+        return sorted(submitted, key=lambda s: s[1])
+
+    def confirm_submitted(
+        self, id: int, now: int, submission_id: str, permalink: Optional[str]
+    ):
+        entry = self.entries[id]
+        self.submitted_times.setdefault(id, now)
+        entry.submission_id = submission_id or ""
+        if permalink:
+            entry.permalink = permalink
+        self.set_status(id, rpc.PostStatus.POSTED)
+
+    def fail_submitted(self, id: int, err: str):
+        entry = self.entries[id]
+        entry.ClearField("submission_id")
+        entry.ClearField("permalink")
+        self.submitted_times.pop(id, None)
+        self.set_status(id, rpc.PostStatus.ERROR, err)
+
+    def add_job(self, post_id: int, position: int, follow_up: rpc.FollowUp, due: int):
+        if (post_id, position) in self.job_positions:
+            return
+        self.job_positions.add((post_id, position))
+        copy = rpc.FollowUp()
+        copy.CopyFrom(follow_up)
+        self.jobs[next(self.job_ids)] = (post_id, copy, due)
+
+    def due_jobs(self, now: int) -> List[ObjJob]:
+        due = [
+            (job[2], job_id, job[0], job[1])
+            for job_id, job in self.jobs.items()
+            if job[2] <= now and job[0] in self.submitted_times
+        ]
+        return [
+            ObjJob(
+                job_id,
+                post_id,
+                self.entries[post_id].submission_id or None,
+                follow_up,
+            )
+            for _, job_id, post_id, follow_up in sorted(due, key=lambda j: j[:2])
+        ]
+
+    def next_job(self, after: int) -> Optional[int]:
+        return min(
+            (job[2] for job in self.jobs.values() if job[2] > after), default=None
+        )
+
+    def finish_job(self, job_id: int, now: int, err: str):
+        self.jobs.pop(job_id, None)
+
+    def stale_stats(
+        self, now: int, oldest: int, limit: int
+    ) -> List[Tuple[int, str, int]]:
+        stale = [
+            (self.next_fetch_times.get(id, 0), id)
+            for id, submitted_time in self.submitted_times.items()
+            if self.entries[id].status == rpc.PostStatus.POSTED
+            and self.entries[id].submission_id != ""
+            and submitted_time > oldest
+            and self.next_fetch_times.get(id, 0) <= now
+        ]
+        return [
+            (id, self.entries[id].submission_id, self.submitted_times[id])
+            for _, id in sorted(stale)[:limit]
+        ]
+
+    def store_stats(self, obj: ObjStats):
+        entry = self.entries.get(obj.id)
+        if entry is None:
+            return
+        self.next_fetch_times[obj.id] = obj.next_fetch_time
+        if obj.stats is None:
+            return
+        entry.stats.CopyFrom(obj.stats)
+        if obj.id in self.submitted_times:
+            entry.permalink = obj.permalink
+        self.record_change(obj.id)
+
+    def stats(self, ids: List[int]) -> Dict[int, rpc.PostStats]:
+        entries = (
+            [self.entries[id] for id in ids if id in self.entries]
+            if ids
+            else self.entries.values()
+        )
+        stats = {}
+        for entry in entries:
+            if entry.HasField("stats"):
+                stats[entry.id] = rpc.PostStats()
+                stats[entry.id].CopyFrom(entry.stats)
+        return stats
+
+    def changes_since(self, seq: int) -> rpc.SyncPostsReply:
+        reply = rpc.SyncPostsReply(seq=self.seq)
+        for id, changed in self.changes.items():
+            if changed <= seq:
+                continue
+            if id in self.entries:
+                reply.posts.append(self.entries[id])
+            else:
+                reply.deleted_ids.append(id)
+        return reply
+
+    def find_idempotency_key(self, key: str) -> Optional[int]:
+        found = self.idempotency_keys.get(key)
+        return found[0] if found is not None else None
+
+    def add_idempotency_key(self, key: str, post_id: int, now: int):
+        self.idempotency_keys[key] = (post_id, now)
+
+    def expire_idempotency_keys(self, before: int):
+        # Keys are added as time goes on, so the oldest come first
+        while self.idempotency_keys:
+            key, (_, added) = next(iter(self.idempotency_keys.items()))
+            if added >= before:
+                break
+            del self.idempotency_keys[key]
+
+    def all_requirements(
+        self,
+    ) -> Dict[str, Tuple[rpc.SubredditRequirements, float]]:
+        return dict(self.requirements)
+
+    def store_requirements(
+        self, subreddit: str, reqs: rpc.SubredditRequirements, now: int
+    ):
+        copy = rpc.SubredditRequirements()
+        copy.CopyFrom(reqs)
+        self.requirements[subreddit] = (copy, now)
+
+
+class SlotIndex:
+    """Scheduled times of the posts waiting to go up, by subreddit, for spacing
+    out posts to the same subreddit.
+
+    The times of every subreddit are kept sorted, so finding the posts near a
+    time is a binary search however many posts are queued.
+    """
+
+    def __init__(self):
+        # (scheduled_time, id) by lowercase subreddit
+        self.times: Dict[str, List[Tuple[int, int]]] = {}
+        # (lowercase subreddit, scheduled_time) by id
+        self.slots: Dict[int, Tuple[str, int]] = {}
+
+    def add(self, id: int, subreddit: str, scheduled_time: int):
+        """Adds the post, or moves it if it's already in the index."""
+        self.remove(id)
+        subreddit = subreddit.lower()
+        bisect.insort(self.times.setdefault(subreddit, []), (scheduled_time, id))
+        self.slots[id] = (subreddit, scheduled_time)
+
+    def remove(self, id: int):
+        slot = self.slots.pop(id, None)
+        if slot is None:
+            return
+        times = self.times[slot[0]]
+        del times[bisect.bisect_left(times, (slot[1], id))]
+
+    def conflict(self, subreddit: str, t: int, spacing: int) -> Optional[int]:
+        """Time of the earliest post to the subreddit less than `spacing` seconds
+        away from t, if there is one."""
+        times = self.times.get(subreddit.lower(), [])
+        i = bisect.bisect_left(times, (t - spacing + 1,))
+        if i < len(times) and times[i][0] < t + spacing:
+            return times[i][0]
+        return None
+
+    def earliest(
+        self, slots: List[Tuple[str, int]], start: int, until: float, spacing: int
+    ) -> Optional[int]:
+        """Earliest time from start to until at which none of the (subreddit,
+        delay) slots conflicts with another post, or None if there is none.
+
+        Every conflict moves the time past the post it conflicts with, so this
+        takes as many binary searches as there are posts in the way.
+        """
+        t = start
+        while t <= until:
+            moved = False
+            for subreddit, delay in slots:
+                other = self.conflict(subreddit, t + delay, spacing)
+                if other is not None:
+                    t = other + spacing - delay
+                    moved = True
+            if not moved:
+                return t
+        return None
+
+
+class Database:
+    """Wraps a Storage and provides an async channel for operations on it."""
+
+    def __init__(
+        self,
+        storage: Storage,
+        clock: Optional[Clock] = None,
+        spacing: int = POST_SPACING,
+    ):
+        # Opened in start() so that it's only used from the database thread
+        self.storage = storage
+        self.clock = clock or Clock()
+        # Seconds between posts to a subreddit, below which scheduling warns
+        self.spacing = spacing
+        self.queue = queue.PriorityQueue(DB_QUEUE_SIZE)
+        # Breaks priority ties so commands of equal priority stay FIFO
+        self.counter = itertools.count()
+        # Moving average of how long a command takes, used for retry hints
+        self.avg_command_time = 0.001
+        # Watchers are added and removed from RPC threads
+        self.watchers: List[Watcher] = []
+        self.watchers_lock = threading.Lock()
+        # Subreddit rules by lowercase name along with when they were fetched.
+        # Only touched from the database thread.
+        self.requirements: Dict[str, Tuple[rpc.SubredditRequirements, float]] = {}
+        # Subreddits whose rules should be (re)fetched by the RequirementsFetcher
+        self.requirements_requests = Queue()  # type: Queue[str]
+        self.requirements_requested: Dict[str, float] = {}
+        # Built from the queue when first needed, see slot_index()
+        self.slots: Optional[SlotIndex] = None
+
+    def add_watcher(self) -> Watcher:
+        watcher = Watcher()
+        with self.watchers_lock:
+            self.watchers.append(watcher)
+        return watcher
+
+    def remove_watcher(self, watcher: Watcher):
+        with self.watchers_lock:
+            if watcher in self.watchers:
+                self.watchers.remove(watcher)
+
+    def notify_watchers(self, entry: rpc.PostDbEntry):
+        with self.watchers_lock:
+            for watcher in list(self.watchers):
+                try:
+                    watcher.events.put_nowait(entry)
+                except queue.Full:
+                    log.warning("Dropping watcher that fell behind")
+                    watcher.dropped = True
+                    self.watchers.remove(watcher)
+
+    def has_watchers(self) -> bool:
+        with self.watchers_lock:
+            return len(self.watchers) != 0
+
+    def queue_command(self, command: DbCommand):
+        """Queue a command to be handled by the db later.
+
+        Raises DbOverloaded right away if the queue is too full for the command's
+        priority. High priority commands instead block until the command's time
+        runs out.
+        """
+        log.debug("Database queued command: %s", command)
+        if tracer.enabled:
+            command.trace_id = command.trace_id or new_trace_id()
+            command.queued_time = time.time()
+        limit = ADMISSION_LIMITS[command.priority] * DB_QUEUE_SIZE
+        if command.priority != PRIORITY_HIGH and self.queue.qsize() >= limit:
+            raise DbOverloaded(self.retry_after())
+        item = (command.priority, next(self.counter), command)
+        try:
+            self.queue.put(item, timeout=command.time_left())
+        except queue.Full:
+            raise DbOverloaded(self.retry_after())
+
+    def retry_after(self) -> float:
+        """Estimates how long it will take to drain the current queue."""
+        return max(MIN_RETRY_AFTER, self.queue.qsize() * self.avg_command_time)
+
+    def start(self):
+        self.initialize()
+        self.handle_commands()
+
+    def initialize(self):
+        self.storage.open()
+        self.requirements = self.storage.all_requirements()
+
+    def step(self) -> bool:
+        entry: DbCommand = self.queue.get()[2]
+        if entry.is_abandoned():
+            log.debug("Database dropping abandoned command: %s", entry)
+            entry.reply_err(ERR_ABANDONED)
+            return True
+        log.debug("Database handling command: %s", entry)
+        start = time.monotonic()
+        if tracer.enabled and entry.queued_time:
+            now = time.time()
+            tracer.record(
+                entry.trace_id,
+                "queue_wait",
+                entry.queued_time,
+                now,
+                command=entry.command,
+            )
+            with tracer.span(entry.trace_id, "sql", command=entry.command):
+                running = self.handle_command(entry)
+        else:
+            running = self.handle_command(entry)
+        elapsed = time.monotonic() - start
+        self.avg_command_time = 0.9 * self.avg_command_time + 0.1 * elapsed
+        return running
+
+    def handle_command(self, entry: DbCommand) -> bool:
+        command = entry.command
+        if command == "quit":
+            log.debug("Stopping database")
+            self.storage.close()
+            return False
+        elif command == "ingest":
+            try:
+                entry.reply_ok(self.ingest_posts(entry.obj))
+            except:
+                log.exception("Failed to insert batch of %d posts", len(entry.obj))
+                self.storage.rollback()
+                self.slots = None
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "schedule":
+            try:
+                entry.reply_ok(self.schedule_posts(entry.obj))
+            except:
+                log.exception("Failed to schedule batch of %d posts", len(entry.obj))
+                self.storage.rollback()
+                self.slots = None
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "eligible":
+            try:
+                entry.reply_ok(self.storage.eligible(int(self.clock.time())))
+            except:
+                log.exception("Failed to get eligible posts")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "all":
+            try:
+                entry.reply_ok(self.storage.list())
+            except:
+                log.exception("Failed to get all posts")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "sync":
+            try:
+                reply = self.sync_posts(entry.obj)
+                entry.reply_ok(reply)
+            except:
+                log.exception("Failed to sync posts since %d", entry.obj)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "next_due":
+            try:
+                entry.reply_ok(self.next_due(entry.obj))
+            except:
+                log.exception("Failed to get next due post")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "upcoming":
+            try:
+                entry.reply_ok(self.upcoming(entry.obj))
+            except:
+                log.exception("Failed to get posts due before %d", entry.obj)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "page":
+            try:
+                page = self.get_page(entry.obj)
+                entry.reply_ok(page)
+            except:
+                log.exception("Failed to get page of posts after id %d", entry.obj)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "import":
+            try:
+                imported = self.import_posts(entry.obj)
+                entry.reply_ok(imported)
+            except:
+                log.exception("Failed to import %d posts", len(entry.obj))
+                self.storage.rollback()
+                self.slots = None
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "edit":
+            try:
+                msg = self.edit_post(entry.obj)
+                entry.reply(msg, msg != "")
+            except:
+                log.exception("Failed to edit post")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "mark_posted":
+            try:
+                msg = self.mark_posted(entry.obj)
+                entry.reply(msg, msg != "")
+            except:
+                log.exception("Failed to mark post with id %d as posted", entry.obj)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "mark_error":
+            obj = cast(ObjMarkError, entry.obj)
+            try:
+                msg = self.mark_error(obj.id, obj.err)
+                entry.reply(msg, msg != "")
+            except:
+                log.exception(
+                    "Failed to mark post with id %d as error %s",
+                    obj.id,
+                    obj.err,
+                )
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "mark_submitted":
+            try:
+                msg = self.mark_submitted(entry.obj)
+                entry.reply(msg, msg != "")
+            except:
+                log.exception("Failed to mark post with id %d as submitted", entry.obj)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "submitted":
+            try:
+                entry.reply_ok(self.get_submitted())
+            except:
+                log.exception("Failed to get submitted posts")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "confirm_submitted":
+            obj = cast(ObjSubmission, entry.obj)
+            try:
+                msg = self.confirm_submitted(obj.id, obj.submission_id, obj.permalink)
+                entry.reply(msg, msg != "")
+            except:
+                log.exception("Failed to confirm submission of post with id %d", obj.id)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "due_jobs":
+            try:
+                entry.reply_ok(self.due_jobs(entry.obj))
+            except:
+                log.exception("Failed to get due follow-ups")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "next_job":
+            try:
+                entry.reply_ok(self.next_job(entry.obj))
+            except:
+                log.exception("Failed to get next due follow-up")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "finish_job":
+            obj = cast(ObjJobResult, entry.obj)
+            try:
+                msg = self.finish_job(obj.id, obj.err)
+                entry.reply(msg, msg != "")
+            except:
+                log.exception("Failed to finish follow-up with id %d", obj.id)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "fail_submitted":
+            obj = cast(ObjMarkError, entry.obj)
+            try:
+                msg = self.fail_submitted(obj.id, obj.err)
+                entry.reply(msg, msg != "")
+            except:
+                log.exception("Failed to mark submission of post %d as failed", obj.id)
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "stale_stats":
+            try:
+                entry.reply_ok(self.get_stale_stats(entry.obj))
+            except:
+                log.exception("Failed to get posts with stale stats")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "store_stats":
+            try:
+                entry.reply_ok(self.store_stats(entry.obj))
+            except:
+                log.exception("Failed to store post stats")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "stats":
+            try:
+                entry.reply_ok(self.get_stats(entry.obj))
+            except:
+                log.exception("Failed to get post stats")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "time_statements":
+            try:
+                self.time_statements(entry.obj)
+                entry.reply_ok("")
+            except:
+                log.exception("Failed to change statement timing")
+                entry.reply_err(ERR_INTERNAL)
+        elif command == "requirements":
+            obj = cast(ObjRequirements, entry.obj)
+            try:
+                self.store_requirements(obj.subreddit, obj.reqs)
+                entry.reply_ok(None)
+            except:
+                log.exception("Failed to store requirements for r/%s", obj.subreddit)
+                entry.reply_err(ERR_INTERNAL)
+        return True
+
+    def handle_commands(self):
+        while self.step():
+            pass
+
+    def time_statements(self, timer: Optional[StatementTimer]):
+        """Times the statements of the following commands with timer, or stops
+        timing them if it's None."""
+        if timer is None:
+            self.storage.trace(None)
+            # Back to the unwrapped step
+            vars(self).pop("step", None)
+            return
+        self.storage.trace(timer.trace)
+
+        def step() -> bool:
+            running = Database.step(self)
+            timer.finish()
+            return running
+
+        self.step = step
+
+    def get_entry(self, id: int) -> Optional[rpc.PostDbEntry]:
+        return self.storage.get(id)
+
+    def notify_watchers_of(self, id: int):
+        """Sends the current state of the post to watchers, if there are any."""
+        if not self.has_watchers():
+            return
+        entry = self.get_entry(id)
+        if entry is not None:
+            self.notify_watchers(entry)
+
+    def insert_post(self, p: rpc.Post) -> Tuple[List[int], str, str]:
+        """Inserts the post, one row per target, without committing.
+
+        Auto scheduled posts are moved to the earliest free slot first, which
+        is written back into p. Returns the new ids, why the post was rejected
+        and a warning if it's too close to other posts to the same subreddits.
+        Nothing is written for rejected posts, nor for posts whose idempotency
+        key was already used, which are reported as scheduled.
+        """
+        key = p.idempotency_key
+        if key != "" and self.already_scheduled(p):
+            return [], "", ""
+        if p.HasField("auto_schedule"):
+            msg = self.allocate_slot(p)
+            if msg != "":
+                return [], msg, ""
+        posts = split_targets(p)
+        for post in posts:
+            if post.subreddit == "":
+                return [], "invalid post, client should not have sent this", ""
+            msg = check_follow_ups(post) or self.check_subreddit_requirements(post)
+            if msg != "":
+                return [], msg, ""
+        slots = self.slot_index()
+        warning = ""
+        for post in posts:
+            other = slots.conflict(post.subreddit, post.scheduled_time, self.spacing)
+            if other is not None and warning == "":
+                warning = (
+                    f"Another post to r/{post.subreddit} is scheduled "
+                    f"{abs(other - post.scheduled_time) / 60:.0f} minutes away, "
+                    f"Reddit may rate limit it or flag it as spam."
+                )
+        for post in posts:
+            post.ClearField("idempotency_key")
+        ids = self.storage.add(posts)
+        for id, post in zip(ids, posts):
+            slots.add(id, post.subreddit, post.scheduled_time)
+        if key != "":
+            self.record_idempotency_key(key, ids[0])
+        return ids, "", warning
+
+    def already_scheduled(self, p: rpc.Post) -> bool:
+        """Whether a post with the idempotency key of p was scheduled before. If
+        so, p gets the scheduled time of that post."""
+        id = self.storage.find_idempotency_key(p.idempotency_key)
+        if id is None:
+            return False
+        log.info("Post with id %d was already scheduled, not adding it again", id)
+        entry = self.storage.get(id)
+        if entry is not None:
+            p.scheduled_time = entry.post.scheduled_time
+        p.ClearField("auto_schedule")
+        return True
+
+    def record_idempotency_key(self, key: str, post_id: int):
+        """Remembers the key of a new post, without committing. Keys are
+        forgotten after IDEMPOTENCY_KEY_TTL, long before a client retries."""
+        now = int(self.clock.time())
+        self.storage.expire_idempotency_keys(now - IDEMPOTENCY_KEY_TTL)
+        self.storage.add_idempotency_key(key, post_id, now)
+
+    def allocate_slot(self, p: rpc.Post) -> str:
+        """Schedules the post and its targets at the earliest time in the
+        post's auto_schedule window at which they are all spaced out from other
+        posts to their subreddits. Returns why there is no such time, or ""."""
+        auto = p.auto_schedule
+        spacing = auto.spacing or self.spacing
+        start = max(p.scheduled_time, int(self.clock.time()))
+        until = auto.until or math.inf
+        slots = [(p.subreddit, 0)] + [(t.subreddit, t.delay) for t in p.targets]
+        t = self.slot_index().earliest(slots, start, until, spacing)
+        if t is None:
+            return (
+                f"No time before {time.strftime('%m/%d %H:%M', time.localtime(until))} "
+                f"is {spacing / 60:.0f} minutes away from other posts to the same "
+                "subreddits."
+            )
+        p.scheduled_time = t
+        p.ClearField("auto_schedule")
+        return ""
+
+    def slot_index(self) -> SlotIndex:
+        """The posts waiting to go up, indexed the first time they're needed."""
+        if self.slots is None:
+            self.slots = SlotIndex()
+            for entry in self.storage.unposted():
+                self.slots.add(
+                    entry.id, entry.post.subreddit, entry.post.scheduled_time
+                )
+        return self.slots
+
+    def unslot(self, id: int):
+        """Takes a post that went up or was deleted out of the SlotIndex."""
+        if self.slots is not None:
+            self.slots.remove(id)
+
+    def reslot(self, id: int, post: rpc.Post):
+        """Moves an edited post in the SlotIndex."""
+        if self.slots is not None:
+            self.slots.add(id, post.subreddit, post.scheduled_time)
+
+    def ingest_posts(self, posts: List[rpc.Post]) -> List[str]:
+        """Inserts a batch of posts in a single transaction.
+
+        Returns why each post was rejected, or "" for posts that were inserted.
+        """
+        return [reply.error_msg for reply in self.schedule_posts(posts)]
+
+    def schedule_posts(self, posts: List[rpc.Post]) -> List[rpc.SchedulePostReply]:
+        """Inserts a batch of posts in a single transaction.
+
+        Returns a reply for each post saying when it was scheduled, or why it
+        was rejected.
+        """
+        replies = []
+        ids = []
+        for p in posts:
+            if not validate_post(p):
+                replies.append(
+                    rpc.SchedulePostReply(
+                        error_msg="post is missing a title, subreddit or scheduled time"
+                    )
+                )
+                continue
+            new_ids, msg, warning = self.insert_post(p)
+            if msg != "":
+                replies.append(rpc.SchedulePostReply(error_msg=msg))
+            else:
+                replies.append(
+                    rpc.SchedulePostReply(
+                        scheduled_time=p.scheduled_time, warning=warning
+                    )
+                )
+            ids.extend(new_ids)
+        self.storage.commit()
+        for id in ids:
+            self.notify_watchers_of(id)
+        return replies
+
+    def import_posts(self, entries: List[rpc.PostDbEntry]) -> int:
+        """Inserts exported posts in a single transaction. Invalid ones are skipped.
+
+        Posts that were sent to Reddit, SUBMITTED ones and any with a
+        submission id included, come back as posted along with their
+        submission, so they're never posted again. Returns the number of posts
+        inserted.
+        """
+        ids = []
+        for e in entries:
+            if not validate_post(e.post) or e.status not in IMPORTABLE_STATUSES:
+                continue
+            imported = rpc.PostDbEntry(
+                post=e.post,
+                status=rpc.PostStatus.PENDING,
+                submission_id=e.submission_id,
+                permalink=e.permalink,
+            )
+            if e.status in SENT_STATUSES or e.submission_id != "":
+                imported.status = rpc.PostStatus.POSTED
+            elif e.status == rpc.PostStatus.ERROR:
+                imported.status = rpc.PostStatus.ERROR
+                imported.error = e.error
+            ids.append(self.storage.import_entry(imported, e.post.scheduled_time))
+        self.storage.commit()
+        self.slots = None
+        for id in ids:
+            self.notify_watchers_of(id)
+        return len(ids)
+
+    def check_subreddit_requirements(self, p: rpc.Post) -> str:
+        """Checks the post against the cached rules of its subreddit.
+
+        Unknown or stale rules are requested from the RequirementsFetcher in the
+        background. Posts to subreddits with unknown rules are let through.
+        """
+        subreddit = p.subreddit.lower()
+        cached = self.requirements.get(subreddit)
+        now = self.clock.time()
+        if cached is None or now - cached[1] > REQUIREMENTS_TTL:
+            requested = self.requirements_requested.get(subreddit)
+            if requested is None or now - requested > REQUIREMENTS_RETRY:
+                self.requirements_requested[subreddit] = now
+                self.requirements_requests.put_nowait(subreddit)
+        if cached is None:
+            return ""
+        return check_requirements(p, cached[0])
+
+    def store_requirements(self, subreddit: str, reqs: rpc.SubredditRequirements):
+        subreddit = subreddit.lower()
+        now = int(self.clock.time())
+        self.storage.store_requirements(subreddit, reqs, now)
+        self.storage.commit()
+        self.requirements[subreddit] = (reqs, now)
+        self.requirements_requested.pop(subreddit, None)
+
+    def edit_post(self, request: rpc.EditPostRequest):
+        deleted = self.storage.get(request.id)
+        if deleted is None:
+            return ERR_UNKNOWN_ID % request.id
+        if request.operation == rpc.EditPostRequest.Operation.DELETE:
+            self.storage.delete(request.id)
+            self.storage.commit()
+            self.unslot(request.id)
+            if self.has_watchers():
+                deleted.status = rpc.PostStatus.DELETED
+                self.notify_watchers(deleted)
+        elif request.operation == rpc.EditPostRequest.Operation.RESCHEDULE:
+            return self.reschedule_posts(request)
+        elif request.operation == rpc.EditPostRequest.Operation.UPDATE:
+            return self.update_post(request)
+        else:
+            raise ValueError(f"unknown edit operation: {request.operation}")
+        return ""
+
+    def get_unposted(self, id: int) -> Tuple[Optional[rpc.PostDbEntry], str]:
+        """A post that can still be edited, or why it can't."""
+        entry = self.storage.get(id)
+        if entry is None:
+            return None, ERR_UNKNOWN_ID % id
+        if entry.status not in [rpc.PostStatus.PENDING, rpc.PostStatus.ERROR]:
+            return None, ERR_ALREADY_POSTED % id
+        return entry, ""
+
+    def reschedule_posts(self, request: rpc.EditPostRequest):
+        """Moves every post in the request, or none of them if one can't be.
+
+        Clears errors, so posts that failed are retried at their new time.
+        """
+        updates = []
+        for id in [request.id] + list(request.ids):
+            entry, msg = self.get_unposted(id)
+            if entry is None:
+                return msg
+            post = entry.post
+            if request.scheduled_time != 0:
+                post.scheduled_time = request.scheduled_time
+            elif post.scheduled_time + request.offset > 0:
+                post.scheduled_time += request.offset
+            else:
+                return f"Post with id {id} can't be moved before 1970."
+            updates.append((id, post))
+        for id, post in updates:
+            self.storage.edit(id, post)
+            self.reslot(id, post)
+        self.storage.commit()
+        for id, _ in updates:
+            self.notify_watchers_of(id)
+        return ""
+
+    def update_post(self, request: rpc.EditPostRequest):
+        """Patches the fields in the request's update_mask.
+
+        Changing the data of a post that shares it with other targets gives the
+        post its own copy.
+        """
+        entry, msg = self.get_unposted(request.id)
+        if entry is None:
+            return msg
+        paths = list(request.update_mask.paths)
+        if len(paths) == 0:
+            return "Nothing to update, update_mask is empty."
+        post = entry.post
+        for path in paths:
+            if path not in EDITABLE_FIELDS:
+                return ERR_UNEDITABLE_FIELD % (path, ", ".join(EDITABLE_FIELDS))
+            parts = path.split(".")
+            if parts[0] == "data" and parts[1] != post_type(post):
+                return ERR_WRONG_POST_TYPE % (request.id, path)
+        request.update_mask.MergeMessage(request.post, post)
+        if not validate_post(post):
+            return "invalid post, client should not have sent this"
+        msg = self.check_subreddit_requirements(post)
+        if msg != "":
+            return msg
+        self.storage.edit(request.id, post)
+        self.reslot(request.id, post)
+        self.storage.commit()
+        self.notify_watchers_of(request.id)
+        return ""
+
+    def mark_posted(self, post_id: int):
+        self.storage.mark_posted(post_id)
+        self.storage.commit()
+        self.unslot(post_id)
+        self.notify_watchers_of(post_id)
+        return ""
+
+    def mark_error(self, post_id: int, err: str):
+        self.storage.mark_error(post_id, err)
+        self.storage.commit()
+        self.notify_watchers_of(post_id)
+        return ""
+
+    def sync_posts(self, since_seq: int) -> rpc.SyncPostsReply:
+        return self.storage.changes_since(since_seq)
+
+    def next_due(self, after: int = 0) -> Optional[int]:
+        """Scheduled time of the next post waiting to be posted after `after`."""
+        return self.storage.next_due(after)
+
+    def upcoming(self, until: int) -> List[rpc.PostDbEntry]:
+        """Posts waiting to be posted that are due by `until`."""
+        return self.storage.upcoming(until)
+
+    def get_page(self, after_id: int) -> List[rpc.PostDbEntry]:
+        return self.storage.page(after_id, EXPORT_PAGE_SIZE)
+
+    def mark_submitted(self, post_id: int):
+        self.storage.mark_submitted(post_id, int(self.clock.time()))
+        self.storage.commit()
+        self.unslot(post_id)
+        self.notify_watchers_of(post_id)
+        return ""
+
+    def get_submitted(self) -> List[Tuple[rpc.PostDbEntry, int]]:
+        """SUBMITTED posts along with when they were submitted, oldest first."""
+        return self.storage.submitted()
+
+    def confirm_submitted(self, post_id: int, submission_id: str, permalink: str):
+        """Marks the post as posted as the given reddit submission."""
+        self.storage.confirm_submitted(
+            post_id, int(self.clock.time()), submission_id, permalink
+        )
+        self.schedule_follow_ups(post_id)
+        self.storage.commit()
+        self.notify_watchers_of(post_id)
+        return ""
+
+    def schedule_follow_ups(self, post_id: int):
+        """Creates a job for each follow-up of the post, due `delay` seconds from
+        now. Doesn't commit."""
+        entry = self.storage.get(post_id)
+        if entry is None:
+            return
+        now = int(self.clock.time())
+        for position, follow_up in enumerate(entry.post.follow_ups):
+            self.storage.add_job(post_id, position, follow_up, now + follow_up.delay)
+
+    def due_jobs(self, now: int) -> List[ObjJob]:
+        return self.storage.due_jobs(now)
+
+    def next_job(self, after: int) -> Optional[int]:
+        """When the next follow-up due after `after` is due."""
+        return self.storage.next_job(after)
+
+    def finish_job(self, job_id: int, err: str):
+        self.storage.finish_job(job_id, int(self.clock.time()), err)
+        self.storage.commit()
+        return ""
+
+    def fail_submitted(self, post_id: int, err: str):
+        self.storage.fail_submitted(post_id, err)
+        self.storage.commit()
+        # Waiting to go up again, rare enough to rebuild the index for
+        self.slots = None
+        self.notify_watchers_of(post_id)
+        return ""
+
+    def get_stale_stats(self, now: int) -> List[Tuple[int, str, int]]:
+        """Posts whose stats need a refresh, as (id, submission id, submitted time).
+
+        Longest overdue first, and no more than fit in STATS_MAX_BATCHES info
+        requests.
+        """
+        limit = STATS_BATCH_SIZE * STATS_MAX_BATCHES
+        return self.storage.stale_stats(now, now - STATS_MAX_AGE, limit)
+
+    def store_stats(self, stats: List[ObjStats]):
+        """Stores fetched stats. Clients see them on their next sync, but
+        watchers aren't notified since the status of the posts didn't change."""
+        for obj in stats:
+            self.storage.store_stats(obj)
+        self.storage.commit()
+        return ""
+
+    def get_stats(self, ids: List[int]) -> Dict[int, rpc.PostStats]:
+        """Stats by post id of the given posts, or of all posts if ids is empty."""
+        return self.storage.stats(ids)
+
+
+class Servicer(reddit_grpc.RedditSchedulerServicer):
+    """Implementation of grpc service which responds to client requests."""
+
+    compression = grpc.Compression.NoCompression
+    compression_threshold = COMPRESSION_THRESHOLD * 1024
+
+    def ListPosts(self, request, context):
+        reply = self.database_op(
+            DbCommand("all", None, PRIORITY_LOW),
+            context,
+            "ListPosts",
+            request,
+            lambda msg, obj: rpc.ListPostsReply(error_msg=msg, posts=obj),
+        )
+        return self.compress_large(context, reply)
+
+    def SyncPosts(self, request, context):
+        reply = self.database_op(
+            DbCommand("sync", request.since_seq, PRIORITY_LOW),
+            context,
+            "SyncPosts",
+            request,
+            lambda msg, obj: rpc.SyncPostsReply(error_msg=msg) if msg else obj,
+        )
+        return self.compress_large(context, reply)
+
+    def ExportPosts(self, request, context):
+        # Exports are large by nature, so they're compressed regardless of size
+        if self.compression != grpc.Compression.NoCompression:
+            context.set_compression(self.compression)
+        commands = RpcCommands(context)
+        after_id = 0
+        while True:
+            msg, page = self.database_op(
+                DbCommand("page", after_id, PRIORITY_LOW),
+                context,
+                "ExportPosts",
+                request,
+                lambda msg, obj: (msg, obj),
+                commands,
+            )
+            if msg:
+                context.abort(grpc.StatusCode.INTERNAL, msg)
+            yield from page
+            if len(page) < EXPORT_PAGE_SIZE:
+                return
+            after_id = page[-1].id
+
+    def ImportPosts(self, request_iterator, context):
+        reply = rpc.ImportPostsReply()
+        batch: List[rpc.PostDbEntry] = []
+        commands = RpcCommands(context)
+
+        def flush() -> str:
+            msg, imported = self.database_op(
+                DbCommand("import", batch),
+                context,
+                "ImportPosts",
+                len(batch),
+                lambda msg, obj: (msg, obj),
+                commands,
+            )
+            if not msg:
+                reply.imported += imported
+                reply.skipped += len(batch) - imported
+            return msg
+
+        for entry in request_iterator:
+            batch.append(entry)
+            if len(batch) == IMPORT_BATCH_SIZE:
+                reply.error_msg = flush()
+                if reply.error_msg:
+                    return reply
+                batch = []
+        if batch:
+            reply.error_msg = flush()
+        return reply
+
+    def GetStats(self, request, context):
+        return self.database_op(
+            DbCommand("stats", list(request.ids), PRIORITY_LOW),
+            context,
+            "GetStats",
+            request,
+            lambda msg, obj: rpc.GetStatsReply(
+                error_msg=msg, stats=None if msg else obj
+            ),
+        )
+
+    def Profile(self, request, context):
+        log.debug("Got Profile RPC")
+        if not Profiler.running.acquire(blocking=False):
+            return rpc.ProfileReply(error_msg=ERR_PROFILE_RUNNING)
+        try:
+            count = request.count or PROFILE_COUNT
+            if request.target == rpc.ProfileRequest.POSTER_STEP:
+                profiler = Profiler(self.poster, "step", count)
+            else:
+                profiler = Profiler(self, "database_op", count)
+            timer = StatementTimer()
+            if query_database(self.db, "time_statements", timer) is None:
+                return rpc.ProfileReply(error_msg=ERR_INTERNAL)
+            profiler.start()
+            try:
+                timeout = request.timeout or PROFILE_TIMEOUT
+                remaining = context.time_remaining()
+                if remaining is not None:
+                    # Leave time to send the results
+                    timeout = min(timeout, remaining - 1)
+                profiler.done.wait(timeout)
+                reply = profiler.stop(
+                    request.top_allocations or PROFILE_TOP_ALLOCATIONS
+                )
+            finally:
+                query_database(self.db, "time_statements", None)
+            reply.statements.extend(timer.results())
+            return reply
+        finally:
+            Profiler.running.release()
+
+    def GetHealth(self, request, _):
+        log.debug("Got GetHealth RPC")
+        return rpc.GetHealthReply(
+            poster_stalled=self.poster.stalled(),
+            hung_post_ids=self.poster.hung_post_ids(),
+        )
+
+    def ListFlairs(self, request, _):
+        flairs = []
+        try:
+            return rpc.ListFlairsResponse(flairs=self.flairs.get(request.subreddit))
+        except Exception as e:
+            log.error(
+                f"Recovering from ListFlairs error for subreddit {request.subreddit}:\n{str(e)}"
+            )
+        return rpc.ListFlairsResponse(flairs=flairs)
+
+    def ResolveFlairs(self, request, _):
+        if len(request.subreddits) != len(request.flair_texts):
+            return rpc.ResolveFlairsReply(
+                error_msg="Every subreddit needs exactly one flair text."
+            )
+        flairs, errors = self.flairs.resolve(
+            list(request.subreddits), list(request.flair_texts)
+        )
+        return rpc.ResolveFlairsReply(flairs=flairs, error_msgs=errors)
+
+    def SchedulePost(self, request, context):
+        reply = self.database_op(
+            DbCommand("schedule", [request]),
+            context,
+            "SchedulePost",
+            request,
+            lambda msg, obj: rpc.SchedulePostReply(error_msg=msg) if msg else obj[0],
+        )
+        if not reply.error_msg:
+            # The post might be due before the Poster's next planned step
+            self.poster.wake()
+        return reply
+
+    def SchedulePosts(self, request, context):
+        reply = self.database_op(
+            DbCommand("schedule", list(request.posts)),
+            context,
+            "SchedulePosts",
+            request,
+            lambda msg, obj: rpc.SchedulePostsReply(
+                error_msg=msg,
+                error_msgs=None if msg else [r.error_msg for r in obj],
+                warnings=None if msg else [r.warning for r in obj],
+            ),
+        )
+        if any(err == "" for err in reply.error_msgs):
+            self.poster.wake()
+        return reply
+
+    def EditPost(self, request, context):
+        reply = self.database_op(
+            DbCommand("edit", request),
+            context,
+            "EditPost",
+            request,
+            lambda msg, _: rpc.EditPostReply(error_msg=msg),
+        )
+        if not reply.error_msg and request.operation == rpc.EditPostRequest.RESCHEDULE:
+            # Posts might have been moved before the Poster's next planned step
+            self.poster.wake()
+        return reply
+
+    def WatchPosts(self, request, context):
+        log.debug("Got WatchPosts RPC")
+        watcher = self.db.add_watcher()
+        try:
+            while context.is_active():
+                try:
+                    entry = watcher.events.get(timeout=WATCH_POLL_INTERVAL)
+                except queue.Empty:
+                    if watcher.dropped:
+                        context.abort(
+                            grpc.StatusCode.RESOURCE_EXHAUSTED, ERR_WATCH_DROPPED
+                        )
+                    continue
+                yield entry
+        finally:
+            self.db.remove_watcher(watcher)
+
+    def database_op(
+        self,
+        command: DbCommand,
+        context: grpc.ServicerContext,
+        rpc_name: str,
+        request: Any,
+        reply_handler: Callable[[str, Any], Any],
+        commands: Optional[RpcCommands] = None,
+    ):
+        """Runs the command on the Database within the RPC's deadline.
+
+        The command is dropped by the Database if the client goes away or the
+        deadline passes before it is handled. RPCs that run several commands
+        pass the same `commands` to every call.
+        """
+        log.debug("Got %s RPC", rpc_name)
+        remaining = context.time_remaining()
+        if remaining is None or remaining > LOCK_TIMEOUT:
+            remaining = LOCK_TIMEOUT
+        command.deadline = time.monotonic() + remaining
+        (commands or RpcCommands(context)).track(command)
+        if tracer.enabled:
+            command.trace_id = command.trace_id or new_trace_id()
+        try:
+            with tracer.span(
+                command.trace_id, "reply_wait", rpc=rpc_name, command=command.command
+            ):
+                self.db.queue_command(command)
+                reply = command.wait_for_answer()
+            msg = str(reply.obj) if reply.is_err else ""
+            return reply_handler(msg, reply.obj)
+        except DbOverloaded as e:
+            log.warning("Rejecting %s RPC: %s", rpc_name, e)
+            context.set_trailing_metadata(
+                (("grpc-retry-pushback-ms", str(int(e.retry_after * 1000))),)
+            )
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        except queue.Empty:
+            command.cancel()
+            log.exception(
+                "%s RPC timed out waiting for database with command:\n%s",
+                rpc_name,
+                command,
+            )
+            return reply_handler(ERR_INTERNAL, None)
+        except:
+            log.exception(
+                "Error handling %s RPC with request:\n%s", rpc_name, Bounded(request)
+            )
+            return reply_handler(ERR_INTERNAL, None)
+
+    def link_database(self, db):
+        self.db = db
+        return self
+
+    def link_poster(self, poster):
+        self.poster = poster
+        return self
+
+    def link_flair_cache(self, flairs):
+        self.flairs = flairs
+        return self
+
+    def set_compression(self, compression: grpc.Compression, threshold: int):
+        """Compresses replies of at least threshold bytes with compression."""
+        self.compression = compression
+        self.compression_threshold = threshold
+        return self
+
+    def compress_large(self, context, reply):
+        """Compresses reply if it's large enough for compression to pay off.
+
+        Clients advertise the algorithms they accept, and grpc falls back to
+        sending the reply uncompressed to clients that don't accept it.
+        """
+        if (
+            self.compression != grpc.Compression.NoCompression
+            and reply.ByteSize() >= self.compression_threshold
+        ):
+            context.set_compression(self.compression)
+        return reply
+
+
+class StagedMedia:
+    """Media uploaded to Reddit ahead of time, ready to be attached to a post."""
+
+    def __init__(self, url: str, websocket_url: Optional[str]):
+        self.url = url
+        self.websocket_url = websocket_url
+        # Whether a post was submitted with it already
+        self.claimed = False
+
+
+def write_temp_image(image: rpc.ImagePost) -> Path:
+    path = (Path("/tmp/reddit-scheduler") / str(uuid.uuid1())).with_suffix(
+        "." + image.extension
+    )
+    log.debug("Writing temporary image to %s", path)
+    os.makedirs(path.parent, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(image.image_data)
+    return path
+
+
+def stage_media(reddit: praw.Reddit, entry: rpc.PostDbEntry) -> StagedMedia:
+    """Uploads the image of an image post to Reddit's media lease."""
+    log.info("Staging image of post with id %d", entry.id)
+    subreddit = reddit.subreddit(entry.post.subreddit)
+    path = write_temp_image(entry.post.data.image)
+    try:
+        with tracer.span(post_trace_id(entry.id), "reddit_stage", post_id=entry.id):
+            # praw has no public API for uploading media without submitting
+            url, websocket_url = subreddit._upload_media(
+                expected_mime_prefix="image", media_path=str(path)
+            )
+    finally:
+        os.remove(path)
+    return StagedMedia(url, websocket_url)
+
+
+class OAuthToken:
+    """The OAuth token of a praw.Reddit, which praw has no public API for.
+
+    prawcore 2.3.0, pinned in requirements.txt, keeps when the token expires in
+    the authorizer's private _expiration_timestamp, in time.time() seconds.
+    Later releases renamed it. `of` returns None for those, and prawcore is
+    left to renew the token itself once it expires.
+    """
+
+    def __init__(self, authorizer):
+        self.authorizer = authorizer
+
+    @classmethod
+    def of(cls, reddit) -> Optional["OAuthToken"]:
+        authorizer = getattr(getattr(reddit, "_core", None), "_authorizer", None)
+        if not hasattr(authorizer, "_expiration_timestamp"):
+            return None
+        return cls(authorizer)
+
+    @property
+    def expiration(self) -> Optional[float]:
+        """None until the first token is fetched."""
+        return self.authorizer._expiration_timestamp
+
+    @expiration.setter
+    def expiration(self, expiration: float):
+        self.authorizer._expiration_timestamp = expiration
+
+
+def refresh_auth(reddit: praw.Reddit, valid_until: float):
+    """Refreshes the OAuth token now if it would expire before valid_until."""
+    token = OAuthToken.of(reddit)
+    if token is None:
+        log.debug("Leaving the reddit OAuth token to prawcore to refresh")
+        return
+    if token.expiration is None or token.expiration < valid_until + AUTH_MARGIN:
+        log.debug("Refreshing reddit OAuth token")
+        token.authorizer.refresh()
+
+
+def submit_staged_image(
+    subreddit,
+    p: rpc.Post,
+    flair_id: Optional[str],
+    staged: StagedMedia,
+    without_websockets: bool = False,
+):
+    """Same as subreddit.submit_image, but with media that is already uploaded."""
+    data = {
+        "sr": str(subreddit),
+        "resubmit": True,
+        "sendreplies": True,
+        "title": p.title,
+        "nsfw": p.data.image.nsfw,
+        "spoiler": False,
+        "validate_on_submit": subreddit._reddit.validate_on_submit,
+        "kind": "image",
+        "url": staged.url,
+    }
+    if flair_id is not None:
+        data["flair_id"] = flair_id
+    websocket_url = None if without_websockets else staged.websocket_url
+    return subreddit._submit_media(data=data, timeout=10, websocket_url=websocket_url)
+
+
+def perform_follow_up(reddit: praw.Reddit, fullname: str, follow_up: rpc.FollowUp):
+    submission = reddit.submission(id=fullname.split("_", 1)[-1])
+    action = follow_up.action
+    if action == rpc.FollowUp.Action.COMMENT:
+        submission.reply(body=follow_up.text)
+    elif action == rpc.FollowUp.Action.STICKY:
+        submission.mod.sticky()
+    elif action == rpc.FollowUp.Action.DISTINGUISH:
+        submission.mod.distinguish()
+    elif action == rpc.FollowUp.Action.LOCK:
+        submission.mod.lock()
+    elif action == rpc.FollowUp.Action.DELETE:
+        submission.delete()
+    else:
+        raise ValueError(f"unknown follow-up action: {action}")
+
+
+def post_to_reddit(
+    reddit: praw.Reddit,
+    entry: rpc.PostDbEntry,
+    staged: Optional[StagedMedia] = None,
+    without_websockets: bool = False,
+):
+    """Submits the post to reddit and returns the praw Submission.
+
+    With `without_websockets`, image posts return as soon as Reddit accepts
+    them instead of waiting for the image to be processed, and no Submission
+    is returned.
+    """
+    log.info("Posting post with id %d to reddit", entry.id)
+    p = entry.post
+    subreddit = reddit.subreddit(p.subreddit)
+    flair_id = p.flair_id if p.flair_id != "" else None
+    if p.data.HasField("text"):
+        submission = subreddit.submit(
+            title=p.title, selftext=p.data.text.body, flair_id=flair_id
+        )
+        log.info("Submitted post with id %d", entry.id)
+        return submission
+    elif p.data.HasField("poll"):
+        poll = p.data.poll
+        kwargs = {}
+        if poll.duration != 0:
+            kwargs["duration"] = poll.duration
+        return subreddit.submit_poll(
+            title=p.title,
+            options=list(poll.options),
+            selftext=poll.selftext,
+            flair_id=flair_id,
+            **kwargs,
+        )
+    elif p.data.HasField("image") and staged is not None:
+        return submit_staged_image(subreddit, p, flair_id, staged, without_websockets)
+    elif p.data.HasField("image"):
+        image = p.data.image
+        path = write_temp_image(image)
+        try:
+            return subreddit.submit_image(
+                title=p.title,
+                flair_id=flair_id,
+                nsfw=image.nsfw,
+                image_path=str(path),
+                without_websockets=without_websockets,
+            )
+        finally:
+            os.remove(path)
+    elif p.data.HasField("url"):
+        submission = subreddit.submit(
+            title=p.title, url=p.data.url.url, flair_id=flair_id
+        )
+        log.info("Submitted post with id %d", entry.id)
+        return submission
+    else:
+        raise ValueError(f"could not determine type of post to post to reddit: {p}")
+
+
+class FlairCache:
+    """Flairs of subreddits, fetched from Reddit at most every FLAIR_TTL seconds."""
+
+    def __init__(self, reddit_config):
+        self.reddit_config = reddit_config
+        self.lock = threading.Lock()
+        # Flairs and when they were fetched, by lowercase subreddit name
+        self.flairs: Dict[str, Tuple[List[rpc.Flair], float]] = {}
+        self.executor = futures.ThreadPoolExecutor(max_workers=FLAIR_WORKERS)
+
+    def get(self, subreddit: str) -> List[rpc.Flair]:
+        key = subreddit.lower()
+        with self.lock:
+            cached = self.flairs.get(key)
+        if cached is not None and time.time() - cached[1] < FLAIR_TTL:
+            return cached[0]
+        flairs = flairs_for_subdreddit(get_reddit(self.reddit_config), subreddit)
+        with self.lock:
+            self.flairs[key] = (flairs, time.time())
+        return flairs
+
+    def find(self, subreddit: str, text: str) -> rpc.Flair:
+        """The flair of the subreddit with the given text. Raises ValueError if
+        there is none."""
+        for flair in self.get(subreddit):
+            if flair.text == text:
+                return flair
+        raise ValueError(f"r/{subreddit} doesn't have a flair called {text}")
+
+    def resolve(
+        self, subreddits: List[str], texts: List[str]
+    ) -> Tuple[List[rpc.Flair], List[str]]:
+        """Finds the flair with texts[i] in subreddits[i], for every i.
+
+        Each subreddit is fetched once, concurrently with the others. Returns the
+        flairs, empty for those that weren't found, and why they weren't.
+        """
+
+        def fetch(subreddit: str) -> Tuple[List[rpc.Flair], str]:
+            try:
+                return self.get(subreddit), ""
+            except Exception as e:
+                log.error("Failed to fetch flairs of r/%s: %s", subreddit, e)
+                return [], f"couldn't fetch the flairs of r/{subreddit}"
+
+        names = list(dict.fromkeys(s.lower() for s in subreddits))
+        fetched = dict(zip(names, self.executor.map(fetch, names)))
+        flairs = []
+        errors = []
+        for subreddit, text in zip(subreddits, texts):
+            available, err = fetched[subreddit.lower()]
+            found = next((f for f in available if f.text == text), None)
+            if found is None and err == "":
+                err = f"r/{subreddit} doesn't have a flair called {text}"
+            flairs.append(found or rpc.Flair())
+            errors.append(err)
+        return flairs, errors
+
+    def set_reddit_config(self, reddit_config):
+        with self.lock:
+            self.reddit_config = reddit_config
+            self.flairs.clear()
+
+
+def flairs_for_subdreddit(reddit: praw.Reddit, subreddit: str) -> List[rpc.Flair]:
+    sub = reddit.subreddit(subreddit)
+    flairs = [
+        f for f in sub.flair.link_templates.user_selectable() if f["flair_text"] != ""
+    ]
+    return [rpc.Flair(text=f["flair_text"], id=f["flair_template_id"]) for f in flairs]
+
+
+def make_requirements(
+    post_requirements: Dict[str, Any], about: Dict[str, Any]
+) -> rpc.SubredditRequirements:
+    """Converts Reddit's post_requirements and subreddit about responses."""
+    r = post_requirements
+    reqs = rpc.SubredditRequirements(
+        title_min_length=r.get("title_text_min_length") or 0,
+        title_max_length=r.get("title_text_max_length") or 0,
+        flair_required=bool(r.get("is_flair_required")),
+        body_required=r.get("body_restriction_policy") == "required",
+        body_not_allowed=r.get("body_restriction_policy") == "notAllowed",
+        body_max_length=r.get("body_text_max_length") or 0,
+        title_required_strings=r.get("title_required_strings") or [],
+        title_blacklisted_strings=r.get("title_blacklisted_strings") or [],
+        domain_blacklist=r.get("domain_blacklist") or [],
+    )
+    submission_type = about.get("submission_type", "any")
+    if submission_type == "self":
+        reqs.disallowed_types.extend(["url", "image"])
+    elif submission_type == "link":
+        reqs.disallowed_types.extend(["text", "poll"])
+    if (
+        r.get("link_restriction_policy") == "notAllowed"
+        and "url" not in reqs.disallowed_types
+    ):
+        reqs.disallowed_types.append("url")
+    if not about.get("allow_images", True) and "image" not in reqs.disallowed_types:
+        reqs.disallowed_types.append("image")
+    if not about.get("allow_polls", True) and "poll" not in reqs.disallowed_types:
+        reqs.disallowed_types.append("poll")
+    return reqs
+
+
+def fetch_requirements(
+    reddit: praw.Reddit, subreddit: str
+) -> rpc.SubredditRequirements:
+    sub = reddit.subreddit(subreddit)
+    about = {
+        "submission_type": getattr(sub, "submission_type", "any"),
+        "allow_images": getattr(sub, "allow_images", True),
+        "allow_polls": getattr(sub, "allow_polls", True),
+    }
+    return make_requirements(sub.post_requirements(), about)
+
+
+def simulate_post(post):
+    log.info("Would've posted: %s", Bounded(post))
+
+
+def token_key(cfg) -> str:
+    return f"{cfg['ClientId']}:{cfg['Username']}"
+
+
+class TokenStore:
+    """Shares Reddit OAuth tokens between praw instances and across restarts.
+
+    Every praw instance from get_reddit is attached, so a token fetched by one
+    is used by all of them instead of each logging in on its first request.
+    With a path set, tokens are saved there too and reused after a restart.
+    Reddit gives script apps access tokens only, so there is no refresh token
+    to keep; TokenRefresher renews the access token before it expires instead.
+    """
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        # By token_key, as dicts of access_token, expiration and scopes
+        self.tokens: Dict[str, Dict[str, Any]] = {}
+        # Held while fetching a token so only one instance logs in at a time
+        self.lock = threading.Lock()
+
+    def set_path(self, path: str):
+        """Loads the tokens saved at path and saves new ones there."""
+        with self.lock:
+            self.path = path
+            try:
+                with open(path) as f:
+                    self.tokens = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                log.error("Ignoring saved OAuth tokens, failed to read them: %s", e)
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            # Tokens are as good as the password for as long as they last
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.tokens, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.error("Failed to save OAuth token: %s", e)
+
+    def expiration(self, cfg) -> float:
+        """When the stored token of the account expires, 0 if there is none."""
+        with self.lock:
+            token = self.tokens.get(token_key(cfg))
+        return token["expiration"] if token else 0
+
+    def attach(self, reddit: praw.Reddit, cfg):
+        """Makes reddit use the stored token and share the ones it fetches."""
+        oauth = OAuthToken.of(reddit)
+        if oauth is None:
+            log.warning(
+                "Can't share OAuth tokens with this version of prawcore, "
+                "each reddit client logs in on its own"
+            )
+            return
+        authorizer = oauth.authorizer
+        key = token_key(cfg)
+        fetch = authorizer.refresh
+        # Tokens the authorizer had before. prawcore drops a token Reddit
+        # rejects, which must then not be adopted again.
+        used: Set[str] = set()
+
+        def adopt(token: Optional[Dict[str, Any]]) -> bool:
+            if token is None or token["access_token"] in used:
+                return False
+            if token["expiration"] - time.time() < TOKEN_REFRESH_MARGIN:
+                return False
+            authorizer.access_token = token["access_token"]
+            oauth.expiration = token["expiration"]
+            authorizer.scopes = set(token["scopes"])
+            used.add(token["access_token"])
+            return True
+
+        def refresh():
+            with self.lock:
+                if adopt(self.tokens.get(key)):
+                    return
+                log.debug("Fetching reddit OAuth token")
+                fetch()
+                used.add(authorizer.access_token)
+                self.tokens[key] = {
+                    "access_token": authorizer.access_token,
+                    "expiration": oauth.expiration,
+                    "scopes": sorted(authorizer.scopes or []),
+                }
+                self.save()
+
+        with self.lock:
+            adopt(self.tokens.get(key))
+        authorizer.refresh = refresh
+
+
+tokens = TokenStore()
+
+
+def token_path() -> str:
+    if os.environ.get("TOKEN_PATH"):
+        return os.environ["TOKEN_PATH"]
+    # Set by systemd from StateDirectory=, possibly to several directories
+    state = os.environ.get("STATE_DIRECTORY", "").split(":")[0]
+    if not state:
+        state = os.path.expandvars("$HOME/.local/state/reddit-scheduler")
+    return os.path.join(state, "token.json")
+
+
+def get_reddit(cfg):
+    reddit = praw.Reddit(
+        client_id=cfg["ClientId"],
+        client_secret=cfg["ClientSecret"],
+        password=cfg["Password"],
+        username=cfg["Username"],
+        user_agent=f"desktop:{cfg['ClientId']}:v0.0.1  (by u/{cfg['Username']})",
+    )
+    tokens.attach(reddit, cfg)
+    return reddit
+
+
+def query_database(
+    db,
+    command: str,
+    obj: Any,
+    priority: int = PRIORITY_HIGH,
+    trace_id: Optional[str] = None,
+) -> Any:
+    """Runs a command on the database. Returns None if that fails."""
+    if tracer.enabled:
+        trace_id = trace_id or new_trace_id()
+    try:
+        db_command = DbCommand(command, obj, priority, trace_id=trace_id)
+        with tracer.span(trace_id, "reply_wait", command=command):
+            db.queue_command(db_command)
+            db_reply = db_command.wait_for_answer()
+        if db_reply.is_err:
+            raise ValueError(db_reply.obj)
+        return db_reply.obj
+    except:
+        log.exception("Errored on db command %s", command)
+        return None
+
+
+def match_submissions(
+    submitted: List[Tuple[rpc.PostDbEntry, int]], recent: List[Any]
+) -> Dict[int, Any]:
+    """Pairs SUBMITTED posts with the reddit submissions they turned into.
+
+    `submitted` holds posts with their submission time, oldest first, and
+    `recent` the account's recent praw submissions. A submission matches a post
+    if it went to the same subreddit with the same title no earlier than the
+    post was submitted. Each submission is used at most once so reposts of the
+    same title are told apart. Returns the matching submissions by post id.
+    """
+    # Oldest submissions first so they pair up with the oldest posts
+    candidates = sorted(recent, key=lambda s: s.created_utc)
+    used = set()  # type: Set[str]
+    matches = {}  # type: Dict[int, Any]
+    for entry, submitted_time in submitted:
+        for s in candidates:
+            if (
+                s.fullname not in used
+                and s.subreddit.display_name.lower() == entry.post.subreddit.lower()
+                and s.title == entry.post.title
+                and s.created_utc >= submitted_time - CLOCK_SLACK
+            ):
+                used.add(s.fullname)
+                matches[entry.id] = s
+                break
+    return matches
+
+
+class Poster:
+    """Routinely checks if any posts are eligible to be posted and then posts them to Reddit.
+
+    Eligible posts are submitted concurrently, up to MAX_SUBMISSIONS at a time,
+    so a post to many subreddits goes out at once. A submission is abandoned if
+    it takes longer than `submit_timeout`, so one hung request can't hold up
+    the rest. An abandoned submission is left to finish in the background: the
+    post is marked posted if it eventually succeeds and retried otherwise.
+
+    Posts due within `stage_lead` seconds are staged: the OAuth token is
+    refreshed if needed and images are uploaded ahead of time, so that the
+    submission itself is a single quick API call. Posts sharing an image share
+    its upload too. Between steps the Poster
+    sleeps until the next post is due or needs staging, but no longer than
+    `step_interval`.
+
+    With `async_images`, image posts are submitted without waiting for Reddit
+    to process the image. They are marked SUBMITTED and left to the
+    SubmissionReconciler to confirm. The same goes for every post but the first
+    to use a shared upload, since Reddit only reports on an upload once.
+
+    Follow-ups of confirmed posts are due alongside posts, and the Poster wakes
+    up for them the same way. Due follow-ups are handed to their own pool of
+    MAX_FOLLOW_UPS workers without waiting for them, so a slow one never holds
+    up a submission. Failed follow-ups are logged and not retried.
+
+    The schedule runs on `clock`, which simulate.py swaps for a SimulatedClock
+    to replay a queue faster than real time.
+    """
+
+    def __init__(
+        self,
+        reddit_config,
+        dry_run: bool = True,
+        step_interval: float = 5,
+        submit_timeout: float = SUBMIT_TIMEOUT,
+        stage_lead: float = STAGE_LEAD_TIME,
+        async_images: bool = False,
+        clock: Optional[Clock] = None,
+    ):
+        self.clock = clock or Clock()
+        self.dry_run = dry_run
+        self.async_images = async_images
+        self.step_interval = step_interval
+        self.submit_timeout = submit_timeout
+        self.stage_lead = stage_lead
+        self.reddit = get_reddit(reddit_config)
+        self.executor = futures.ThreadPoolExecutor(max_workers=MAX_SUBMISSIONS)
+        self.stage_executor = futures.ThreadPoolExecutor(max_workers=MAX_STAGING)
+        self.job_executor = futures.ThreadPoolExecutor(max_workers=MAX_FOLLOW_UPS)
+        # Ids of the follow-up jobs that are running
+        self.running_jobs: Set[int] = set()
+        self.jobs_lock = threading.Lock()
+        # Media uploads of upcoming image posts, by post id. Posts with the
+        # same image share a future.
+        self.staged: Dict[int, futures.Future] = {}
+        # Digests of the images of staged posts, by post id
+        self.staged_digests: Dict[int, bytes] = {}
+        self.wakeup = threading.Event()
+        # Abandoned submissions that are still running, by post id
+        self.hung: Dict[int, futures.Future] = {}
+        # Ids in hung whose submission finished and was recorded. They stay in
+        # hung until the next step, since the current one may have read them
+        # as failed before the result was recorded.
+        self.settled: Set[int] = set()
+        self.hung_lock = threading.Lock()
+        # Liveness, in time.monotonic() seconds. step_started is None between steps,
+        # last_loop is when the loop in start last came around.
+        self.step_started: Optional[float] = None
+        self.last_progress = self.last_loop = time.monotonic()
+        # Held for the duration of a step so settings only change between steps
+        self.settings_lock = threading.Lock()
+
+    def submit(self, entry: rpc.PostDbEntry, staged: Optional[StagedMedia] = None):
+        """Returns the praw Submission if Reddit gave one back."""
+        if self.dry_run:
+            simulate_post(entry.post)
+            return None
+        with tracer.span(
+            post_trace_id(entry.id),
+            "reddit_submit",
+            post_id=entry.id,
+            subreddit=entry.post.subreddit,
+        ):
+            return post_to_reddit(self.reddit, entry, staged, self.is_async(entry))
+
+    def is_async(self, entry: rpc.PostDbEntry) -> bool:
+        """Whether the post is submitted without waiting for Reddit to confirm it."""
+        return (
+            self.async_images and not self.dry_run and entry.post.data.HasField("image")
+        )
+
+    def take_staged(self, post_id: int) -> Optional[StagedMedia]:
+        future = self.staged.pop(post_id, None)
+        self.staged_digests.pop(post_id, None)
+        if future is None or not future.done():
+            return None
+        if future.exception() is not None:
+            log.error(
+                "Staging post with id %d failed, submitting without it: %s",
+                post_id,
+                future.exception(),
+            )
+            return None
+        staged = future.result()
+        if staged.claimed:
+            # Already submitted with another post, whose submission gets the
+            # websocket message
+            return StagedMedia(staged.url, None)
+        staged.claimed = True
+        return staged
+
+    def stage(self):
+        """Gets posts due within stage_lead seconds ready to be submitted."""
+        if self.dry_run:
+            return
+        until = self.clock.time() + self.stage_lead
+        upcoming = self.query("upcoming", int(until))
+        if upcoming is None:
+            return
+        # Forget posts that were deleted or can't be posted anymore
+        ids = set(e.id for e in upcoming)
+        for id in list(self.staged.keys()):
+            if id not in ids:
+                del self.staged[id]
+                del self.staged_digests[id]
+        if len(upcoming) == 0:
+            return
+        try:
+            with tracer.span(None, "reddit_auth"):
+                refresh_auth(self.reddit, upcoming[-1].post.scheduled_time)
+        except:
+            log.exception("Failed to refresh reddit OAuth token")
+        uploads = {
+            digest: self.staged[id] for id, digest in self.staged_digests.items()
+        }
+        for entry in upcoming:
+            if entry.post.data.HasField("image") and entry.id not in self.staged:
+                digest = hashlib.sha256(entry.post.data.image.image_data).digest()
+                future = uploads.get(digest)
+                if future is None:
+                    future = self.stage_executor.submit(stage_media, self.reddit, entry)
+                    uploads[digest] = future
+                self.staged[entry.id] = future
+                self.staged_digests[entry.id] = digest
+
+    def time_until_next_step(self) -> float:
+        now = self.clock.time()
+        wakeup = now + self.step_interval
+        next_due = self.query("next_due", int(now))
+        if next_due is not None:
+            wakeup = min(wakeup, next_due)
+        if not self.dry_run:
+            next_stage = self.query("next_due", int(now + self.stage_lead))
+            if next_stage is not None:
+                wakeup = min(wakeup, next_stage - self.stage_lead)
+        next_job = self.query("next_job", int(now))
+        if next_job is not None:
+            wakeup = min(wakeup, next_job)
+        return max(0, wakeup - now)
+
+    def wake(self):
+        """Makes the Poster check for posts now instead of at its planned time."""
+        self.wakeup.set()
+
+    def query(self, command: str, obj: Any, trace_id: Optional[str] = None) -> Any:
+        return query_database(self.db, command, obj, trace_id=trace_id)
+
+    def step(self):
+        """Posts all eligible posts and marks them as posted in the datbase."""
+        log.debug("Poster doing step")
+        self.step_started = self.last_progress = time.monotonic()
+        trace_id = new_trace_id() if tracer.enabled else None
+        try:
+            with tracer.span(trace_id, "poster_step"):
+                self.post_eligible(trace_id)
+                self.start_due_jobs(trace_id)
+        finally:
+            self.step_started = None
+
+    def post_eligible(self, trace_id: Optional[str] = None):
+        with self.hung_lock:
+            for id in self.settled:
+                self.hung.pop(id, None)
+            self.settled.clear()
+        # Get the eligible posts from the database
+        eligible: List[rpc.PostDbEntry] = self.query("eligible", None, trace_id) or []
+        log.debug("Got %d eligible posts", len(eligible))
+        self.last_progress = time.monotonic()
+
+        # Post everything to reddit
+        pending = []  # type: List[Tuple[rpc.PostDbEntry, futures.Future]]
+        for entry in eligible:
+            with self.hung_lock:
+                if entry.id in self.hung:
+                    log.debug("Skipping post with id %d, still submitting", entry.id)
+                    continue
+            staged = self.take_staged(entry.id)
+            pending.append((entry, self.executor.submit(self.submit, entry, staged)))
+
+        # The submissions run at once, so they share a single timeout
+        futures.wait([future for _, future in pending], timeout=self.submit_timeout)
+        succeeded = []  # type: List[Tuple[rpc.PostDbEntry, Any]]
+        for entry, future in pending:
+            if future.cancel():
+                # Every worker was busy, try again next step
+                log.debug("Post with id %d is waiting for a worker", entry.id)
+                continue
+            if not future.done():
+                self.abandon(entry, future)
+                continue
+            try:
+                succeeded.append((entry, future.result()))
+            except RedditAPIException as e:
+                msg = f"Failed to post post with id {entry.id}:"
+                report = []
+                for sube in e.items:
+                    report.append(f"-> {sube.error_type}: {sube.message or ''}")
+                log.error("\n".join([msg] + report))
+                self.mark_error(entry.id, "\n".join(report))
+            except Exception as e:
+                log.exception("Failed to post post with id %d", entry.id)
+                self.mark_error(entry.id, str(e))
+            self.last_progress = time.monotonic()
+
+        # Tell database which posts we posted
+        for entry, submission in succeeded:
+            self.record_success(entry, submission)
+
+    def start_due_jobs(self, trace_id: Optional[str] = None):
+        """Hands due follow-ups to the job workers without waiting for them."""
+        jobs: List[ObjJob] = (
+            self.query("due_jobs", int(self.clock.time()), trace_id) or []
+        )
+        for job in jobs:
+            with self.jobs_lock:
+                if job.id in self.running_jobs:
+                    continue
+                self.running_jobs.add(job.id)
+            self.job_executor.submit(self.run_job, job)
+
+    def run_job(self, job: ObjJob):
+        action = rpc.FollowUp.Action.Name(job.follow_up.action).lower()
+        err = ""
+        try:
+            if self.dry_run:
+                log.info("Would %s post with id %d", action, job.post_id)
+            else:
+                with tracer.span(
+                    post_trace_id(job.post_id), "reddit_follow_up", action=action
+                ):
+                    perform_follow_up(self.reddit, job.submission_id, job.follow_up)
+        except RedditAPIException as e:
+            err = "\n".join(f"-> {i.error_type}: {i.message or ''}" for i in e.items)
+            log.error("Failed to %s post with id %d:\n%s", action, job.post_id, err)
+        except Exception as e:
+            log.exception("Failed to %s post with id %d", action, job.post_id)
+            err = str(e) or type(e).__name__
+        # Left due and run again next step if this fails
+        self.query("finish_job", ObjJobResult(job.id, err), post_trace_id(job.post_id))
+        with self.jobs_lock:
+            self.running_jobs.discard(job.id)
+
+    def abandon(self, entry: rpc.PostDbEntry, future: futures.Future):
+        log.error(
+            "Submission of post with id %d took longer than %d seconds, abandoning it",
+            entry.id,
+            self.submit_timeout,
+        )
+        # Queued first, so the outcome recorded by finish_abandoned comes after
+        # it even if the callback runs right away on a future that just finished
+        self.mark_error(entry.id, ERR_SUBMIT_TIMEOUT % self.submit_timeout)
+        with self.hung_lock:
+            self.hung[entry.id] = future
+        future.add_done_callback(lambda f: self.finish_abandoned(entry, f))
+
+    def finish_abandoned(self, entry: rpc.PostDbEntry, future: futures.Future):
+        if future.exception() is None:
+            log.info("Abandoned submission of post with id %d succeeded", entry.id)
+            self.record_success(entry, future.result())
+        else:
+            log.error(
+                "Abandoned submission of post with id %d failed: %s",
+                entry.id,
+                future.exception(),
+            )
+        # Only let steps retry it once the outcome is in the database
+        with self.hung_lock:
+            self.settled.add(entry.id)
+
+    def record_success(self, entry: rpc.PostDbEntry, submission: Any):
+        if submission is not None:
+            # The permalink is filled in by the StatsCollector, reading it here
+            # would cost another request.
+            obj = ObjSubmission(entry.id, submission.fullname, None)
+            self.query("confirm_submitted", obj, post_trace_id(entry.id))
+        elif self.dry_run:
+            self.mark_posted(entry.id)
+        else:
+            # Submitted without waiting for Reddit to say where the post went
+            self.query("mark_submitted", entry.id, post_trace_id(entry.id))
+
+    def mark_posted(self, post_id: int):
+        self.query("mark_posted", post_id, post_trace_id(post_id))
+
+    def mark_error(self, post_id: int, err: str):
+        command = DbCommand(
+            "mark_error",
+            ObjMarkError(post_id, err),
+            PRIORITY_HIGH,
+            trace_id=post_trace_id(post_id),
+        )
+        self.db.queue_command(command)
+
+    def hung_post_ids(self) -> List[int]:
+        with self.hung_lock:
+            return [id for id in self.hung if id not in self.settled]
+
+    def stalled(self) -> bool:
+        """Whether the Poster is stuck and the service should be restarted.
+
+        That is the case if a step stopped making progress, if the loop stopped
+        coming around, or if hung submissions are taking up every worker so
+        nothing else can be posted.
+        """
+        now = time.monotonic()
+        started = self.step_started
+        if started is not None and now - self.last_progress > STALL_TIMEOUT:
+            return True
+        # The loop sleeps at most step_interval between rounds
+        if now - self.last_loop > self.step_interval + STALL_TIMEOUT:
+            return True
+        return len(self.hung_post_ids()) >= MAX_SUBMISSIONS
+
+    def configure(
+        self,
+        dry_run: bool,
+        step_interval: float,
+        stage_lead: float,
+        async_images: bool,
+        reddit_config=None,
+    ):
+        """Swaps in new settings once the current step is done.
+
+        Abandoned submissions that are still running finish on the old reddit
+        client.
+        """
+        with self.settings_lock:
+            self.dry_run = dry_run
+            self.step_interval = step_interval
+            self.stage_lead = stage_lead
+            self.async_images = async_images
+            if reddit_config is not None:
+                self.reddit = get_reddit(reddit_config)
+                # Uploaded with the old credentials
+                self.staged.clear()
+                self.staged_digests.clear()
+        self.wake()
+
+    def start(self):
+        # TODO figure out how to stop this
+        while True:
+            self.last_loop = time.monotonic()
+            self.wakeup.clear()
+            with self.settings_lock:
+                try:
+                    self.step()
+                    self.stage()
+                except Exception:
+                    # Try again next round instead of ending the thread
+                    log.exception("Poster step failed")
+                timeout = self.time_until_next_step()
+            self.clock.wait(self.wakeup, timeout)
+
+    def link_database(self, db):
+        self.db = db
+        return self
+
+
+def post_from_file(path: Path, flairs: FlairCache) -> rpc.Post:
+    """Reads a post file in the format `reddit post -f` takes.
+
+    Raises ValueError saying what is wrong with the file.
+    """
+    with open(path, "r") as f:
+        parsed = post_file.read_post_file(f)
+    return post_file.make_post(parsed, path.parent, flairs.find)
+
+
+class Inotify:
+    """Just enough of inotify(7) to be told about files in one directory."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, path: Path, mask: int):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), str(path))
+
+    def read(self, timeout: Optional[float]) -> List[str]:
+        """Names of the files that had events, waiting up to timeout seconds."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            names.append(os.fsdecode(data[offset : offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def unused_path(directory: Path, name: str) -> Path:
+    """Where to move a file called name in directory without replacing an
+    earlier one or its .error file. Numbers the name if it's taken."""
+    stem, suffix = os.path.splitext(name)
+    target = directory / name
+    n = 1
+    while target.exists() or target.with_name(target.name + ".error").exists():
+        target = directory / f"{stem}.{n}{suffix}"
+        n += 1
+    return target
+
+
+class DropDirectoryIngester:
+    """Schedules the post files that are dropped into a directory.
+
+    Files are picked up through inotify once they are written, parsed on a
+    worker pool and inserted in a single transaction. Each file is then moved
+    to done/, or to failed/ along with a .error file saying why, numbered if
+    an earlier file had the same name. Posts due in the past are posted right
+    away.
+    """
+
+    def __init__(self, path: str, flairs: FlairCache, workers: int = INGEST_WORKERS):
+        self.path = Path(path)
+        self.done = self.path / "done"
+        self.failed = self.path / "failed"
+        self.flairs = flairs
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        # Files the database couldn't take, tried again later
+        self.retry: List[Path] = []
+
+    def parse(self, path: Path) -> Tuple[Optional[rpc.Post], str]:
+        try:
+            return post_from_file(path, self.flairs), ""
+        except FileNotFoundError:
+            return None, f"file not found: {path}"
+        except Exception as e:
+            return None, str(e) or type(e).__name__
+
+    def ingest(self, paths: List[Path]):
+        paths = [p for p in paths if p.suffix in (".yaml", ".yml") and p.is_file()]
+        if len(paths) == 0:
+            return
+        log.info("Ingesting %d dropped post files", len(paths))
+        parsed = list(self.executor.map(self.parse, paths))
+        posts = [post for post, _ in parsed if post is not None]
+        errors = query_database(self.db, "ingest", posts, PRIORITY_NORMAL)
+        if errors is None:
+            self.retry.extend(paths)
+            return
+        db_errors = iter(errors)
+        scheduled = 0
+        for path, (post, err) in zip(paths, parsed):
+            if post is not None:
+                err = next(db_errors)
+            if err == "":
+                scheduled += 1
+                shutil.move(str(path), unused_path(self.done, path.name))
+            else:
+                log.error("Rejected dropped post file %s: %s", path.name, err)
+                target = unused_path(self.failed, path.name)
+                shutil.move(str(path), target)
+                with open(target.with_name(target.name + ".error"), "w") as f:
+                    f.write(err + "\n")
+        if scheduled > 0:
+            self.poster.wake()
+
+    def start(self):
+        os.makedirs(self.done, exist_ok=True)
+        os.makedirs(self.failed, exist_ok=True)
+        inotify = Inotify(self.path, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+        # Files dropped while the service wasn't running
+        self.ingest(sorted(self.path.iterdir()))
+        while True:
+            names = inotify.read(INGEST_RETRY if self.retry else None)
+            # Wait for the rest of a batch of files to be written
+            while True:
+                more = inotify.read(INGEST_SETTLE)
+                if not more:
+                    break
+                names.extend(more)
+            paths, self.retry = self.retry, []
+            paths.extend(self.path / name for name in dict.fromkeys(names))
+            self.ingest(paths)
+
+    def link_database(self, db):
+        self.db = db
+        return self
+
+    def link_poster(self, poster):
+        self.poster = poster
+        return self
+
+
+class SubmissionReconciler:
+    """Confirms image posts that the Poster submitted without waiting on Reddit.
+
+    All SUBMITTED posts are checked against the account's recent submissions
+    with a single listing call. Posts that haven't shown up after
+    `timeout` seconds are marked as errored so the Poster retries them.
+    """
+
+    def __init__(
+        self,
+        reddit_config,
+        interval: float = RECONCILE_INTERVAL,
+        timeout: float = RECONCILE_TIMEOUT,
+    ):
+        self.reddit = get_reddit(reddit_config)
+        self.interval = interval
+        self.timeout = timeout
+
+    def step(self):
+        submitted = query_database(self.db, "submitted", None)
+        if not submitted:
+            return
+        try:
+            recent = list(
+                self.reddit.user.me().submissions.new(limit=RECONCILE_LISTING_SIZE)
+            )
+        except:
+            log.exception("Failed to fetch recent submissions")
+            return
+        matches = match_submissions(submitted, recent)
+        now = time.time()
+        for entry, submitted_time in submitted:
+            if entry.id in matches:
+                s = matches[entry.id]
+                log.info("Post with id %d is up as %s", entry.id, s.fullname)
+                query_database(
+                    self.db,
+                    "confirm_submitted",
+                    ObjSubmission(entry.id, s.fullname, s.permalink),
+                )
+            elif now - submitted_time > self.timeout:
+                log.error("Submission of post with id %d never showed up", entry.id)
+                err = ERR_SUBMISSION_LOST % self.timeout
+                query_database(self.db, "fail_submitted", ObjMarkError(entry.id, err))
+
+    def start(self):
+        while True:
+            self.step()
+            time.sleep(self.interval)
+
+    def set_reddit_config(self, reddit_config):
+        self.reddit = get_reddit(reddit_config)
+
+    def link_database(self, db):
+        self.db = db
+        return self
+
+
+class StatsCollector:
+    """Keeps the score, comment count and upvote ratio of posted posts fresh.
 
-    def mark_posted(self, post_id: int):
-        if self.conn == None:
-            assert False
-        self.conn.execute(QUERY_MARK_POSTED, (post_id,))
-        self.conn.commit()
+    Posts with stale stats are looked up in info requests of up to
+    STATS_BATCH_SIZE fullnames each, rather than one request per post. How
+    often a post is refreshed decays with its age, see stats_refresh_interval.
+    """
 
-    def mark_error(self, post_id: int, err: str):
-        if self.conn == None:
-            assert False
-        self.conn.execute(QUERY_MARK_ERROR, (err, post_id))
-        self.conn.commit()
+    def __init__(self, reddit_config, interval: float = STATS_INTERVAL):
+        self.reddit = get_reddit(reddit_config)
+        self.interval = interval
 
-    def get_posts_from_query(self, query: str):
-        if self.conn == None:
-            assert False
-        posts = []
-        for row in self.conn.execute(query):
-            status = rpc.PostStatus.UNKNOWN
-            error = ""
-            if row["error"] is not None:
-                status = rpc.PostStatus.ERROR
-                error = row["error"]
-            elif row["posted"]:
-                status = rpc.PostStatus.POSTED
-            else:
-                status = rpc.PostStatus.PENDING
-            posts.append(
-                rpc.PostDbEntry(
-                    id=row["id"],
-                    post=make_post_from_row(row),
-                    status=status,
-                    error=error,
+    def step(self):
+        now = int(time.time())
+        stale = query_database(self.db, "stale_stats", now)
+        if not stale:
+            return
+        posts = {fullname: (id, submitted) for id, fullname, submitted in stale}
+        fullnames = list(posts.keys())
+        stats = []  # type: List[ObjStats]
+        for i in range(0, len(fullnames), STATS_BATCH_SIZE):
+            batch = fullnames[i : i + STATS_BATCH_SIZE]
+            try:
+                submissions = list(self.reddit.info(fullnames=batch))
+            except:
+                log.exception("Failed to fetch stats of %d posts", len(batch))
+                break
+            missing = set(batch)
+            for submission in submissions:
+                missing.discard(submission.fullname)
+                id, submitted = posts[submission.fullname]
+                next_fetch_time = now + stats_refresh_interval(now - submitted)
+                post_stats = rpc.PostStats(
+                    score=submission.score,
+                    num_comments=submission.num_comments,
+                    upvote_ratio=submission.upvote_ratio,
+                    fetched_time=now,
                 )
-            )
-        return posts
+                stats.append(
+                    ObjStats(id, post_stats, submission.permalink, int(next_fetch_time))
+                )
+            # Deleted posts aren't returned at all. Back off from them like from
+            # any other post so they don't take up every batch.
+            for fullname in missing:
+                id, submitted = posts[fullname]
+                next_fetch_time = now + stats_refresh_interval(now - submitted)
+                stats.append(ObjStats(id, None, "", int(next_fetch_time)))
+        log.debug("Refreshed stats of %d posts", len(stats))
+        if stats:
+            query_database(self.db, "store_stats", stats)
 
+    def start(self):
+        while True:
+            self.step()
+            time.sleep(self.interval)
 
-class Servicer(reddit_grpc.RedditSchedulerServicer):
-    """Implementation of grpc service which responds to client requests."""
+    def set_reddit_config(self, reddit_config):
+        self.reddit = get_reddit(reddit_config)
 
-    def ListPosts(self, request, _):
-        return self.database_op(
-            DbCommand("all", None),
-            "ListPosts",
-            request,
-            lambda msg, obj: rpc.ListPostsReply(error_msg=msg, posts=obj),
-        )
+    def link_database(self, db):
+        self.db = db
+        return self
 
-    def ListFlairs(self, request, _):
-        flairs = []
-        try:
-            reddit = get_reddit(self.reddit_config)
-            return rpc.ListFlairsResponse(
-                flairs=flairs_for_subdreddit(reddit, request.subreddit)
-            )
-        except Exception as e:
-            log.error(
-                f"Recovering from ListFlairs error for subreddit {request.subreddit}:\n{str(e)}"
-            )
-        return rpc.ListFlairsResponse(flairs=flairs)
 
-    def SchedulePost(self, request, _):
-        return self.database_op(
-            DbCommand("post", request),
-            "SchedulePost",
-            request,
-            lambda msg, _: rpc.SchedulePostReply(error_msg=msg),
-        )
+class TokenRefresher:
+    """Renews the shared OAuth token TOKEN_REFRESH_MARGIN seconds before it
+    expires, so that posts and RPCs never wait on a login."""
 
-    def EditPost(self, request, _):
-        return self.database_op(
-            DbCommand("edit", request),
-            "EditPost",
-            request,
-            lambda msg, _: rpc.EditPostReply(error_msg=msg),
-        )
+    def __init__(self, reddit_config):
+        self.wakeup = threading.Event()
+        self.set_reddit_config(reddit_config)
 
-    def database_op(
-        self,
-        command: DbCommand,
-        rpc_name: str,
-        request: Any,
-        reply_handler: Callable[[str, Any], Any],
-    ):
-        log.debug("Got %s RPC", rpc_name)
+    def step(self) -> Optional[float]:
+        """Renews the token if it's due. Returns seconds until the next renewal,
+        or None if prawcore renews it instead."""
+        oauth = OAuthToken.of(self.reddit)
+        if oauth is None:
+            return None
+        left = tokens.expiration(self.reddit_config) - time.time()
+        if left > TOKEN_REFRESH_MARGIN:
+            return left - TOKEN_REFRESH_MARGIN
         try:
-            self.db.queue_command(command)
-            reply = command.oneshot.get(timeout=LOCK_TIMEOUT)
-            msg = str(reply.obj) if reply.is_err else ""
-            return reply_handler(msg, reply.obj)
-        except queue.Empty:
-            log.exception(
-                "%s RPC timed out waiting for database with command:\n%s",
-                rpc_name,
-                command,
-            )
-            return reply_handler(ERR_INTERNAL, None)
+            oauth.authorizer.refresh()
         except:
-            log.exception("Error handling %s RPC with request:\n%s", rpc_name, request)
-            return reply_handler(ERR_INTERNAL, None)
+            log.exception("Failed to renew reddit OAuth token")
+            return TOKEN_RETRY
+        left = tokens.expiration(self.reddit_config) - time.time()
+        return max(TOKEN_RETRY, left - TOKEN_REFRESH_MARGIN)
 
-    def link_database(self, db):
-        self.db = db
-        return self
+    def start(self):
+        while True:
+            self.wakeup.clear()
+            self.wakeup.wait(self.step())
 
     def set_reddit_config(self, reddit_config):
         self.reddit_config = reddit_config
-        return self
+        self.reddit = get_reddit(reddit_config)
+        self.wakeup.set()
 
 
-def post_to_reddit(reddit: praw.Reddit, entry: rpc.PostDbEntry):
-    log.info("Posting post with id %d to reddit", entry.id)
-    p = entry.post
-    subreddit = reddit.subreddit(p.subreddit)
-    flair_id = p.flair_id if p.flair_id != "" else None
-    if p.data.HasField("text"):
-        subreddit.submit(title=p.title, selftext=p.data.text.body, flair_id=flair_id)
-        log.info("Submitted post with id %d", entry.id)
-    elif p.data.HasField("poll"):
-        poll = p.data.poll
-        kwargs = {}
-        if poll.duration != 0:
-            kwargs["duration"] = poll.duration
-        subreddit.submit_poll(
-            title=p.title,
-            options=list(poll.options),
-            selftext=poll.selftext,
-            flair_id=flair_id,
-            **kwargs,
-        )
-    elif p.data.HasField("image"):
-        image = p.data.image
-        path = (Path("/tmp/reddit-scheduler") / str(uuid.uuid1())).with_suffix(
-            "." + image.extension
-        )
-        log.debug("Writing temporary image to %s", path)
-        os.makedirs(path.parent, exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(image.image_data)
-        subreddit.submit_image(
-            title=p.title, flair_id=flair_id, nsfw=image.nsfw, image_path=str(path)
-        )
-    elif p.data.HasField("url"):
-        subreddit.submit(title=p.title, url=p.data.url.url, flair_id=flair_id)
-        log.info("Submitted post with id %d", entry.id)
-    else:
-        raise ValueError(f"could not determine type of post to post to reddit: {p}")
+class Watchdog:
+    """Pings the systemd watchdog for as long as the Poster isn't stalled.
 
+    Once the Poster stalls the pings stop and systemd restarts the service.
+    """
 
-def flairs_for_subdreddit(reddit: praw.Reddit, subreddit: str) -> List[rpc.Flair]:
-    sub = reddit.subreddit(subreddit)
-    flairs = [
-        f for f in sub.flair.link_templates.user_selectable() if f["flair_text"] != ""
-    ]
-    return [rpc.Flair(text=f["flair_text"], id=f["flair_template_id"]) for f in flairs]
+    def __init__(self, poster: Poster, interval: float):
+        self.poster = poster
+        self.interval = interval
 
+    def step(self):
+        if self.poster.stalled():
+            log.error(
+                "Poster is stalled, hung submissions: %s", self.poster.hung_post_ids()
+            )
+        else:
+            daemon.notify("WATCHDOG=1")
 
-def simulate_post(post):
-    log.info("Would've posted: %s", post)
+    def start(self):
+        while True:
+            self.step()
+            time.sleep(self.interval)
 
 
-def get_reddit(cfg):
-    return praw.Reddit(
-        client_id=cfg["ClientId"],
-        client_secret=cfg["ClientSecret"],
-        password=cfg["Password"],
-        username=cfg["Username"],
-        user_agent=f"desktop:{cfg['ClientId']}:v0.0.1  (by u/{cfg['Username']})",
-    )
+def watchdog_interval() -> Optional[float]:
+    """Seconds between watchdog pings if systemd expects them."""
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+    if usec is None or (pid is not None and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 1e6 / 2
 
 
-class Poster:
-    """Routinely checks if any posts are eligible to be posted and then posts them to Reddit."""
+class RequirementsFetcher:
+    """Fetches subreddit posting rules requested by the Database.
 
-    def __init__(self, reddit_config, dry_run: bool = True, step_interval: float = 5):
-        self.dry_run = dry_run
-        self.step_interval = step_interval
+    Keeps Reddit API calls off the SchedulePost path: the Database validates
+    against whatever it has cached and asks this class to fill in the gaps.
+    """
+
+    def __init__(self, reddit_config):
         self.reddit = get_reddit(reddit_config)
 
     def step(self):
-        """Posts all eligible posts and marks them as posted in the datbase."""
-        log.debug("Poster doing step")
-        # Get the eligible posts from the database
-        eligible = []  # type: List[rpc.PostDbEntry]
+        subreddit = self.db.requirements_requests.get()
+        log.debug("Fetching requirements for r/%s", subreddit)
+        try:
+            reqs = fetch_requirements(self.reddit, subreddit)
+        except:
+            log.exception("Failed to fetch requirements for r/%s", subreddit)
+            return
         try:
-            command = DbCommand("eligible", None)
+            command = DbCommand("requirements", ObjRequirements(subreddit, reqs))
             self.db.queue_command(command)
             db_reply = command.wait_for_answer()
             if db_reply.is_err:
                 raise ValueError(db_reply.obj)
-            eligible = db_reply.obj
         except:
-            log.exception("Poster step errored on db command")
-        log.debug("Got %d eligible posts", len(eligible))
+            log.exception("Failed to store requirements for r/%s", subreddit)
 
-        # Post everything to reddit
-        posted = []  # type: List[rpc.PostDbEntry]
-        for entry in eligible:
-            if self.dry_run:
-                simulate_post(entry.post)
-                posted.append(entry)
-            else:
-                try:
-                    post_to_reddit(self.reddit, entry)
-                    posted.append(entry)
-                except RedditAPIException as e:
-                    msg = f"Failed to post post with id {entry.id}:"
-                    report = []
-                    for sube in e.items:
-                        report.append(f"-> {sube.error_type}: {sube.message or ''}")
-                    log.error("\n".join([msg] + report))
-                    command = DbCommand(
-                        "mark_error", ObjMarkError(entry.id, "\n".join(report))
-                    )
-                    self.db.queue_command(command)
+    def start(self):
+        while True:
+            self.step()
 
-        # Tell database which posts we posted
-        for entry in posted:
-            try:
-                command = DbCommand("mark_posted", entry.id)
-                self.db.queue_command(command)
-                db_reply = command.wait_for_answer()
-                if db_reply.is_err:
-                    raise ValueError(db_reply.obj)
-            except:
-                log.exception("Poster step errored on telling db about posted")
+    def set_reddit_config(self, reddit_config):
+        self.reddit = get_reddit(reddit_config)
+
+    def link_database(self, db):
+        self.db = db
+        return self
+
+
+class SocketActivationProxy:
+    """Forwards connections from a socket passed in by systemd to the RPC server.
+
+    grpc can't serve on an inherited file descriptor, so the RPC server listens
+    on a local port and connections accepted on the systemd socket are piped to
+    it. Keeps track of open connections so the service can tell when it's idle.
+    """
+
+    def __init__(self, fd: int, target_port: int):
+        self.listener = socket.socket(fileno=fd)
+        self.listener.settimeout(IDLE_CHECK_INTERVAL)
+        self.target = ("127.0.0.1", target_port)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.last_active = time.monotonic()
+        self.accepting = threading.Event()
+        self.accepting.set()
+
+    def step(self):
+        self.accepting.wait()
+        try:
+            conn, _ = self.listener.accept()
+        except socket.timeout:
+            return
+        with self.lock:
+            self.connections += 1
+            self.last_active = time.monotonic()
+        threading.Thread(target=self.forward, args=(conn,), daemon=True).start()
+
+    def forward(self, conn: socket.socket):
+        try:
+            conn.settimeout(None)
+            upstream = socket.create_connection(self.target)
+        except OSError:
+            log.exception("Failed to connect to the rpc server")
+            conn.close()
+            self.close_connection()
+            return
+        pump = threading.Thread(target=pipe, args=(upstream, conn), daemon=True)
+        pump.start()
+        pipe(conn, upstream)
+        pump.join()
+        conn.close()
+        upstream.close()
+        self.close_connection()
+
+    def close_connection(self):
+        with self.lock:
+            self.connections -= 1
+            self.last_active = time.monotonic()
+
+    def idle_for(self) -> float:
+        """Seconds since the last connection closed, or 0 if one is open."""
+        with self.lock:
+            if self.connections != 0:
+                return 0
+            return time.monotonic() - self.last_active
+
+    def pause(self) -> bool:
+        """Stops accepting connections. Returns False if one is already open.
+
+        Connections made while paused wait in the socket, which systemd keeps
+        open and uses to start the service again once this process exits.
+        """
+        self.accepting.clear()
+        with self.lock:
+            if self.connections == 0:
+                return True
+        self.resume()
+        return False
+
+    def resume(self):
+        self.accepting.set()
 
     def start(self):
-        # TODO figure out how to stop this
         while True:
             self.step()
-            time.sleep(self.step_interval)
+
+
+def pipe(src: socket.socket, dst: socket.socket):
+    """Copies bytes from src to dst until src is done sending."""
+    try:
+        while data := src.recv(PROXY_BUFFER_SIZE):
+            dst.sendall(data)
+    except OSError:
+        pass
+    try:
+        dst.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def schedule_wakeup(timestamp: Optional[int]) -> bool:
+    """Replaces the wakeup timer with one starting the service at timestamp.
+
+    No new timer is created if timestamp is None.
+    """
+    subprocess.run(
+        ["systemctl", "--user", "stop", f"{WAKEUP_UNIT}.timer"], capture_output=True
+    )
+    if timestamp is None:
+        return True
+    result = subprocess.run(
+        [
+            "systemd-run",
+            "--user",
+            f"--unit={WAKEUP_UNIT}",
+            f"--on-calendar=@{timestamp}",
+            "--timer-property=AccuracySec=1s",
+            "--collect",
+            "systemctl",
+            "--user",
+            "start",
+            SERVICE_UNIT,
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        log.error("Failed to schedule wakeup timer:\n%s", result.stderr)
+        return False
+    return True
+
+
+class IdleMonitor:
+    """Stops the service while nothing needs it.
+
+    The service is idle once no connection has been open for `idle_timeout`
+    seconds, no submission is waiting to be confirmed, no failed post is waiting
+    to be retried and neither the next post nor the next follow-up is due within
+    that time. Posts count as due when the Poster would stage them, so the
+    service comes back in time to stage them. Only used with socket activation,
+    since otherwise nothing could start the service again.
+    """
+
+    def __init__(
+        self,
+        proxy: SocketActivationProxy,
+        server,
+        idle_timeout: float,
+        clock: Optional[Clock] = None,
+    ):
+        self.proxy = proxy
+        self.server = server
+        self.idle_timeout = idle_timeout
+        self.clock = clock or Clock()
+
+    def step(self) -> bool:
+        """Returns True if the service was stopped."""
+        if self.proxy.idle_for() < self.idle_timeout:
+            return False
+        # The SubmissionReconciler has to keep running until they show up
+        submitted = query_database(self.db, "submitted", None)
+        if submitted is None or len(submitted) > 0:
+            return False
+        # Failed posts are retried on every Poster step
+        eligible = query_database(self.db, "eligible", None)
+        if eligible is None or len(eligible) > 0:
+            return False
+        wakeup = self.next_wakeup()
+        if wakeup is not None and wakeup - self.clock.time() < self.idle_timeout:
+            return False
+        if not self.proxy.pause():
+            return False
+        if not schedule_wakeup(wakeup):
+            self.proxy.resume()
+            return False
+        log.info("Service idle, stopping until %s", wakeup)
+        self.server.stop(None)
+        return True
+
+    def next_wakeup(self) -> Optional[int]:
+        """When the Poster next has something to do, if it ever does."""
+        next_due = query_database(self.db, "next_due", 0)
+        if next_due is not None and not self.poster.dry_run:
+            next_due -= int(self.poster.stage_lead)
+        next_job = query_database(self.db, "next_job", 0)
+        return min((t for t in (next_due, next_job) if t is not None), default=None)
+
+    def start(self):
+        while not self.step():
+            time.sleep(IDLE_CHECK_INTERVAL)
 
     def link_database(self, db):
         self.db = db
         return self
 
+    def link_poster(self, poster):
+        self.poster = poster
+        return self
+
 
 def database_thread(db: Database):
-    log.debug("Starting database with path %s", db.path)
+    log.debug("Starting database on %s", type(db.storage).__name__)
     db.start()
 
 
@@ -563,6 +4635,173 @@ def poster_thread(poster: Poster):
     poster.start()
 
 
+def requirements_thread(fetcher: RequirementsFetcher):
+    log.debug("Starting requirements fetcher")
+    fetcher.start()
+
+
+def token_thread(refresher: TokenRefresher):
+    log.debug("Starting OAuth token refresher")
+    refresher.start()
+
+
+def reconciler_thread(reconciler: SubmissionReconciler):
+    log.debug("Starting submission reconciler")
+    reconciler.start()
+
+
+def stats_thread(collector: StatsCollector):
+    log.debug("Starting stats collector")
+    collector.start()
+
+
+def ingester_thread(ingester: DropDirectoryIngester):
+    log.debug("Starting drop directory ingester on %s", ingester.path)
+    ingester.start()
+
+
+def watchdog_thread(watchdog: Watchdog):
+    log.debug("Starting watchdog")
+    watchdog.start()
+
+
+def proxy_thread(proxy: SocketActivationProxy):
+    log.debug("Starting socket activation proxy")
+    proxy.start()
+
+
+def idle_thread(monitor: IdleMonitor):
+    log.debug("Starting idle monitor")
+    monitor.start()
+
+
+class ConfigReloader:
+    """Applies changes to the config file without restarting the service.
+
+    PostInterval, DryRun, StageLeadTime, AsyncImageSubmit, Debug, TraceFile and
+    the RedditAPI credentials are applied live; the Poster switches over once its
+    current step is done. Other settings need a restart. A config that isn't
+    valid is rejected and the service keeps running as it was.
+    """
+
+    # Settings that are only read on startup
+    RESTART_SETTINGS = [
+        "Port",
+        "IdleTimeout",
+        "DropDirectory",
+        "RpcWorkers",
+        "MaxConcurrentRpcs",
+        "MaxMessageSize",
+        "KeepaliveTime",
+        "Compression",
+        "CompressionThreshold",
+        "PayloadCompression",
+        "PostSpacing",
+    ]
+
+    def __init__(self, config: ConfigParser, poster: Poster, reddit_users: List[Any]):
+        self.config = config
+        self.poster = poster
+        # Components with a set_reddit_config method
+        self.reddit_users = reddit_users
+        self.lock = threading.Lock()
+
+    def reload(self):
+        with self.lock:
+            log.info("Reloading config")
+            config = get_config()
+            if config is None or not is_valid_config(config):
+                log.error("Not reloading, keeping the current config")
+                return
+            general = config["General"]
+            try:
+                settings = poster_settings(general)
+            except ValueError as e:
+                log.error("Not reloading, config file contains errors: %s", e)
+                return
+            reddit_config = None
+            if dict(config["RedditAPI"]) != dict(self.config["RedditAPI"]):
+                log.info("Reddit credentials changed")
+                reddit_config = config["RedditAPI"]
+                for user in self.reddit_users:
+                    user.set_reddit_config(reddit_config)
+            self.poster.configure(reddit_config=reddit_config, **settings)
+            set_debug_level(debug_level(general))
+            if general.get("TraceFile") != self.config["General"].get("TraceFile"):
+                tracer.set_path(trace_path(general))
+            for key in self.RESTART_SETTINGS:
+                if general.get(key) != self.config["General"].get(key):
+                    log.warning("%s changed, restart the service to apply it", key)
+            self.config = config
+            log.info("Config reloaded")
+
+
+def poster_settings(general) -> Dict[str, Any]:
+    """Poster settings from the General section of the config."""
+    return {
+        "dry_run": bool(os.environ.get("DRY_RUN")) or general.getboolean("DryRun"),
+        "step_interval": general.getint("PostInterval"),
+        "stage_lead": general.getfloat("StageLeadTime", fallback=STAGE_LEAD_TIME),
+        "async_images": general.getboolean("AsyncImageSubmit", fallback=False),
+    }
+
+
+def rpc_server_settings(general) -> Dict[str, Any]:
+    """grpc.server arguments from the General section of the config."""
+    max_message = int(
+        general.getfloat("MaxMessageSize", fallback=MAX_MESSAGE_SIZE) * 1024 * 1024
+    )
+    options = [
+        ("grpc.max_send_message_length", max_message),
+        ("grpc.max_receive_message_length", max_message),
+    ]
+    keepalive = int(general.getfloat("KeepaliveTime", fallback=0) * 1000)
+    if keepalive > 0:
+        options += [
+            ("grpc.keepalive_time_ms", keepalive),
+            ("grpc.keepalive_timeout_ms", KEEPALIVE_TIMEOUT * 1000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            # Clients ping at the same interval when they read the same config
+            ("grpc.http2.min_ping_interval_without_data_ms", keepalive),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+    return {
+        "options": options,
+        "maximum_concurrent_rpcs": general.getint("MaxConcurrentRpcs", fallback=0)
+        or None,
+    }
+
+
+def rpc_compression(general) -> Tuple[grpc.Compression, int]:
+    """Compression algorithm and threshold in bytes from the General section."""
+    name = general.get("Compression", fallback="none").lower()
+    if name not in COMPRESSION_ALGORITHMS:
+        raise ValueError(
+            ERR_UNKNOWN_COMPRESSION % (name, ", ".join(COMPRESSION_ALGORITHMS))
+        )
+    threshold = general.getfloat("CompressionThreshold", fallback=COMPRESSION_THRESHOLD)
+    return COMPRESSION_ALGORITHMS[name], int(threshold * 1024)
+
+
+def blob_compression(general) -> str:
+    """How posts are compressed in the database, from the General section."""
+    name = general.get("PayloadCompression", fallback="zstd").lower()
+    if name not in BLOB_ALGORITHMS:
+        raise ValueError(ERR_UNKNOWN_COMPRESSION % (name, ", ".join(BLOB_ALGORITHMS)))
+    return name
+
+
+def trace_path(general) -> str:
+    """Where to write spans to, empty if tracing is off."""
+    return os.path.expanduser(general.get("TraceFile", fallback=""))
+
+
+def debug_level(general) -> int:
+    if "Debug" in general and general["Debug"] == "true":
+        return logging.DEBUG
+    return logging.INFO
+
+
 def get_config():
     for p in CONFIG_SEARCH_PATHS:
         if os.path.exists(p):
@@ -579,6 +4818,15 @@ def is_valid_config(config: ConfigParser):
         general.getint("Port")
         general.getfloat("PostInterval")
         general.getboolean("DryRun")
+        general.getfloat("IdleTimeout", fallback=0)
+        general.getfloat("StageLeadTime", fallback=STAGE_LEAD_TIME)
+        general.getboolean("AsyncImageSubmit", fallback=False)
+        general.get("DropDirectory", fallback="")
+        general.getint("RpcWorkers", fallback=RPC_WORKERS)
+        general.getint("PostSpacing", fallback=POST_SPACING)
+        rpc_server_settings(general)
+        rpc_compression(general)
+        blob_compression(general)
 
         reddit = config["RedditAPI"]
         reddit["Username"]
@@ -601,35 +4849,108 @@ if __name__ == "__main__":
     general = config["General"]
 
     # Check for debugging
-    if "Debug" in general and general["Debug"] == "true":
+    if debug_level(general) == logging.DEBUG:
         log.info("Debug logging enabled")
         set_debug_level(logging.DEBUG)
+    tracer.set_path(trace_path(general))
+
+    # Reuse the OAuth token from before the restart and keep it fresh
+    tokens.set_path(token_path())
+    refresher = TokenRefresher(config["RedditAPI"])
+    threading.Thread(target=token_thread, args=(refresher,), daemon=True).start()
 
     # Start database
+    codec.set_algorithm(blob_compression(general))
     db = Database(
-        os.environ.get("DB_PATH")
-        or os.path.expandvars("$HOME/.config/reddit-scheduler/database.sqlite")
+        SqliteStorage(
+            os.environ.get("DB_PATH")
+            or os.path.expandvars("$HOME/.config/reddit-scheduler/database.sqlite")
+        ),
+        spacing=general.getint("PostSpacing", fallback=POST_SPACING),
     )
     threading.Thread(target=database_thread, args=(db,)).start()
 
     # Start poster
-    poster = Poster(
-        config["RedditAPI"],
-        bool(os.environ.get("DRY_RUN")) or general.getboolean("DryRun"),
-        general.getint("PostInterval"),
-    )
+    poster = Poster(config["RedditAPI"], **poster_settings(general))
     poster.link_database(db)
-    threading.Thread(target=poster_thread, args=(poster,)).start()
+    # Daemon threads so that the process can exit when the rpc server stops
+    threading.Thread(target=poster_thread, args=(poster,), daemon=True).start()
+
+    # Start watchdog
+    interval = watchdog_interval()
+    if interval is not None:
+        watchdog = Watchdog(poster, interval)
+        threading.Thread(target=watchdog_thread, args=(watchdog,), daemon=True).start()
+
+    # Start submission reconciler. Also runs with AsyncImageSubmit off so that
+    # posts submitted before it was turned off still get confirmed.
+    reconciler = SubmissionReconciler(config["RedditAPI"]).link_database(db)
+    threading.Thread(target=reconciler_thread, args=(reconciler,), daemon=True).start()
+
+    # Start stats collector
+    collector = StatsCollector(config["RedditAPI"]).link_database(db)
+    threading.Thread(target=stats_thread, args=(collector,), daemon=True).start()
+
+    # Start requirements fetcher
+    fetcher = RequirementsFetcher(config["RedditAPI"]).link_database(db)
+    threading.Thread(target=requirements_thread, args=(fetcher,), daemon=True).start()
+
+    flairs = FlairCache(config["RedditAPI"])
+
+    # Start drop directory ingester
+    drop_dir = general.get("DropDirectory", fallback="")
+    if drop_dir != "":
+        ingester = (
+            DropDirectoryIngester(os.path.expanduser(drop_dir), flairs)
+            .link_database(db)
+            .link_poster(poster)
+        )
+        threading.Thread(target=ingester_thread, args=(ingester,), daemon=True).start()
+
+    # Reload config on SIGHUP, off the main thread since the Poster may be busy
+    reloader = ConfigReloader(
+        config, poster, [reconciler, collector, fetcher, flairs, refresher]
+    )
+    signal.signal(
+        signal.SIGHUP,
+        lambda *_: threading.Thread(target=reloader.reload, daemon=True).start(),
+    )
 
     # Start RPC server
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    server = grpc.server(
+        futures.ThreadPoolExecutor(
+            max_workers=general.getint("RpcWorkers", fallback=RPC_WORKERS)
+        ),
+        **rpc_server_settings(general),
+    )
     reddit_grpc.add_RedditSchedulerServicer_to_server(
-        Servicer().link_database(db).set_reddit_config(config["RedditAPI"]), server
+        Servicer()
+        .link_database(db)
+        .link_poster(poster)
+        .link_flair_cache(flairs)
+        .set_compression(*rpc_compression(general)),
+        server,
     )
-    addr = f"[::]:{general.getint('Port')}"
-    server.add_insecure_port(addr)
-    log.debug("Starting rpc server on %s", addr)
-    log.info("Service started on %s", addr)
+    fds = daemon.listen_fds()
+    if fds:
+        port = server.add_insecure_port("127.0.0.1:0")
+        proxy = SocketActivationProxy(fds[0], port)
+        threading.Thread(target=proxy_thread, args=(proxy,), daemon=True).start()
+        log.info("Service started on socket passed by systemd")
+
+        idle_timeout = general.getfloat("IdleTimeout", fallback=0)
+        if idle_timeout > 0:
+            monitor = (
+                IdleMonitor(proxy, server, idle_timeout)
+                .link_database(db)
+                .link_poster(poster)
+            )
+            threading.Thread(target=idle_thread, args=(monitor,), daemon=True).start()
+    else:
+        addr = f"[::]:{general.getint('Port')}"
+        server.add_insecure_port(addr)
+        log.debug("Starting rpc server on %s", addr)
+        log.info("Service started on %s", addr)
 
     server.start()
     daemon.notify("READY=1")
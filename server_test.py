@@ -1,9 +1,19 @@
+import json
+import marshal
+import os
+import shutil
+import socket
+import threading
+import time
 import unittest
+from unittest import mock
 import sqlite3
+import tempfile
 import reddit_pb2 as rpc
 
 from server import *
-from typing import List
+from types import SimpleNamespace
+from typing import List, Optional
 
 TEXT_POST = rpc.Post(
     title="Hello there",
@@ -42,6 +52,18 @@ URL_POST = rpc.Post(
 )
 
 
+def adopt(conn: sqlite3.Connection, clock: Optional[Clock] = None) -> Database:
+    """A Database on the connection, which tests can check directly."""
+    storage = SqliteStorage("")
+    storage.adopt_connection_for_testing(conn)
+    return Database(storage, clock)
+
+
+def schedule(db: Database, post: rpc.Post) -> str:
+    """Schedules the post and returns why it was rejected, or ""."""
+    return db.schedule_posts([post])[0].error_msg
+
+
 def get_all_rows(conn: sqlite3.Connection) -> List[sqlite3.Row]:
     rows = []
     for row in conn.execute(QUERY_ALL):
@@ -54,7 +76,7 @@ class ServerTest(unittest.TestCase):
     def setUpClass(cls):
         cls._conn = sqlite3.connect(":memory:")
         cls._conn.row_factory = sqlite3.Row
-        cls._conn.execute(QUERY_CREATE_TABLE)
+        create_tables(cls._conn)
 
     @classmethod
     def tearDownClass(cls):
@@ -62,6 +84,10 @@ class ServerTest(unittest.TestCase):
 
     def tearDown(self):
         self._conn.execute("DELETE FROM Queue")
+        self._conn.execute("DELETE FROM ChangeLog")
+        self._conn.execute("DELETE FROM Requirements")
+        self._conn.execute("DELETE FROM Payloads")
+        self._conn.execute("DELETE FROM Shares")
 
     def test_make_post_from_row(self):
         p = TEXT_POST
@@ -75,10 +101,9 @@ class ServerTest(unittest.TestCase):
         self.assertEqual(post.data.text.body, p.data.text.body)
         self.assertEqual(post.flair_id, p.flair_id)
 
-    def test_db_add_post(self):
-        db = Database("")
-        db.adopt_connection_for_testing(self._conn)
-        db.add_post(TEXT_POST)
+    def test_db_schedule_post(self):
+        db = adopt(self._conn)
+        schedule(db, TEXT_POST)
         rows = get_all_rows(self._conn)
         self.assertGreater(len(rows), 0)
         e = rows[0]
@@ -86,11 +111,187 @@ class ServerTest(unittest.TestCase):
         self.assertEqual(e["error"], None)
         self.assertEqual(e["posted"], 0)
 
+    def test_db_schedule_post_with_targets(self):
+        db = adopt(self._conn)
+        p = rpc.Post()
+        p.CopyFrom(POLL_POST)
+        p.targets.add(subreddit="second", flair_text="flair")
+        p.targets.add(subreddit="third", delay=60)
+        self.assertEqual(schedule(db, p), "")
+
+        entries = db.storage.list()
+        self.assertEqual(
+            [e.post.subreddit for e in entries], [p.subreddit, "second", "third"]
+        )
+        self.assertEqual(entries[1].post.flair_text, "flair")
+        self.assertEqual(entries[2].post.scheduled_time, p.scheduled_time + 60)
+        for e in entries:
+            self.assertEqual(e.post.data, p.data)
+            self.assertEqual(len(e.post.targets), 0)
+        # The data is only stored once
+        for row in self._conn.execute("SELECT post FROM Queue"):
+            self.assertFalse(rpc.Post.FromString(row["post"]).HasField("data"))
+        self.assertEqual(
+            self._conn.execute("SELECT COUNT(*) FROM Payloads").fetchone()[0], 1
+        )
+
+        for e in entries:
+            db.edit_post(
+                rpc.EditPostRequest(operation=rpc.EditPostRequest.DELETE, id=e.id)
+            )
+        self.assertEqual(
+            self._conn.execute("SELECT COUNT(*) FROM Payloads").fetchone()[0], 0
+        )
+
+    def test_db_auto_schedule(self):
+        db = adopt(self._conn, SimulatedClock(1000))
+
+        def schedule(
+            scheduled_time: int, auto: Optional[rpc.AutoSchedule] = None, **kwargs
+        ) -> rpc.SchedulePostReply:
+            p = rpc.Post()
+            p.CopyFrom(TEXT_POST)
+            p.scheduled_time = scheduled_time
+            if auto is not None:
+                p.auto_schedule.CopyFrom(auto)
+            for field, value in kwargs.items():
+                setattr(p, field, value)
+            return db.schedule_posts([p])[0]
+
+        auto = rpc.AutoSchedule()
+        manual = schedule(10000)
+        self.assertEqual((manual.scheduled_time, manual.warning), (10000, ""))
+        self.assertEqual(schedule(10000, auto).scheduled_time, 10600)
+        self.assertIn(
+            "No time", schedule(10000, rpc.AutoSchedule(until=11000)).error_msg
+        )
+        self.assertIn("r/test", schedule(10300).warning)
+        # Closer spacing fits before the manual post at 10300
+        self.assertEqual(
+            schedule(10000, rpc.AutoSchedule(spacing=60)).scheduled_time, 10060
+        )
+        # Never earlier than now
+        self.assertEqual(schedule(1, auto).scheduled_time, 1000)
+
+        # Posts that went up or were deleted free their slot
+        entries = db.storage.unposted()
+        db.mark_posted(entries[1].id)
+        for e in entries[2:4]:
+            db.edit_post(
+                rpc.EditPostRequest(operation=rpc.EditPostRequest.DELETE, id=e.id)
+            )
+        self.assertEqual(schedule(10000, auto).scheduled_time, 10600)
+
+        # Targets are spaced out in their own subreddits
+        p = rpc.Post()
+        p.CopyFrom(TEXT_POST)
+        p.subreddit = "other"
+        p.scheduled_time = 10000
+        p.auto_schedule.CopyFrom(auto)
+        p.targets.add(subreddit="test", delay=60)
+        reply = db.schedule_posts([p])[0]
+        self.assertEqual(reply.scheduled_time, 11140)
+        self.assertFalse(p.HasField("auto_schedule"))
+
+        # The index is rebuilt from the queue after a restart
+        db = adopt(self._conn, SimulatedClock(1000))
+        self.assertEqual(schedule(10000, auto).scheduled_time, 11800)
+
+    def test_db_idempotency_key(self):
+        db = adopt(self._conn, SimulatedClock(1000))
+
+        def schedule(key: str) -> rpc.SchedulePostReply:
+            p = rpc.Post()
+            p.CopyFrom(TEXT_POST)
+            p.scheduled_time = 10000
+            p.auto_schedule.CopyFrom(rpc.AutoSchedule())
+            p.idempotency_key = key
+            return db.schedule_posts([p])[0]
+
+        first = schedule("a")
+        # A resent post is reported as scheduled at its slot, not added again
+        self.assertEqual(schedule("a"), first)
+        self.assertEqual(len(db.storage.list()), 1)
+        self.assertNotEqual(schedule("b").scheduled_time, first.scheduled_time)
+
+        entries = db.storage.list()
+        self.assertEqual(len(entries), 2)
+        for e in entries:
+            self.assertEqual(e.post.idempotency_key, "")
+
+    def test_db_reschedule(self):
+        db = adopt(self._conn)
+        for _ in range(3):
+            schedule(db, TEXT_POST)
+        ids = [e.id for e in db.storage.list()]
+        db.mark_error(ids[1], "failed")
+
+        def reschedule(**kwargs):
+            return db.edit_post(
+                rpc.EditPostRequest(operation=rpc.EditPostRequest.RESCHEDULE, **kwargs)
+            )
+
+        self.assertEqual(reschedule(id=ids[0], ids=ids[1:], offset=60), "")
+        entries = db.storage.list()
+        for e in entries:
+            self.assertEqual(e.post.scheduled_time, TEXT_POST.scheduled_time + 60)
+            self.assertEqual(e.status, rpc.PostStatus.PENDING)
+        rows = self._conn.execute("SELECT scheduled_time FROM Queue").fetchall()
+        self.assertEqual([r[0] for r in rows], [TEXT_POST.scheduled_time + 60] * 3)
+
+        # Nothing moves if one of the posts can't be
+        db.mark_posted(ids[2])
+        self.assertEqual(
+            reschedule(id=ids[0], ids=ids[1:], scheduled_time=5000),
+            ERR_ALREADY_POSTED % ids[2],
+        )
+        self.assertEqual(
+            db.get_entry(ids[0]).post.scheduled_time, TEXT_POST.scheduled_time + 60
+        )
+        self.assertEqual(reschedule(id=ids[0], scheduled_time=5000), "")
+        self.assertEqual(db.get_entry(ids[0]).post.scheduled_time, 5000)
+
+    def test_db_update(self):
+        db = adopt(self._conn)
+        p = rpc.Post()
+        p.CopyFrom(TEXT_POST)
+        p.targets.add(subreddit="second")
+        schedule(db, p)
+        ids = [e.id for e in db.storage.list()]
+
+        def update(id, paths, post):
+            return db.edit_post(
+                rpc.EditPostRequest(
+                    operation=rpc.EditPostRequest.UPDATE,
+                    id=id,
+                    update_mask={"paths": paths},
+                    post=post,
+                )
+            )
+
+        self.assertEqual(update(ids[0], ["title"], rpc.Post(title="New")), "")
+        self.assertEqual(db.get_entry(ids[0]).post.title, "New")
+        self.assertEqual(db.get_entry(ids[0]).post.data, TEXT_POST.data)
+        self.assertEqual(db.get_entry(ids[1]).post.title, TEXT_POST.title)
+
+        body = rpc.Post(data=rpc.Data(text=rpc.TextPost(body="new body")))
+        self.assertEqual(update(ids[1], ["data.text.body"], body), "")
+        self.assertEqual(db.get_entry(ids[1]).post.data.text.body, "new body")
+        self.assertEqual(db.get_entry(ids[0]).post.data, TEXT_POST.data)
+
+        self.assertEqual(
+            update(ids[0], ["subreddit"], rpc.Post(subreddit="x")),
+            ERR_UNEDITABLE_FIELD % ("subreddit", ", ".join(EDITABLE_FIELDS)),
+        )
+        self.assertEqual(
+            update(ids[0], ["data.poll.selftext"], rpc.Post()),
+            ERR_WRONG_POST_TYPE % (ids[0], "data.poll.selftext"),
+        )
+
     def test_db_mark_error(self):
-        db = Database("")
-        db.adopt_connection_for_testing(self._conn)
+        db = adopt(self._conn)
 
-        db.queue_command(DbCommand("post", POLL_POST))
+        db.queue_command(DbCommand("schedule", [POLL_POST]))
         db.step()
 
         e = get_all_rows(self._conn)[0]
@@ -102,8 +303,7 @@ class ServerTest(unittest.TestCase):
         self.assertEqual(e["error"], err)
 
     def test_db_delete_unknown(self):
-        db = Database("")
-        db.adopt_connection_for_testing(self._conn)
+        db = adopt(self._conn)
 
         cmd = DbCommand(
             "edit",
@@ -116,6 +316,1234 @@ class ServerTest(unittest.TestCase):
         self.assertEqual(reply.obj, ERR_UNKNOWN_ID % 123)
         self.assertTrue(reply.is_err)
 
+    def test_db_watchers(self):
+        db = adopt(self._conn)
+        watcher = db.add_watcher()
+
+        schedule(db, TEXT_POST)
+        added = watcher.events.get_nowait()
+        self.assertEqual(added.status, rpc.PostStatus.PENDING)
+        self.assertEqual(added.post.title, TEXT_POST.title)
+
+        db.mark_posted(added.id)
+        self.assertEqual(watcher.events.get_nowait().status, rpc.PostStatus.POSTED)
+
+        db.edit_post(
+            rpc.EditPostRequest(operation=rpc.EditPostRequest.DELETE, id=added.id)
+        )
+        deleted = watcher.events.get_nowait()
+        self.assertEqual(deleted.id, added.id)
+        self.assertEqual(deleted.status, rpc.PostStatus.DELETED)
+
+        db.remove_watcher(watcher)
+        schedule(db, TEXT_POST)
+        self.assertTrue(watcher.events.empty())
+
+    def test_db_drops_slow_watcher(self):
+        db = adopt(self._conn)
+        watcher = db.add_watcher()
+        for _ in range(WATCH_BUFFER + 1):
+            schedule(db, TEXT_POST)
+        self.assertTrue(watcher.dropped)
+        self.assertFalse(db.has_watchers())
+
+    def test_db_sync_posts(self):
+        db = adopt(self._conn)
+        schedule(db, TEXT_POST)
+        schedule(db, POLL_POST)
+
+        full = db.sync_posts(0)
+        self.assertEqual(len(full.posts), 2)
+        self.assertEqual(len(full.deleted_ids), 0)
+
+        unchanged = db.sync_posts(full.seq)
+        self.assertEqual(unchanged.seq, full.seq)
+        self.assertEqual(len(unchanged.posts), 0)
+
+        posted_id = full.posts[0].id
+        deleted_id = full.posts[1].id
+        db.mark_posted(posted_id)
+        db.edit_post(
+            rpc.EditPostRequest(operation=rpc.EditPostRequest.DELETE, id=deleted_id)
+        )
+        delta = db.sync_posts(full.seq)
+        self.assertGreater(delta.seq, full.seq)
+        self.assertEqual([e.id for e in delta.posts], [posted_id])
+        self.assertEqual(delta.posts[0].status, rpc.PostStatus.POSTED)
+        self.assertEqual(list(delta.deleted_ids), [deleted_id])
+
+    def test_db_priority_order(self):
+        db = adopt(self._conn)
+        low = DbCommand("all", None, PRIORITY_LOW)
+        high = DbCommand("eligible", None, PRIORITY_HIGH)
+        db.queue_command(low)
+        db.queue_command(high)
+
+        db.step()
+        self.assertFalse(high.oneshot.empty())
+        self.assertTrue(low.oneshot.empty())
+        db.step()
+        self.assertFalse(low.wait_for_answer().is_err)
+
+    def test_db_drops_abandoned_commands(self):
+        db = adopt(self._conn)
+        expired = DbCommand("schedule", [TEXT_POST], deadline=time.monotonic() - 1)
+        cancelled = DbCommand("schedule", [TEXT_POST])
+        db.queue_command(expired)
+        db.queue_command(cancelled)
+        cancelled.cancel()
+        db.step()
+        db.step()
+
+        self.assertEqual(len(get_all_rows(self._conn)), 0)
+        self.assertEqual(expired.oneshot.get_nowait().obj, ERR_ABANDONED)
+        self.assertEqual(cancelled.oneshot.get_nowait().obj, ERR_ABANDONED)
+
+    def test_rpc_commands_register_once(self):
+        callbacks = []
+        context = SimpleNamespace(add_callback=lambda cb: callbacks.append(cb) or True)
+        commands = RpcCommands(context)
+        pages = [DbCommand("page", i) for i in range(3)]
+        commands.track(pages[0])
+        commands.track(pages[1])
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertTrue(pages[1].is_abandoned())
+        # Commands of an RPC that already ended are cancelled right away
+        commands.track(pages[2])
+        self.assertTrue(pages[2].is_abandoned())
+
+    def test_db_admission_control(self):
+        db = Database(MemoryStorage())
+        limit = int(ADMISSION_LIMITS[PRIORITY_LOW] * DB_QUEUE_SIZE)
+        for _ in range(limit):
+            db.queue_command(DbCommand("all", None, PRIORITY_LOW))
+        with self.assertRaises(DbOverloaded) as cm:
+            db.queue_command(DbCommand("all", None, PRIORITY_LOW))
+        self.assertGreater(cm.exception.retry_after, 0)
+        # Higher priorities still get through
+        db.queue_command(DbCommand("schedule", [TEXT_POST]))
+        db.queue_command(DbCommand("mark_posted", 1, PRIORITY_HIGH))
+
+    def test_check_requirements(self):
+        reqs = make_requirements(
+            {
+                "title_text_min_length": 5,
+                "is_flair_required": True,
+                "body_restriction_policy": "required",
+                "domain_blacklist": ["google.com"],
+            },
+            {"submission_type": "any", "allow_images": False},
+        )
+        self.assertEqual(list(reqs.disallowed_types), ["image"])
+        self.assertEqual(check_requirements(POLL_POST, reqs), "")
+        self.assertIn("flair", check_requirements(TEXT_POST, reqs))
+
+        post = rpc.Post()
+        post.CopyFrom(POLL_POST)
+        post.title = "Poll"
+        self.assertIn("at least 5", check_requirements(post, reqs))
+
+        reqs.disallowed_types.append("poll")
+        self.assertIn("poll posts", check_requirements(POLL_POST, reqs))
+
+        post.CopyFrom(URL_POST)
+        post.flair_id = "flair"
+        post.data.url.url = "https://www.google.com/search"
+        self.assertIn("google.com", check_requirements(post, reqs))
+
+    def test_db_schedule_checks_requirements(self):
+        db = adopt(self._conn)
+
+        # Unknown subreddits are let through and their rules requested
+        self.assertEqual(schedule(db, TEXT_POST), "")
+        self.assertEqual(db.requirements_requests.get_nowait(), "test")
+        schedule(db, TEXT_POST)
+        self.assertTrue(db.requirements_requests.empty())
+
+        db.store_requirements("Test", rpc.SubredditRequirements(flair_required=True))
+        self.assertIn("flair", schedule(db, TEXT_POST))
+        self.assertEqual(len(get_all_rows(self._conn)), 2)
+
+    def test_db_export_import(self):
+        db = adopt(self._conn)
+        for _ in range(EXPORT_PAGE_SIZE + 1):
+            schedule(db, TEXT_POST)
+        first = db.get_page(0)
+        self.assertEqual(len(first), EXPORT_PAGE_SIZE)
+        rest = db.get_page(first[-1].id)
+        self.assertEqual(len(rest), 1)
+
+        posted = rpc.PostDbEntry(post=POLL_POST, status=rpc.PostStatus.POSTED)
+        errored = rpc.PostDbEntry(
+            post=URL_POST, status=rpc.PostStatus.ERROR, error="oops"
+        )
+        invalid = rpc.PostDbEntry(post=rpc.Post(title="no subreddit"))
+        self.assertEqual(db.import_posts([posted, invalid, errored]), 2)
+
+        imported = db.get_page(rest[-1].id)
+        self.assertEqual(
+            [(e.status, e.error) for e in imported],
+            [(rpc.PostStatus.POSTED, ""), (rpc.PostStatus.ERROR, "oops")],
+        )
+
+        # Posts already sent to Reddit round-trip as posted, never pending
+        schedule(db, URL_POST)
+        db.mark_submitted(imported[-1].id + 1)
+        submitted = db.get_page(imported[-1].id)
+        confirmed = rpc.PostDbEntry(
+            post=URL_POST,
+            status=rpc.PostStatus.ERROR,
+            submission_id="t3_abc",
+            permalink="/r/testing/abc/",
+        )
+        deleted = rpc.PostDbEntry(post=URL_POST, status=rpc.PostStatus.DELETED)
+        self.assertEqual(submitted[0].status, rpc.PostStatus.SUBMITTED)
+        self.assertEqual(db.import_posts(submitted + [confirmed, deleted]), 2)
+        imported = db.get_page(submitted[-1].id)
+        self.assertEqual(
+            [(e.status, e.error, e.submission_id, e.permalink) for e in imported],
+            [
+                (rpc.PostStatus.POSTED, "", "", ""),
+                (rpc.PostStatus.POSTED, "", "t3_abc", "/r/testing/abc/"),
+            ],
+        )
+        eligible = [e.id for e in db.storage.eligible(URL_POST.scheduled_time)]
+        self.assertNotIn(imported[0].id, eligible)
+
+    def test_db_next_due(self):
+        db = adopt(self._conn)
+        self.assertIsNone(db.next_due())
+        schedule(db, TEXT_POST)
+        later = rpc.Post()
+        later.CopyFrom(POLL_POST)
+        later.scheduled_time = 2000
+        schedule(db, later)
+        self.assertEqual(db.next_due(), 1000)
+        db.mark_posted(get_all_rows(self._conn)[0]["id"])
+        self.assertEqual(db.next_due(), 2000)
+
+    def test_blob_codec(self):
+        long_post = rpc.Post()
+        long_post.CopyFrom(TEXT_POST)
+        long_post.data.text.body = "a long and repetitive body " * 100
+        blob = long_post.SerializeToString()
+        image = rpc.Post(
+            title="Image",
+            data=rpc.Data(image=rpc.ImagePost(image_data=os.urandom(100 * 1024))),
+        ).SerializeToString()
+        for algorithm, header in [("zlib", BlobCodec.ZLIB), ("zstd", BlobCodec.ZSTD)]:
+            c = BlobCodec(algorithm)
+            packed = c.encode(blob)
+            self.assertEqual(packed[0], header)
+            self.assertLess(len(packed), len(blob) // 10)
+            self.assertEqual(c.decode(packed), blob)
+            # Blobs that don't get smaller, and rows from before compression
+            short = TEXT_POST.SerializeToString()
+            self.assertEqual(c.encode(short), short)
+            self.assertEqual(c.encode(image), image)
+            self.assertEqual(c.decode(short), short)
+        self.assertEqual(BlobCodec("none").encode(blob), blob)
+
+        # New posts use the newest dictionary, older ones stay readable
+        trained = BlobCodec("zstd")
+        old = trained.encode(blob)
+        dictionary = zstandard.train_dictionary(
+            1024,
+            [
+                rpc.Post(
+                    title=f"Post number {i}",
+                    subreddit="test",
+                    data=rpc.Data(text=rpc.TextPost(body=f"body of post {i} " * 5)),
+                ).SerializeToString()
+                for i in range(200)
+            ],
+        )
+        trained.add_dictionary(dictionary.as_bytes())
+        self.assertLess(len(trained.encode(blob)), len(old))
+        self.assertEqual(trained.decode(trained.encode(blob)), blob)
+        self.assertEqual(trained.decode(old), blob)
+        with self.assertRaises(ValueError):
+            BlobCodec("zstd").decode(trained.encode(blob))
+
+        # Stored compressed and read back transparently
+        db = adopt(self._conn)
+        self.assertEqual(schedule(db, long_post), "")
+        row = get_all_rows(self._conn)[0]
+        self.assertIn(row["post"][0], [BlobCodec.ZLIB, BlobCodec.ZSTD])
+        self.assertEqual(db.get_entry(row["id"]).post, long_post)
+
+    def test_resolve_flairs(self):
+        fetched = []
+
+        def flairs_for(_, subreddit):
+            fetched.append(subreddit)
+            time.sleep(0.2)
+            if subreddit == "private":
+                raise ValueError("403")
+            return [rpc.Flair(text=f"{subreddit} flair", id=f"{subreddit}-id")]
+
+        cache = FlairCache(REDDIT_CONFIG)
+        with mock.patch("server.get_reddit"), mock.patch(
+            "server.flairs_for_subdreddit", flairs_for
+        ):
+            subreddits = ["one", "two", "One", "three", "private"]
+            texts = ["one flair", "two flair", "missing", "three flair", "x"]
+            start = time.monotonic()
+            flairs, errors = cache.resolve(subreddits, texts)
+            # Fetched once each, at the same time
+            self.assertLess(time.monotonic() - start, 0.6)
+            self.assertEqual(sorted(fetched), ["one", "private", "three", "two"])
+            self.assertEqual(
+                [f.id for f in flairs], ["one-id", "two-id", "", "three-id", ""]
+            )
+            self.assertEqual(
+                errors,
+                [
+                    "",
+                    "",
+                    "r/One doesn't have a flair called missing",
+                    "",
+                    "couldn't fetch the flairs of r/private",
+                ],
+            )
+
+            reply = (
+                Servicer()
+                .link_flair_cache(cache)
+                .ResolveFlairs(
+                    rpc.ResolveFlairsRequest(
+                        subreddits=["two"], flair_texts=["two flair"]
+                    ),
+                    None,
+                )
+            )
+            self.assertEqual(
+                list(reply.flairs), [rpc.Flair(text="two flair", id="two-id")]
+            )
+            self.assertEqual(len(fetched), 4)
+
+    def test_rpc_settings(self):
+        parser = ConfigParser()
+        parser.read_string(
+            "[General]\nMaxMessageSize = 1\nMaxConcurrentRpcs = 4\n"
+            "KeepaliveTime = 30\nCompression = Gzip\nCompressionThreshold = 2\n"
+        )
+        general = parser["General"]
+        settings = rpc_server_settings(general)
+        options = dict(settings["options"])
+        self.assertEqual(options["grpc.max_receive_message_length"], 1024 * 1024)
+        self.assertEqual(options["grpc.keepalive_time_ms"], 30000)
+        self.assertEqual(settings["maximum_concurrent_rpcs"], 4)
+        self.assertEqual(rpc_compression(general), (grpc.Compression.Gzip, 2048))
+
+        parser["General"]["Compression"] = "brotli"
+        self.assertRaises(ValueError, rpc_compression, general)
+
+        servicer = Servicer().set_compression(grpc.Compression.Gzip, 2048)
+        context = mock.Mock()
+        servicer.compress_large(context, rpc.ListPostsReply())
+        context.set_compression.assert_not_called()
+        big = rpc.ListPostsReply(
+            posts=[rpc.PostDbEntry(post=rpc.Post(title="a" * 4096))]
+        )
+        servicer.compress_large(context, big)
+        context.set_compression.assert_called_once_with(grpc.Compression.Gzip)
+
+    def test_profiler(self):
+        db = adopt(self._conn)
+        timer = StatementTimer()
+        db.time_statements(timer)
+        db.queue_command(DbCommand("schedule", [TEXT_POST]))
+        db.step()
+        db.time_statements(None)
+        self.assertNotIn("step", vars(db))
+        timings = {t.sql: t for t in timer.results()}
+        insert = " ".join(QUERY_INSERT_POST.split())
+        self.assertIn(insert, timings)
+        self.assertEqual(timings[insert].count, 1)
+
+        class Worker:
+            def work(self, n):
+                return sum(range(n))
+
+        worker = Worker()
+        profiler = Profiler(worker, "work", 2)
+        profiler.start()
+        for _ in range(3):
+            self.assertEqual(worker.work(10), 45)
+        self.assertTrue(profiler.done.is_set())
+        reply = profiler.stop(5)
+        self.assertNotIn("work", vars(worker))
+        self.assertEqual(reply.samples, 2)
+        stats = marshal.loads(reply.pstats)
+        self.assertTrue(any(name == "work" for _, _, name in stats))
+
+    def test_tracing(self):
+        image = rpc.ImagePost(image_data=b"x" * 100000, extension="png")
+        post = rpc.Post(title="t", data=rpc.Data(image=image))
+        self.assertIn("image_data=<100000 bytes>", str(Bounded(post)))
+        command = DbCommand("schedule", [post])
+        self.assertLess(len(str(command)), 2 * REPR_LIMIT)
+
+        db = adopt(self._conn)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.jsonl")
+            tracer.set_path(path)
+            try:
+                db.queue_command(DbCommand("schedule", [TEXT_POST], trace_id="abc"))
+                db.step()
+            finally:
+                tracer.set_path("")
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+        self.assertEqual(
+            [(s["trace"], s["span"], s["command"]) for s in spans],
+            [("abc", "queue_wait", "schedule"), ("abc", "sql", "schedule")],
+        )
+
+    def test_simulated_clock(self):
+        clock = SimulatedClock(0)
+        db = adopt(self._conn, clock)
+        schedule(db, TEXT_POST)
+
+        def eligible() -> List[rpc.PostDbEntry]:
+            command = DbCommand("eligible", None)
+            db.handle_command(command)
+            return command.wait_for_answer().obj
+
+        self.assertEqual(eligible(), [])
+        event = threading.Event()
+        self.assertFalse(clock.wait(event, TEXT_POST.scheduled_time))
+        self.assertEqual(clock.time(), TEXT_POST.scheduled_time)
+        self.assertEqual(len(eligible()), 1)
+        event.set()
+        self.assertTrue(clock.wait(event, 100))
+        self.assertEqual(clock.time(), TEXT_POST.scheduled_time)
+
+    def test_socket_activation_proxy(self):
+        echo = socket.create_server(("127.0.0.1", 0))
+        activation = socket.create_server(("127.0.0.1", 0))
+
+        def serve_echo():
+            conn, _ = echo.accept()
+            pipe(conn, conn)
+            conn.close()
+
+        threading.Thread(target=serve_echo, daemon=True).start()
+        proxy = SocketActivationProxy(
+            os.dup(activation.fileno()), echo.getsockname()[1]
+        )
+        client = socket.create_connection(activation.getsockname())
+        proxy.step()
+        self.assertEqual(proxy.idle_for(), 0)
+        self.assertFalse(proxy.pause())
+
+        client.sendall(b"hello")
+        self.assertEqual(client.recv(5), b"hello")
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(client.recv(5), b"")
+        client.close()
+        for _ in range(100):
+            if proxy.connections == 0:
+                break
+            time.sleep(0.01)
+        self.assertTrue(proxy.pause())
+
+        for s in [proxy.listener, echo, activation]:
+            s.close()
+
+
+REDDIT_CONFIG = {
+    "ClientId": "id",
+    "ClientSecret": "secret",
+    "Username": "user",
+    "Password": "password",
+}
+
+
+class StorageConformance:
+    """Tests every Storage implementation has to pass. Subclasses pick the
+    implementation with make_storage."""
+
+    def make_storage(self) -> Storage:
+        raise NotImplementedError
+
+    def setUp(self):
+        self.storage = self.make_storage()
+
+    def add(self, scheduled_time: int, targets: int = 0) -> List[int]:
+        p = rpc.Post()
+        p.CopyFrom(TEXT_POST)
+        p.scheduled_time = scheduled_time
+        for i in range(targets):
+            p.targets.add(subreddit=f"target{i}", delay=i + 1)
+        return self.storage.add(split_targets(p))
+
+    def test_add_and_get(self):
+        ids = self.add(1000, targets=2)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(sorted(ids), ids)
+        self.assertLess(ids[-1], self.add(1000)[0])
+        entries = self.storage.list()
+        self.assertEqual([e.id for e in entries], sorted(e.id for e in entries))
+        self.assertEqual(
+            [e.post.subreddit for e in entries[:3]], ["test", "target0", "target1"]
+        )
+        for e in entries:
+            self.assertEqual(e.status, rpc.PostStatus.PENDING)
+            self.assertEqual(e.post.data, TEXT_POST.data)
+        self.assertEqual(self.storage.get(ids[1]), entries[1])
+        self.assertIsNone(self.storage.get(12345))
+
+        # What callers get back is theirs to change
+        entries[0].post.title = "changed"
+        self.assertEqual(self.storage.get(ids[0]).post.title, TEXT_POST.title)
+
+    def test_eligible_and_next_due(self):
+        ids = [self.add(t)[0] for t in [3000, 1000, 2000, 1000]]
+        self.assertEqual([e.id for e in self.storage.eligible(999)], [])
+        self.assertEqual([e.id for e in self.storage.eligible(1000)], [ids[1], ids[3]])
+        self.assertEqual(self.storage.next_due(0), 1000)
+        self.assertEqual(self.storage.next_due(1000), 2000)
+        self.assertIsNone(self.storage.next_due(3000))
+
+        # Failed posts are still eligible but no longer due
+        self.storage.mark_error(ids[1], "failed")
+        self.storage.mark_posted(ids[3])
+        eligible = self.storage.eligible(2000)
+        self.assertEqual([e.id for e in eligible], [ids[1], ids[2]])
+        self.assertEqual(eligible[0].status, rpc.PostStatus.ERROR)
+        self.assertEqual(eligible[0].error, "failed")
+        self.assertEqual(self.storage.next_due(0), 2000)
+        self.assertEqual(self.storage.get(ids[3]).status, rpc.PostStatus.POSTED)
+        self.assertEqual([e.id for e in self.storage.unposted()], ids[:3])
+
+    def test_edit(self):
+        ids = self.add(1000, targets=1)
+        self.storage.mark_error(ids[0], "failed")
+        post = self.storage.get(ids[0]).post
+        post.scheduled_time = 5000
+        post.title = "New"
+        self.storage.edit(ids[0], post)
+        entry = self.storage.get(ids[0])
+        self.assertEqual(entry.post, post)
+        self.assertEqual(entry.status, rpc.PostStatus.PENDING)
+        self.assertEqual(entry.error, "")
+        self.assertEqual(self.storage.next_due(1001), 5000)
+
+        # Changing the data of one target leaves the others alone
+        post.data.text.body = "new body"
+        self.storage.edit(ids[0], post)
+        self.assertEqual(self.storage.get(ids[0]).post.data.text.body, "new body")
+        self.assertEqual(self.storage.get(ids[1]).post.data, TEXT_POST.data)
+
+    def test_delete(self):
+        ids = self.add(1000, targets=1)
+        self.storage.delete(ids[0])
+        self.assertIsNone(self.storage.get(ids[0]))
+        self.assertEqual([e.id for e in self.storage.list()], ids[1:])
+        self.assertEqual([e.id for e in self.storage.eligible(2000)], ids[1:])
+        self.assertEqual(self.storage.get(ids[1]).post.data, TEXT_POST.data)
+
+    def test_upcoming_and_page(self):
+        ids = [self.add(t)[0] for t in [3000, 1000, 2000]]
+        self.storage.mark_error(ids[2], "failed")
+        self.assertEqual([e.id for e in self.storage.upcoming(2999)], [ids[1]])
+        self.assertEqual([e.id for e in self.storage.upcoming(3000)], [ids[1], ids[0]])
+        self.assertEqual([e.id for e in self.storage.page(0, 2)], ids[:2])
+        self.assertEqual([e.id for e in self.storage.page(ids[1], 2)], ids[2:])
+
+    def test_submissions(self):
+        ids = self.add(1000, targets=1)
+        self.storage.mark_submitted(ids[0], 1500)
+        submitted = self.storage.submitted()
+        self.assertEqual([(e.id, t) for e, t in submitted], [(ids[0], 1500)])
+        self.assertEqual(submitted[0][0].status, rpc.PostStatus.SUBMITTED)
+        self.assertEqual([e.id for e in self.storage.eligible(2000)], ids[1:])
+
+        # Confirming keeps the time it was submitted
+        self.storage.confirm_submitted(ids[0], 1600, "t3_a", "/r/test/a")
+        entry = self.storage.get(ids[0])
+        self.assertEqual(entry.status, rpc.PostStatus.POSTED)
+        self.assertEqual((entry.submission_id, entry.permalink), ("t3_a", "/r/test/a"))
+        self.assertEqual(self.storage.submitted(), [])
+        self.assertEqual(
+            self.storage.stale_stats(2000, 0, 10), [(ids[0], "t3_a", 1500)]
+        )
+
+        self.storage.mark_submitted(ids[1], 1700)
+        self.storage.fail_submitted(ids[1], "lost")
+        entry = self.storage.get(ids[1])
+        self.assertEqual((entry.status, entry.error), (rpc.PostStatus.ERROR, "lost"))
+        self.assertEqual(entry.submission_id, "")
+        self.assertEqual([e.id for e in self.storage.eligible(2000)], ids[1:])
+
+    def test_jobs(self):
+        id = self.add(1000)[0]
+        self.storage.confirm_submitted(id, 1000, "t3_a", None)
+        comment = rpc.FollowUp(action=rpc.FollowUp.Action.COMMENT, text="hi")
+        lock = rpc.FollowUp(action=rpc.FollowUp.Action.LOCK)
+        self.storage.add_job(id, 0, comment, 2000)
+        # Already added for this position
+        self.storage.add_job(id, 0, comment, 1500)
+        self.storage.add_job(id, 1, lock, 3000)
+        self.assertEqual(self.storage.due_jobs(1999), [])
+        self.assertEqual(self.storage.next_job(0), 2000)
+
+        jobs = self.storage.due_jobs(2000)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(
+            (jobs[0].post_id, jobs[0].submission_id, jobs[0].follow_up),
+            (id, "t3_a", comment),
+        )
+        self.storage.finish_job(jobs[0].id, 2000, "")
+        self.assertEqual(self.storage.next_job(0), 3000)
+        self.assertEqual([j.follow_up for j in self.storage.due_jobs(5000)], [lock])
+
+        self.storage.delete(id)
+        self.assertIsNone(self.storage.next_job(0))
+
+    def test_stats(self):
+        ids = [self.add(1000)[0] for _ in range(3)]
+        for id in ids:
+            self.storage.confirm_submitted(id, 1000, f"t3_{id}", None)
+        stats = rpc.PostStats(
+            score=5, num_comments=2, upvote_ratio=0.5, fetched_time=2000
+        )
+        self.storage.store_stats(ObjStats(ids[0], stats, "/r/test/a", 5000))
+        self.storage.store_stats(ObjStats(ids[1], None, "", 3000))
+        self.assertEqual(
+            self.storage.stale_stats(2000, 0, 10), [(ids[2], f"t3_{ids[2]}", 1000)]
+        )
+        self.assertEqual(
+            [s[0] for s in self.storage.stale_stats(6000, 0, 10)],
+            [ids[2], ids[1], ids[0]],
+        )
+        self.assertEqual(len(self.storage.stale_stats(6000, 0, 2)), 2)
+        self.assertEqual(self.storage.stale_stats(6000, 1000, 10), [])
+
+        self.assertEqual(self.storage.stats([]), {ids[0]: stats})
+        self.assertEqual(self.storage.stats([ids[1], ids[2]]), {})
+        # More ids than fit in one query, some of them twice
+        many = [ids[0], ids[0]] + list(range(10000, 10000 + 2 * STATS_QUERY_SIZE))
+        self.assertEqual(self.storage.stats(many + [ids[0]]), {ids[0]: stats})
+        entry = self.storage.get(ids[0])
+        self.assertEqual((entry.stats, entry.permalink), (stats, "/r/test/a"))
+
+    def test_changes_since(self):
+        seq = self.storage.changes_since(0).seq
+        ids = self.add(1000, targets=1)
+        self.storage.mark_posted(ids[0])
+        self.storage.delete(ids[1])
+        reply = self.storage.changes_since(seq)
+        self.assertEqual([e.id for e in reply.posts], [ids[0]])
+        self.assertEqual(reply.posts[0].status, rpc.PostStatus.POSTED)
+        self.assertEqual(list(reply.deleted_ids), [ids[1]])
+        self.assertGreater(reply.seq, seq)
+        self.assertEqual(
+            self.storage.changes_since(reply.seq), rpc.SyncPostsReply(seq=reply.seq)
+        )
+
+    def test_import_entry(self):
+        posted = self.storage.import_entry(
+            rpc.PostDbEntry(
+                post=TEXT_POST,
+                status=rpc.PostStatus.POSTED,
+                submission_id="t3_a",
+                permalink="/r/test/a",
+            ),
+            900,
+        )
+        failed = self.storage.import_entry(
+            rpc.PostDbEntry(
+                post=TEXT_POST, status=rpc.PostStatus.ERROR, error="failed"
+            ),
+            900,
+        )
+        entry = self.storage.get(posted)
+        self.assertEqual(entry.status, rpc.PostStatus.POSTED)
+        self.assertEqual((entry.submission_id, entry.permalink), ("t3_a", "/r/test/a"))
+        self.assertEqual(self.storage.stale_stats(1000, 0, 10), [(posted, "t3_a", 900)])
+        eligible = self.storage.eligible(1000)
+        self.assertEqual([(e.id, e.error) for e in eligible], [(failed, "failed")])
+
+    def test_idempotency_keys(self):
+        self.storage.add_idempotency_key("a", 1, 1000)
+        self.storage.add_idempotency_key("b", 2, 2000)
+        self.assertEqual(self.storage.find_idempotency_key("a"), 1)
+        self.assertIsNone(self.storage.find_idempotency_key("c"))
+        self.storage.expire_idempotency_keys(2000)
+        self.assertIsNone(self.storage.find_idempotency_key("a"))
+        self.assertEqual(self.storage.find_idempotency_key("b"), 2)
+
+    def test_requirements(self):
+        reqs = rpc.SubredditRequirements(title_max_length=100)
+        self.storage.store_requirements("test", reqs, 1000)
+        self.assertEqual(self.storage.all_requirements(), {"test": (reqs, 1000)})
+
+
+class SqliteStorageTest(StorageConformance, unittest.TestCase):
+    def make_storage(self) -> Storage:
+        storage = SqliteStorage(":memory:")
+        storage.open()
+        self.addCleanup(storage.close)
+        return storage
+
+
+class MemoryStorageTest(StorageConformance, unittest.TestCase):
+    def make_storage(self) -> Storage:
+        return MemoryStorage()
+
+
+class HangingPoster(Poster):
+    """Poster whose submissions block until released."""
+
+    def __init__(self):
+        super().__init__(REDDIT_CONFIG, dry_run=False, submit_timeout=0.05)
+        self.release = threading.Event()
+        self.fail = False
+
+    def submit(self, entry, staged=None):
+        self.release.wait()
+        if self.fail:
+            raise ValueError("failed")
+        return SimpleNamespace(fullname=f"t3_{entry.id}")
+
+
+class FakeAuthorizer:
+    """Stands in for prawcore's ScriptAuthorizer, counting logins."""
+
+    def __init__(self):
+        self.access_token = None
+        self._expiration_timestamp = None
+        self.scopes = None
+        self.fetches = 0
+
+    def refresh(self):
+        self.fetches += 1
+        self.access_token = f"token{self.fetches}"
+        self._expiration_timestamp = time.time() + 3600
+        self.scopes = {"*"}
+
+
+def fake_reddit(authorizer: FakeAuthorizer):
+    return SimpleNamespace(_core=SimpleNamespace(_authorizer=authorizer))
+
+
+class TokenStoreTest(unittest.TestCase):
+    def test_tokens_shared_and_persisted(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "state", "token.json")
+            store = TokenStore()
+            store.set_path(path)
+            first, second = FakeAuthorizer(), FakeAuthorizer()
+            store.attach(fake_reddit(first), REDDIT_CONFIG)
+            store.attach(fake_reddit(second), REDDIT_CONFIG)
+            first.refresh()
+            second.refresh()
+            # The second instance picked up the token of the first
+            self.assertEqual((first.fetches, second.fetches), (1, 0))
+            self.assertEqual(second.access_token, "token1")
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+            # After a restart the saved token is used right away
+            restarted = TokenStore()
+            restarted.set_path(path)
+            authorizer = FakeAuthorizer()
+            restarted.attach(fake_reddit(authorizer), REDDIT_CONFIG)
+            self.assertEqual(authorizer.access_token, "token1")
+            self.assertGreater(restarted.expiration(REDDIT_CONFIG), time.time())
+
+            # A token Reddit rejected isn't adopted again
+            authorizer.access_token = None
+            authorizer.refresh()
+            self.assertEqual(authorizer.fetches, 1)
+
+    def test_unknown_prawcore_left_alone(self):
+        # Newer prawcore keeps the expiry under another name
+        refresh = mock.Mock()
+        reddit = fake_reddit(SimpleNamespace(refresh=refresh))
+        TokenStore().attach(reddit, REDDIT_CONFIG)
+        self.assertIs(reddit._core._authorizer.refresh, refresh)
+        refresh_auth(reddit, time.time())
+        refresh.assert_not_called()
+
+
+class PosterTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(SqliteStorage(":memory:"))
+        threading.Thread(target=database_thread, args=(self.db,)).start()
+        self.poster = HangingPoster().link_database(self.db)
+
+    def tearDown(self):
+        self.poster.release.set()
+        self.db.queue_command(DbCommand("quit", None))
+
+    def run_db(self, command: str, obj=None):
+        cmd = DbCommand(command, obj)
+        self.db.queue_command(cmd)
+        return cmd.wait_for_answer().obj
+
+    def schedule(self, post: rpc.Post) -> str:
+        return self.run_db("schedule", [post])[0].error_msg
+
+    def test_hung_submission_is_abandoned(self):
+        self.schedule(TEXT_POST)
+        self.schedule(POLL_POST)
+        self.poster.step()
+
+        self.assertEqual(len(self.poster.hung_post_ids()), 2)
+        self.assertFalse(self.poster.stalled())
+        statuses = [e.status for e in self.run_db("all")]
+        self.assertEqual(statuses, [rpc.PostStatus.ERROR] * 2)
+
+        # Still running submissions aren't retried
+        self.poster.step()
+        self.assertEqual(len(self.poster.hung_post_ids()), 2)
+
+        self.poster.release.set()
+        for _ in range(100):
+            if not self.poster.hung_post_ids():
+                break
+            time.sleep(0.01)
+        statuses = [e.status for e in self.run_db("all")]
+        self.assertEqual(statuses, [rpc.PostStatus.POSTED] * 2)
+
+    def test_hung_submissions_share_timeout(self):
+        self.poster.submit_timeout = 0.3
+        for _ in range(3):
+            self.schedule(TEXT_POST)
+        start = time.monotonic()
+        self.poster.step()
+        # Waited for the batch once, not once per post
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertEqual(len(self.poster.hung_post_ids()), 3)
+
+    def test_abandon_finished_submission(self):
+        self.schedule(TEXT_POST)
+        entry = self.run_db("all")[0]
+        # The submission finished right after the step gave up on it
+        future = futures.Future()
+        future.set_result(SimpleNamespace(fullname="t3_a"))
+        self.poster.abandon(entry, future)
+        entry = self.run_db("all")[0]
+        self.assertEqual(entry.status, rpc.PostStatus.POSTED)
+        self.assertEqual(entry.submission_id, "t3_a")
+
+    def test_abandoned_success_not_resubmitted(self):
+        self.schedule(TEXT_POST)
+        self.poster.step()
+        submitted = []
+        submit = self.poster.submit
+        self.poster.submit = lambda entry, staged=None: (
+            submitted.append(entry.id) or submit(entry, staged)
+        )
+        query = self.poster.query
+
+        def stale_query(command, obj, trace_id=None):
+            reply = query(command, obj, trace_id)
+            if command == "eligible":
+                # The submission succeeds after the step read the post as failed
+                self.poster.release.set()
+                for _ in range(100):
+                    if not self.poster.hung_post_ids():
+                        break
+                    time.sleep(0.01)
+            return reply
+
+        self.poster.query = stale_query
+        self.poster.step()
+        self.assertEqual(submitted, [])
+        self.assertEqual(self.run_db("all")[0].status, rpc.PostStatus.POSTED)
+
+    def test_loop_survives_failed_step(self):
+        calls = []
+        parked = threading.Event()
+
+        def step():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ValueError("step failed")
+            # Keep the loop here for the rest of the tests
+            parked.set()
+            threading.Event().wait()
+
+        self.poster.step = step
+        self.poster.step_interval = 0
+        threading.Thread(target=self.poster.start, daemon=True).start()
+        self.assertTrue(parked.wait(5))
+        self.assertEqual(len(calls), 3)
+        self.assertFalse(self.poster.stalled())
+
+        # Stalled once the loop stops coming around
+        self.poster.last_loop -= STALL_TIMEOUT + 1
+        self.assertTrue(self.poster.stalled())
+
+    def test_stalled_when_workers_hang(self):
+        for _ in range(MAX_SUBMISSIONS):
+            self.schedule(TEXT_POST)
+        self.poster.fail = True
+        self.poster.step()
+        self.assertTrue(self.poster.stalled())
+
+        self.poster.release.set()
+        for _ in range(100):
+            if not self.poster.hung_post_ids():
+                break
+            time.sleep(0.01)
+        self.assertFalse(self.poster.stalled())
+        statuses = [e.status for e in self.run_db("all")]
+        self.assertEqual(statuses, [rpc.PostStatus.ERROR] * MAX_SUBMISSIONS)
+
+    def test_sleeps_until_next_post(self):
+        self.poster.step_interval = 10000
+        self.poster.stage_lead = 300
+        self.assertAlmostEqual(self.poster.time_until_next_step(), 10000, delta=2)
+
+        post = rpc.Post()
+        post.CopyFrom(TEXT_POST)
+        post.scheduled_time = int(time.time()) + 1000
+        self.schedule(post)
+        # Wakes up to stage the post first
+        self.assertAlmostEqual(self.poster.time_until_next_step(), 700, delta=2)
+        self.poster.dry_run = True
+        self.assertAlmostEqual(self.poster.time_until_next_step(), 1000, delta=2)
+
+    def test_take_staged(self):
+        staged = StagedMedia("url", None)
+        done = futures.Future()
+        done.set_result(staged)
+        failed = futures.Future()
+        failed.set_exception(ValueError("upload failed"))
+        self.poster.staged = {1: done, 2: failed, 3: futures.Future()}
+
+        self.assertIs(self.poster.take_staged(1), staged)
+        # Another post with the same image doesn't wait on the websocket
+        self.poster.staged[5] = done
+        shared = self.poster.take_staged(5)
+        self.assertEqual(shared.url, "url")
+        self.assertIsNone(shared.websocket_url)
+        self.assertIsNone(self.poster.take_staged(2))
+        self.assertIsNone(self.poster.take_staged(3))
+        self.assertIsNone(self.poster.take_staged(4))
+        self.assertEqual(self.poster.staged, {})
+
+    def test_idle_monitor(self):
+        proxy = SimpleNamespace(idle_for=lambda: 60, pause=lambda: True)
+        server = mock.Mock()
+        monitor = IdleMonitor(proxy, server, 10, SimulatedClock(995))
+        monitor.link_database(self.db).link_poster(self.poster)
+        p = rpc.Post()
+        p.CopyFrom(TEXT_POST)
+        p.follow_ups.add(action=rpc.FollowUp.Action.COMMENT, text="First!", delay=60)
+        self.schedule(p)
+        self.schedule(TEXT_POST)
+        with mock.patch("server.schedule_wakeup", return_value=True) as wakeup:
+            # Due within the idle timeout
+            self.assertFalse(monitor.step())
+            monitor.clock = SimulatedClock(0)
+            self.run_db("mark_submitted", 1)
+            # Waiting for the reconciler to confirm it
+            self.assertFalse(monitor.step())
+            self.run_db("confirm_submitted", ObjSubmission(1, "t3_abc", None))
+            self.run_db("mark_posted", 2)
+            # The follow-up is due within the idle timeout
+            job = self.run_db("next_job", 0)
+            monitor.clock = SimulatedClock(job - 5)
+            self.assertFalse(monitor.step())
+            monitor.clock = SimulatedClock(0)
+            self.assertTrue(monitor.step())
+        wakeup.assert_called_once_with(job)
+        server.stop.assert_called_once()
+
+    def test_idle_monitor_wakes_up_to_stage(self):
+        clock = SimulatedClock(5000)
+        db = Database(MemoryStorage(), clock)
+        threading.Thread(target=database_thread, args=(db,)).start()
+        self.addCleanup(db.queue_command, DbCommand("quit", None))
+        proxy = SimpleNamespace(idle_for=lambda: 600, pause=lambda: True)
+        monitor = IdleMonitor(proxy, mock.Mock(), 60, clock)
+        monitor.link_database(db).link_poster(self.poster)
+        self.assertGreater(self.poster.stage_lead, monitor.idle_timeout)
+        p = rpc.Post()
+        p.CopyFrom(TEXT_POST)
+        p.scheduled_time = 10000
+        query_database(db, "schedule", [p])
+        staging = p.scheduled_time - int(self.poster.stage_lead)
+        with mock.patch("server.schedule_wakeup", return_value=True) as wakeup:
+            self.assertTrue(monitor.step())
+            wakeup.assert_called_once_with(staging)
+            # Staging starts within the idle timeout, though the post is due later
+            clock.advance(staging - 30 - clock.time())
+            self.assertFalse(monitor.step())
+            # Failed posts keep it up until they're retried
+            clock.advance(p.scheduled_time - clock.time())
+            query_database(db, "mark_error", ObjMarkError(1, "failed"))
+            self.assertFalse(monitor.step())
+
+    def test_submission_confirmed(self):
+        self.schedule(TEXT_POST)
+        self.schedule(TEXT_POST)
+        self.run_db("mark_submitted", 1)
+        self.run_db("mark_submitted", 2)
+        submitted = self.run_db("submitted")
+        self.assertEqual(
+            [e.status for e, _ in submitted], [rpc.PostStatus.SUBMITTED] * 2
+        )
+        # Submitted posts aren't eligible again
+        self.assertEqual(self.run_db("eligible"), [])
+
+        self.run_db("confirm_submitted", ObjSubmission(1, "t3_abc", "/r/test/abc/"))
+        self.run_db("fail_submitted", ObjMarkError(2, "lost"))
+        entries = self.run_db("all")
+        self.assertEqual(entries[0].status, rpc.PostStatus.POSTED)
+        self.assertEqual(entries[0].submission_id, "t3_abc")
+        self.assertEqual(entries[0].permalink, "/r/test/abc/")
+        self.assertEqual(entries[1].status, rpc.PostStatus.ERROR)
+        self.assertEqual(entries[1].submission_id, "")
+        self.assertEqual(self.run_db("submitted"), [])
+
+    def test_follow_ups_run_after_submission(self):
+        p = rpc.Post()
+        p.CopyFrom(TEXT_POST)
+        p.follow_ups.add(action=rpc.FollowUp.Action.COMMENT, text="First!")
+        p.follow_ups.add(action=rpc.FollowUp.Action.LOCK, delay=3600)
+        self.assertEqual(self.schedule(p), "")
+        bad = rpc.Post()
+        bad.CopyFrom(TEXT_POST)
+        bad.follow_ups.add(action=rpc.FollowUp.Action.COMMENT)
+        self.assertIn("comment", self.schedule(bad))
+
+        # A follow-up that hangs doesn't hold up the step
+        replied = threading.Event()
+        calls = []
+
+        def reply(body):
+            calls.append((submission_id, body))
+            replied.wait()
+
+        def submission(id):
+            nonlocal submission_id
+            submission_id = id
+            return SimpleNamespace(reply=reply)
+
+        submission_id = None
+        self.poster.reddit = SimpleNamespace(submission=submission)
+        self.poster.release.set()
+        self.poster.step()
+        self.assertEqual(self.run_db("all")[0].status, rpc.PostStatus.POSTED)
+        self.assertEqual(len(self.poster.running_jobs), 1)
+        # Running jobs aren't started twice
+        self.poster.start_due_jobs()
+        replied.set()
+        self.poster.job_executor.shutdown(wait=True)
+        self.assertEqual(calls, [("1", "First!")])
+
+        self.assertEqual(self.run_db("due_jobs", int(time.time())), [])
+        lock_time = self.run_db("next_job", int(time.time()))
+        self.assertAlmostEqual(lock_time, time.time() + 3600, delta=5)
+        # Confirming again doesn't repeat them
+        self.run_db("confirm_submitted", ObjSubmission(1, "t3_1", "/r/test/1/"))
+        self.assertEqual(len(self.run_db("due_jobs", lock_time)), 1)
+
+    def test_match_submissions(self):
+        def submission(fullname, subreddit, title, created_utc):
+            return SimpleNamespace(
+                fullname=fullname,
+                subreddit=SimpleNamespace(display_name=subreddit),
+                title=title,
+                created_utc=created_utc,
+            )
+
+        def entry(id):
+            return rpc.PostDbEntry(id=id, post=TEXT_POST)
+
+        now = int(time.time())
+        recent = [
+            submission("t3_c", TEXT_POST.subreddit.upper(), TEXT_POST.title, now),
+            submission("t3_b", TEXT_POST.subreddit, "Other title", now),
+            submission("t3_a", TEXT_POST.subreddit, TEXT_POST.title, now - 1000),
+        ]
+        # The old submission with the same title is an earlier repost
+        matches = match_submissions([(entry(1), now - 10), (entry(2), now)], recent)
+        self.assertEqual({id: s.fullname for id, s in matches.items()}, {1: "t3_c"})
+
+    def test_stats_collected_in_batches(self):
+        for i in range(150):
+            self.schedule(TEXT_POST)
+            self.run_db("confirm_submitted", ObjSubmission(i + 1, f"t3_{i}", None))
+        requested = []
+
+        def info(fullnames):
+            requested.append(len(fullnames))
+            for fullname in fullnames:
+                if fullname == "t3_5":
+                    continue  # Deleted
+                yield SimpleNamespace(
+                    fullname=fullname,
+                    permalink=f"/comments/{fullname}/",
+                    score=10,
+                    num_comments=2,
+                    upvote_ratio=0.5,
+                )
+
+        collector = StatsCollector(REDDIT_CONFIG).link_database(self.db)
+        collector.reddit = SimpleNamespace(info=info)
+        collector.step()
+        self.assertEqual(requested, [100, 50])
+        entry = self.run_db("all")[0]
+        self.assertEqual(entry.stats.score, 10)
+        self.assertEqual(entry.permalink, "/comments/t3_0/")
+        self.assertEqual(self.run_db("stats", [1])[1].num_comments, 2)
+        self.assertFalse(self.run_db("all")[5].HasField("stats"))
+        self.assertEqual(self.run_db("stats", [6]), {})
+
+        # Fresh stats aren't fetched again, nor are deleted posts
+        collector.step()
+        self.assertEqual(requested, [100, 50])
+
+    def test_stats_refresh_interval_decays(self):
+        self.assertEqual(stats_refresh_interval(0), STATS_MIN_INTERVAL)
+        self.assertEqual(stats_refresh_interval(4 * 60 * 60), 60 * 60)
+        self.assertEqual(stats_refresh_interval(STATS_MAX_AGE), STATS_MAX_INTERVAL)
+
+    def test_config_reload(self):
+        def make_config(interval: str, username: str) -> ConfigParser:
+            config = ConfigParser()
+            config.read_dict(
+                {
+                    "General": {
+                        "Port": "1",
+                        "PostInterval": interval,
+                        "DryRun": "true",
+                    },
+                    "RedditAPI": dict(REDDIT_CONFIG, Username=username),
+                }
+            )
+            return config
+
+        collector = StatsCollector(REDDIT_CONFIG)
+        old_reddit = collector.reddit
+        reloader = ConfigReloader(make_config("5", "user"), self.poster, [collector])
+
+        with mock.patch("server.get_config", return_value=make_config("60", "user")):
+            reloader.reload()
+        self.assertEqual(self.poster.step_interval, 60)
+        self.assertTrue(self.poster.dry_run)
+        self.assertIs(collector.reddit, old_reddit)
+
+        with mock.patch("server.get_config", return_value=make_config("30", "other")):
+            reloader.reload()
+        self.assertEqual(self.poster.step_interval, 30)
+        self.assertIsNot(collector.reddit, old_reddit)
+
+        # Invalid configs are ignored
+        with mock.patch("server.get_config", return_value=make_config("x", "user")):
+            reloader.reload()
+        self.assertEqual(self.poster.step_interval, 30)
+
+
+class IngesterTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(MemoryStorage())
+        threading.Thread(target=database_thread, args=(self.db,)).start()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.dir.name)
+        flairs = FlairCache(REDDIT_CONFIG)
+        flairs.flairs["test"] = ([rpc.Flair(text="flair1", id="1")], time.time())
+        self.poster = HangingPoster()
+        self.ingester = (
+            DropDirectoryIngester(self.dir.name, flairs)
+            .link_database(self.db)
+            .link_poster(self.poster)
+        )
+        os.makedirs(self.ingester.done)
+        os.makedirs(self.ingester.failed)
+
+    def tearDown(self):
+        self.db.queue_command(DbCommand("quit", None))
+        self.dir.cleanup()
+
+    def write(self, name: str, content: str) -> Path:
+        path = self.path / name
+        path.write_text(content)
+        return path
+
+    def test_ingest(self):
+        shutil.copy("testdata/sample-image.png", self.path / "image.png")
+        paths = [
+            self.write(
+                "text.yaml",
+                "type: text\ntitle: Hi\nsubreddit: test\nbody: hello\n"
+                "scheduled_time: '3/20 18:01 2100'\nflair: flair1\n",
+            ),
+            self.write(
+                "image.yaml",
+                "type: image\ntitle: Pic\nsubreddit: test\nimage_path: image.png\n"
+                "scheduled_time: '3/20 18:01 2100'\n",
+            ),
+            self.write("broken.yaml", "type: text\ntitle: Hi\n"),
+            self.write(
+                "flair.yaml",
+                "type: url\ntitle: Hi\nsubreddit: test\nurl: google.com\n"
+                "scheduled_time: '3/20 18:01 2100'\nflair: missing\n",
+            ),
+        ]
+        self.ingester.ingest(paths)
+
+        cmd = DbCommand("all", None)
+        self.db.queue_command(cmd)
+        entries = cmd.wait_for_answer().obj
+        self.assertEqual([e.post.title for e in entries], ["Hi", "Pic"])
+        self.assertEqual(entries[0].post.flair_id, "1")
+        self.assertGreater(len(entries[1].post.data.image.image_data), 0)
+        self.assertTrue(self.poster.wakeup.is_set())
+
+        self.assertEqual(
+            sorted(os.listdir(self.ingester.done)), ["image.yaml", "text.yaml"]
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.ingester.failed)),
+            ["broken.yaml", "broken.yaml.error", "flair.yaml", "flair.yaml.error"],
+        )
+        error = (self.ingester.failed / "broken.yaml.error").read_text()
+        self.assertIn("subreddit", error)
+
+    def test_ingest_same_name_twice(self):
+        for _ in range(2):
+            self.ingester.ingest([self.write("broken.yaml", "type: text\n")])
+            self.ingester.ingest(
+                [
+                    self.write(
+                        "post.yaml",
+                        "type: url\ntitle: Hi\nsubreddit: test\nurl: google.com\n"
+                        "scheduled_time: '3/20 18:01 2100'\n",
+                    )
+                ]
+            )
+        self.assertEqual(
+            sorted(os.listdir(self.ingester.done)), ["post.1.yaml", "post.yaml"]
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.ingester.failed)),
+            [
+                "broken.1.yaml",
+                "broken.1.yaml.error",
+                "broken.yaml",
+                "broken.yaml.error",
+            ],
+        )
+
+    def test_inotify(self):
+        inotify = Inotify(self.path, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+        try:
+            self.write("a.yaml", "")
+            self.assertEqual(inotify.read(1), ["a.yaml"])
+            self.assertEqual(inotify.read(0), [])
+        finally:
+            inotify.close()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,323 @@
+"""Replays the queue on a simulated clock to see how the Poster keeps up with it.
+
+Time skips ahead whenever the Poster would wait, so a week of schedule runs in
+seconds. Posts go through the dry-run path, or with --fake-reddit through a
+fake Reddit that rate limits posts the way Reddit does for new accounts. The
+service's database is only read, the simulation runs on a MemoryStorage.
+
+Run `python simulate.py --help` for the options.
+"""
+
+from collections import defaultdict, deque
+import logging
+import math
+import os
+import random
+import sqlite3
+import statistics
+import threading
+import time
+from types import SimpleNamespace
+from typing import Deque, Dict, List, Optional, Tuple
+
+import click
+from praw.exceptions import RedditAPIException
+from tabulate import tabulate
+
+import reddit_pb2 as rpc
+from server import (
+    QUERY_ALL,
+    DbCommand,
+    Database,
+    MemoryStorage,
+    Poster,
+    SimulatedClock,
+    database_thread,
+    load_dictionaries,
+    make_entry_from_row,
+    query_database,
+    set_debug_level,
+)
+
+DEFAULT_DB_PATH = os.path.expandvars("$HOME/.config/reddit-scheduler/database.sqlite")
+# Never used to log in, the fake Reddit or dry run stands in for it
+REDDIT_CONFIG = {
+    "ClientId": "simulation",
+    "ClientSecret": "simulation",
+    "Username": "simulation",
+    "Password": "simulation",
+}
+
+
+class FakeReddit:
+    """Stands in for praw.Reddit, accepting at most `limit` posts per `window`
+    seconds of the clock and rejecting the rest with a RATELIMIT error."""
+
+    def __init__(self, clock: SimulatedClock, limit: int, window: float):
+        self.clock = clock
+        self.limit = limit
+        self.window = window
+        self.accepted: Deque[float] = deque()
+        self.lock = threading.Lock()
+        self.validate_on_submit = False
+
+    def subreddit(self, name: str) -> "FakeSubreddit":
+        return FakeSubreddit(self, name)
+
+    def accept(self) -> SimpleNamespace:
+        with self.lock:
+            now = self.clock.time()
+            while self.accepted and self.accepted[0] <= now - self.window:
+                self.accepted.popleft()
+            if len(self.accepted) >= self.limit:
+                wait = math.ceil((self.accepted[0] + self.window - now) / 60)
+                raise RedditAPIException(
+                    [
+                        [
+                            "RATELIMIT",
+                            f"Take a break for {wait} minutes before trying again.",
+                            "ratelimit",
+                        ]
+                    ]
+                )
+            self.accepted.append(now)
+            return SimpleNamespace(fullname=f"t3_{len(self.accepted)}")
+
+
+class FakeSubreddit:
+    """The parts of praw's Subreddit that post_to_reddit and stage_media use."""
+
+    def __init__(self, reddit: FakeReddit, name: str):
+        self._reddit = reddit
+        self.name = name
+
+    def __str__(self) -> str:
+        return self.name
+
+    def submit(self, **_):
+        return self._reddit.accept()
+
+    submit_poll = submit_image = submit
+
+    def _submit_media(self, **_):
+        return self._reddit.accept()
+
+    def _upload_media(self, **_) -> Tuple[str, None]:
+        return "https://example.com/media", None
+
+
+class RecordingPoster(Poster):
+    """Poster that notes when each post was submitted and whether it was
+    rate limited."""
+
+    def __init__(self, clock: SimulatedClock, dry_run: bool, step_interval: float):
+        super().__init__(
+            REDDIT_CONFIG,
+            dry_run=dry_run,
+            step_interval=step_interval,
+            clock=clock,
+        )
+        # Attempts by post id, as (time, error type or "")
+        self.attempts: Dict[int, List[Tuple[float, str]]] = defaultdict(list)
+
+    def submit(self, entry: rpc.PostDbEntry, staged=None):
+        now = self.clock.time()
+        try:
+            submission = super().submit(entry, staged)
+        except RedditAPIException as e:
+            self.attempts[entry.id].append((now, e.items[0].error_type))
+            raise
+        except Exception as e:
+            self.attempts[entry.id].append((now, type(e).__name__))
+            raise
+        self.attempts[entry.id].append((now, ""))
+        return submission
+
+
+def read_database(path: str) -> List[rpc.PostDbEntry]:
+    """Every post in the database at path, which is opened read-only."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        load_dictionaries(conn)
+        return [make_entry_from_row(row) for row in conn.execute(QUERY_ALL)]
+    finally:
+        conn.close()
+
+
+def generate_posts(
+    count: int, start: float, span: float, subreddits: List[str]
+) -> List[rpc.Post]:
+    """Text posts spread randomly over span seconds from start."""
+    return [
+        rpc.Post(
+            title=f"Simulated post {i}",
+            subreddit=random.choice(subreddits),
+            scheduled_time=int(start + random.uniform(0, span)),
+            data=rpc.Data(text=rpc.TextPost(body="Simulated")),
+        )
+        for i in range(count)
+    ]
+
+
+def run(
+    db: Database, poster: RecordingPoster, clock: SimulatedClock, until: float
+) -> int:
+    """Steps the Poster until every post went out or the clock passes until.
+
+    Returns how many steps it took.
+    """
+    steps = 0
+    while True:
+        poster.step()
+        poster.stage()
+        steps += 1
+        now = clock.time()
+        waiting = query_database(db, "next_due", int(now)) is not None
+        if not waiting and not query_database(db, "eligible", None):
+            return steps
+        if now > until:
+            return steps
+        clock.advance(poster.time_until_next_step())
+
+
+def report(entries: List[rpc.PostDbEntry], poster: RecordingPoster, per_post: bool):
+    lags = []
+    rate_limited = 0
+    rows = []
+    for entry in entries:
+        attempts = poster.attempts.get(entry.id, [])
+        limited = sum(1 for _, err in attempts if err == "RATELIMIT")
+        rate_limited += limited
+        posted = [t for t, err in attempts if err == ""]
+        lag = posted[0] - entry.post.scheduled_time if posted else None
+        if lag is not None:
+            lags.append(lag)
+        if per_post:
+            rows.append(
+                [
+                    entry.id,
+                    entry.post.subreddit,
+                    entry.post.title[:40],
+                    time.strftime(
+                        "%m/%d %H:%M", time.localtime(entry.post.scheduled_time)
+                    ),
+                    "not posted" if lag is None else f"{lag / 60:.1f}",
+                    len(attempts),
+                    limited,
+                ]
+            )
+    if per_post:
+        headers = ["Id", "Subreddit", "Title", "Due", "Lag min", "Tries", "Limited"]
+        print(tabulate(rows, headers=headers), end="\n\n")
+
+    lags.sort()
+    summary = [
+        ["Posts", len(entries)],
+        ["Posted", len(lags)],
+        ["Not posted", len(entries) - len(lags)],
+        ["Rate limited attempts", rate_limited],
+    ]
+    if lags:
+        summary += [
+            ["Median lag (min)", f"{statistics.median(lags) / 60:.1f}"],
+            ["95th percentile lag (min)", f"{lags[int(len(lags) * 0.95)] / 60:.1f}"],
+            ["Max lag (min)", f"{lags[-1] / 60:.1f}"],
+        ]
+    print(tabulate(summary))
+
+
+@click.command()
+@click.argument("database", type=click.Path(exists=True), required=False)
+@click.option(
+    "--fake-reddit",
+    is_flag=True,
+    help="Submit to a rate limited fake Reddit instead of the dry-run path.",
+)
+@click.option(
+    "--rate-limit",
+    type=(int, float),
+    default=(1, 600),
+    show_default=True,
+    help="Posts the fake Reddit accepts per window of seconds.",
+)
+@click.option("--post-interval", type=float, default=600, show_default=True)
+@click.option(
+    "--generate",
+    type=int,
+    default=0,
+    help="Schedule this many text posts instead of replaying DATABASE.",
+)
+@click.option(
+    "--span",
+    type=float,
+    default=24,
+    show_default=True,
+    help="Hours generated posts are spread over.",
+)
+@click.option("--subreddits", default="test", show_default=True)
+@click.option(
+    "--max-lag",
+    type=float,
+    default=24,
+    show_default=True,
+    help="Hours after the last post is due to give up on the rest.",
+)
+@click.option("--per-post", is_flag=True, help="Print a row for every post.")
+def main(
+    database: Optional[str],
+    fake_reddit: bool,
+    rate_limit: Tuple[int, float],
+    post_interval: float,
+    generate: int,
+    span: float,
+    subreddits: str,
+    max_lag: float,
+    per_post: bool,
+):
+    """Replay the posts in DATABASE, the service's database by default."""
+    # Rate limits and dry-run posts would otherwise flood the log
+    set_debug_level(logging.CRITICAL)
+    clock = SimulatedClock(time.time())
+    start = clock.time()
+    db = Database(MemoryStorage(), clock)
+    threading.Thread(target=database_thread, args=(db,), daemon=True).start()
+    try:
+        if generate > 0:
+            posts = generate_posts(
+                generate, clock.time(), span * 3600, subreddits.split(",")
+            )
+            query_database(db, "ingest", posts)
+        else:
+            query_database(db, "import", read_database(database or DEFAULT_DB_PATH))
+        entries = [
+            e
+            for e in query_database(db, "all", None) or []
+            if e.status in [rpc.PostStatus.PENDING, rpc.PostStatus.ERROR]
+        ]
+        if not entries:
+            print("No posts waiting to be posted.")
+            return
+
+        poster = RecordingPoster(clock, not fake_reddit, post_interval)
+        if fake_reddit:
+            poster.reddit = FakeReddit(clock, *rate_limit)
+        poster.link_database(db)
+        last_due = max(e.post.scheduled_time for e in entries)
+        started = time.monotonic()
+        steps = run(db, poster, clock, max(last_due, clock.time()) + max_lag * 3600)
+        elapsed = time.monotonic() - started
+    finally:
+        db.queue_command(DbCommand("quit", None))
+
+    simulated = (clock.time() - start) / 3600
+    print(
+        f"Simulated {simulated:.1f} hours in {steps} steps, "
+        f"taking {elapsed:.1f} seconds.",
+        end="\n\n",
+    )
+    report(entries, poster, per_post)
+
+
+if __name__ == "__main__":
+    main()